@@ -1,3 +1,7 @@
+import argparse
+import inspect
+
+import diffusers
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -7,6 +11,7 @@ from diffusers import (
     FluxPipeline,
     FluxTransformer2DModel,
 )
+from packaging import version
 from typing import Union, Optional, Dict, Any, Tuple
 from diffusers.utils import USE_PEFT_BACKEND, is_torch_version, logging, scale_lora_layers, unscale_lora_layers
 
@@ -15,6 +20,9 @@ from transformers import CLIPTokenizer, PretrainedConfig, T5TokenizerFast
 from transformers import CLIPTextModel,T5EncoderModel
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
+# diffusers 0.31 起 txt_ids / img_ids 不再带 batch 维，位置编码在 dim=0 拼接
+_BATCHED_IDS = version.parse(diffusers.__version__).release < (0, 31)
+
 
 def modified_forward(
     self,
@@ -81,10 +89,16 @@ def modified_forward(
         else self.time_text_embed(timestep, guidance, pooled_projections)
     )
     encoder_hidden_states = self.context_embedder(encoder_hidden_states)
-    try:
-        ids = torch.cat((txt_ids, img_ids), dim=1)
-    except:
-        import pdb; pdb.set_trace()
+    if _BATCHED_IDS:
+        try:
+            ids = torch.cat((txt_ids, img_ids), dim=1)
+        except:
+            import pdb; pdb.set_trace()
+    else:
+        # 各样本的 ids 相同，带 batch 维时只取第一个 (与 FluxTransformer2DModel.forward 相同)
+        txt_ids = txt_ids[0] if txt_ids.ndim == 3 else txt_ids
+        img_ids = img_ids[0] if img_ids.ndim == 3 else img_ids
+        ids = torch.cat((txt_ids, img_ids), dim=0)
     image_rotary_emb = self.pos_embed(ids)
     output_features = []
 
@@ -120,7 +134,12 @@ def modified_forward(
         output_features.append(hidden_states)
         # return output_features
     # print(len(output_features))
-    hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
+    # 新版 diffusers 的 single block 分别接收并返回文本 / 图像两段，特征仍取两段拼接后的结果，与旧版一致
+    split_single_blocks = len(self.single_transformer_blocks) > 0 and (
+        "encoder_hidden_states" in inspect.signature(self.single_transformer_blocks[0].forward).parameters
+    )
+    if not split_single_blocks:
+        hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
 
     for index_block, block in enumerate(self.single_transformer_blocks):
         if self.training and self.gradient_checkpointing:
@@ -135,24 +154,45 @@ def modified_forward(
                 return custom_forward
 
             ckpt_kwargs: Dict[str, Any] = {"use_reentrant": False} if is_torch_version(">=", "1.11.0") else {}
-            hidden_states = torch.utils.checkpoint.checkpoint(
-                create_custom_forward(block),
-                hidden_states,
-                temb,
-                image_rotary_emb,
-                **ckpt_kwargs,
-            )
+            if split_single_blocks:
+                encoder_hidden_states, hidden_states = torch.utils.checkpoint.checkpoint(
+                    create_custom_forward(block),
+                    hidden_states,
+                    encoder_hidden_states,
+                    temb,
+                    image_rotary_emb,
+                    **ckpt_kwargs,
+                )
+            else:
+                hidden_states = torch.utils.checkpoint.checkpoint(
+                    create_custom_forward(block),
+                    hidden_states,
+                    temb,
+                    image_rotary_emb,
+                    **ckpt_kwargs,
+                )
 
+        elif split_single_blocks:
+            encoder_hidden_states, hidden_states = block(
+                hidden_states=hidden_states,
+                encoder_hidden_states=encoder_hidden_states,
+                temb=temb,
+                image_rotary_emb=image_rotary_emb,
+            )
         else:
             hidden_states = block(
                 hidden_states=hidden_states,
                 temb=temb,
                 image_rotary_emb=image_rotary_emb,
             )
-        output_features.append(hidden_states)
+        if split_single_blocks:
+            output_features.append(torch.cat([encoder_hidden_states, hidden_states], dim=1))
+        else:
+            output_features.append(hidden_states)
     # print(len(output_features))
 
-    hidden_states = hidden_states[:, encoder_hidden_states.shape[1] :, ...]
+    if not split_single_blocks:
+        hidden_states = hidden_states[:, encoder_hidden_states.shape[1] :, ...]
 
     hidden_states = self.norm_out(hidden_states, temb)
     output = self.proj_out(hidden_states)
@@ -163,10 +203,18 @@ def modified_forward(
 
     return output_features
 
+
+def _repeat_batch(x):
+    # fake / real 拼成一个 batch 时，共用的条件沿 batch 维重复一份
+    if torch.is_tensor(x) and x.ndim > 0:
+        return torch.cat([x, x])
+    return x
+
+
 class TransformerBasedDiscriminatorHead(nn.Module):
-    def __init__(self, input_dim=64, output_channel=1):
+    def __init__(self, input_dim=64, output_channel=1, feature_dim=3072):
         super().__init__()
-        self.proj_out = nn.Linear(3072, input_dim, bias=True)  # 将输入投影到 input_dim
+        self.proj_out = nn.Linear(feature_dim, input_dim, bias=True)  # 将输入投影到 input_dim
         self.mlp = nn.Sequential(
             nn.Linear(input_dim, input_dim),
             nn.LayerNorm(input_dim),  # 可选
@@ -194,9 +242,11 @@ class TransformerBasedDiscriminatorHead(nn.Module):
         return x_out
         
 class TransformerFluxDiscriminator(nn.Module):
-    def __init__(self, transformer, head_num=57,num_heads_per_block=1):
+    def __init__(self, transformer, head_num=57,num_heads_per_block=1,feature_dim=3072,single_pass=False):
         super().__init__()
         self.transformer=transformer
+        # d_loss 中 fake 和 real 拼成一个 batch，只过一次 transformer
+        self.single_pass = single_pass
         self.num_heads_per_block = num_heads_per_block
         self.head_num=head_num
         # transformer_output_dims=[transformer_output_dim]*head_num
@@ -204,7 +254,7 @@ class TransformerFluxDiscriminator(nn.Module):
             [
                 nn.ModuleList(
                     [
-                        TransformerBasedDiscriminatorHead()
+                        TransformerBasedDiscriminatorHead(feature_dim=feature_dim)
                         for _ in range(num_heads_per_block)
                     ]
                 )
@@ -212,13 +262,7 @@ class TransformerFluxDiscriminator(nn.Module):
             ]
         )
 
-    def _forward(self, packed_noisy_model_input, timesteps,guidance,pooled_prompt_embeds,prompt_embeds,text_ids,latent_image_ids):
-        """
-        Args:
-            features (list of tensors): 
-                Features from `transformer_blocks` and `single_transformer_blocks`.
-                Example: [19 * torch.Size([1, 4096, 3072]), 38 * torch.Size([1, 4608, 3072])]
-        """
+    def _features(self, packed_noisy_model_input, timesteps,guidance,pooled_prompt_embeds,prompt_embeds,text_ids,latent_image_ids):
         features = modified_forward(
             self.transformer,
             hidden_states=packed_noisy_model_input,
@@ -233,11 +277,25 @@ class TransformerFluxDiscriminator(nn.Module):
         )
         # features=[features[18],features[37],features[56]] 
         assert self.head_num == len(features)
+        return features
+
+    def _heads(self, features):
+        """
+        Args:
+            features (list of tensors): 
+                Features from `transformer_blocks` and `single_transformer_blocks`.
+                Example: [19 * torch.Size([1, 4096, 3072]), 38 * torch.Size([1, 4608, 3072])]
+        """
         outputs = []
         for feature_set, head_set in zip(features, self.heads):
             for feature, head in zip(feature_set, head_set):
                 outputs.append(head(feature))
         return outputs
+
+    def _forward(self, packed_noisy_model_input, timesteps,guidance,pooled_prompt_embeds,prompt_embeds,text_ids,latent_image_ids):
+        return self._heads(
+            self._features(packed_noisy_model_input, timesteps,guidance,pooled_prompt_embeds,prompt_embeds,text_ids,latent_image_ids)
+        )
     
     def forward(self, flag, *args):
         if flag == "d_loss":
@@ -260,14 +318,30 @@ class TransformerFluxDiscriminator(nn.Module):
         weight=1,
     ):
         loss = 0.0
-        fake_outputs = self._forward(
-            # sample_fake.detach(), timestep, encoder_hidden_states, added_cond_kwargs
-            sample_fake.detach(), timesteps,guidance,pooled_prompt_embeds,prompt_embeds,text_ids,latent_image_ids
-        )
-        real_outputs = self._forward(
-            # sample_real.detach(), timestep, encoder_hidden_states, added_cond_kwargs
-            sample_real.detach(), timesteps,guidance,pooled_prompt_embeds,prompt_embeds,text_ids,latent_image_ids
-        )
+        if self.single_pass:
+            features = self._features(
+                torch.cat([sample_fake.detach(), sample_real.detach()]),
+                _repeat_batch(timesteps),
+                _repeat_batch(guidance),
+                _repeat_batch(pooled_prompt_embeds),
+                _repeat_batch(prompt_embeds),
+                # 不带 batch 维的 ids ([seq_len, 3]) 对整个 batch 共用
+                _repeat_batch(text_ids) if text_ids.ndim == 3 else text_ids,
+                _repeat_batch(latent_image_ids) if latent_image_ids.ndim == 3 else latent_image_ids,
+            )
+            # 判别头按 feature 的第一维逐个取样本，因此在 backbone 输出上切分，而不是在判别头输出上
+            batch_size = sample_fake.shape[0]
+            fake_outputs = self._heads([feature[:batch_size] for feature in features])
+            real_outputs = self._heads([feature[batch_size:] for feature in features])
+        else:
+            fake_outputs = self._forward(
+                # sample_fake.detach(), timestep, encoder_hidden_states, added_cond_kwargs
+                sample_fake.detach(), timesteps,guidance,pooled_prompt_embeds,prompt_embeds,text_ids,latent_image_ids
+            )
+            real_outputs = self._forward(
+                # sample_real.detach(), timestep, encoder_hidden_states, added_cond_kwargs
+                sample_real.detach(), timesteps,guidance,pooled_prompt_embeds,prompt_embeds,text_ids,latent_image_ids
+            )
         for fake_output, real_output in zip(fake_outputs, real_outputs):
             loss += (
                 torch.mean(weight * torch.relu(fake_output.float() + 1))
@@ -296,3 +370,53 @@ class TransformerFluxDiscriminator(nn.Module):
             )
         return loss
     
+
+
+def check_single_pass(seed=0, atol=1e-5):
+    # 在一个很小的 Flux 结构 transformer 上比较两次前向与单次前向的 d_loss 及判别头梯度
+    torch.manual_seed(seed)
+    transformer = FluxTransformer2DModel(
+        patch_size=1,
+        in_channels=16,
+        num_layers=1,
+        num_single_layers=2,
+        attention_head_dim=16,
+        num_attention_heads=2,
+        joint_attention_dim=32,
+        pooled_projection_dim=32,
+        guidance_embeds=True,
+        axes_dims_rope=(4, 4, 8),
+    )
+    transformer.requires_grad_(False)
+    discriminator = TransformerFluxDiscriminator(transformer, head_num=3, feature_dim=32)
+    sample_fake, sample_real = torch.randn(2, 3, 64, 16)
+    timesteps = torch.rand(3) * 1000
+    guidance = torch.full((3,), 3.5)
+    pooled_prompt_embeds = torch.randn(3, 32)
+    prompt_embeds = torch.randn(3, 7, 32)
+    # 64 个 latent token 即 8x8 的网格；diffusers < 0.31 的 ids 带 batch 维 ([3, seq_len, 3]) 且传入 packing 前的尺寸
+    grid_size = 16 if _BATCHED_IDS else 8
+    latent_image_ids = FluxPipeline._prepare_latent_image_ids(3, grid_size, grid_size, "cpu", torch.float32)
+    text_ids = torch.zeros(*latent_image_ids.shape[:-2], 7, 3)
+
+    results = []
+    for single_pass in (False, True):
+        discriminator.single_pass = single_pass
+        discriminator.zero_grad(set_to_none=True)
+        loss = discriminator(
+            "d_loss", sample_fake, sample_real, timesteps, guidance, pooled_prompt_embeds, prompt_embeds, text_ids, latent_image_ids
+        )
+        loss.backward()
+        results.append((loss.detach(), [p.grad.clone() for p in discriminator.heads.parameters()]))
+    (loss_two, grads_two), (loss_one, grads_one) = results
+    grad_error = max((a - b).abs().max().item() for a, b in zip(grads_two, grads_one))
+    print(f"d_loss two passes {loss_two.item():.6f}, single pass {loss_one.item():.6f}, max head grad difference {grad_error:.2e}")
+    assert torch.allclose(loss_two, loss_one, atol=atol) and grad_error <= atol
+    return loss_two, loss_one
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check_single_pass", action="store_true", help="Check that the single-pass d_loss matches two passes on a tiny transformer.")
+    if parser.parse_args().check_single_pass:
+        check_single_pass()
@@ -15,12 +15,14 @@ import argparse
 import copy
 import gc
 import itertools
+import json
 import logging
 import math
 import os
 import random
 import shutil
-from contextlib import nullcontext
+import sys
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
 from PIL import Image
 
@@ -70,7 +72,11 @@ from diffusers.utils.hub_utils import load_or_create_model_card, populate_model_
 from diffusers.utils.torch_utils import is_compiled_module
 from diffusers.utils.import_utils import is_xformers_available
 # from dataset import SDXLText2ImageDataset
-from dataset_myself import ComicDataModule
+# 数据集与各类缓存模块由 SDXL / FLUX 训练脚本共用，放在 RLCFM/common 下
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from dataset_myself import ComicDataModule, prepare_pixel_values
+from latent_cache import latent_dist_sample
+from embedding_cache import EmbeddingCache
 import random, time
 from pcm_discriminator_flux import TransformerFluxDiscriminator
 from pcm_scheduling_flowmatch_modified import FlowMatchEulerDiscreteScheduler
@@ -243,6 +249,33 @@ class EulerSolver:
         x_prev_s = sample + (sigma_prev_s - sigma) * model_pred
         return x_prev_s
 
+@contextmanager
+def no_grad_forward(model):
+    """
+    Forward of a model whose output is not backpropagated, e.g. the student on discriminator steps where the
+    fake sample is detached: no autograd graph is built and gradient checkpointing is switched off, so the
+    checkpointed blocks skip their bookkeeping as well.
+    """
+    model = model.get_base_model() if hasattr(model, "get_base_model") else model
+    checkpointing = model.is_gradient_checkpointing
+    if checkpointing:
+        model.disable_gradient_checkpointing()
+    try:
+        with torch.no_grad():
+            yield
+    finally:
+        if checkpointing:
+            model.enable_gradient_checkpointing()
+
+
+@torch.no_grad()
+def normalize_gradients(parameters, scale):
+    """Multiplies the accumulated gradients by `scale` before clipping and the optimizer step."""
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if grads and scale != 1:
+        torch._foreach_mul_(grads, scale)
+
+
 def import_model_class_from_model_name_or_path(
     pretrained_teacher_model: str, revision: str, subfolder: str = "text_encoder"
 ):
@@ -376,7 +409,9 @@ def parse_args():
         help=(
             "The name of the Dataset (from the HuggingFace hub) to train on (could be your own, possibly private,"
             " dataset). It can also be a path pointing to a local copy of a dataset in your filesystem,"
-            " or to a folder containing files that 🤗 Datasets can understand."
+            " or to a folder containing files that 🤗 Datasets can understand. Tar shards in webdataset format"
+            " (e.g. `/data/shards/{00000..00999}.tar`, several patterns separated by `::`) are read sequentially"
+            " and bucketed on the fly; this needs `--max_train_samples` as the number of samples per epoch."
         ),
     )
     parser.add_argument(
@@ -417,6 +452,102 @@ def parse_args():
             "Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process."
         ),
     )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=2,
+        help="Number of batches loaded in advance by each worker. Only used when `--dataloader_num_workers > 0`.",
+    )
+    parser.add_argument(
+        "--dataloader_persistent_workers",
+        action="store_true",
+        help="Keep the dataloader workers alive between epochs instead of re-creating them.",
+    )
+    parser.add_argument(
+        "--dataloader_sync_buckets",
+        action="store_true",
+        help=(
+            "Make all ranks draw their batch from the same resolution bucket at every step, so that step time is"
+            " uniform across GPUs instead of waiting on the rank with the largest resolution."
+        ),
+    )
+    parser.add_argument(
+        "--max_batch_pixels",
+        type=int,
+        default=None,
+        help=(
+            "If set, the batch size of every resolution bucket is max_batch_pixels // (width * height) instead of"
+            " `--train_batch_size`, e.g. train_batch_size * 1024 * 1024 keeps the number of latent tokens per step"
+            " close to the base resolution. Gradients are averaged over the samples of each accumulation window and"
+            " the step count and learning rate schedule follow the number of samples seen (see `--max_train_steps`)."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_reduced_decode",
+        action="store_true",
+        help=(
+            "Decode JPEGs at 1/2, 1/4 or 1/8 resolution (libjpeg DCT scaling) when the original image, as recorded"
+            " in the manifest, is still at least as large as its bucket after the reduction. Saves most of the"
+            " decode time for photos much larger than the buckets. Benchmark with"
+            " `python ../common/dataset_myself.py --benchmark_decode <manifest>`."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_device_resize",
+        action="store_true",
+        help=(
+            "Dataloader workers only decode; each batch is resized to its bucket resolution on the training device"
+            " with antialiased bilinear interpolation (one call per source image size). Best combined with"
+            " `--dataloader_reduced_decode`, which keeps the transferred images small. Check the difference to the"
+            " cv2 path with `python ../common/dataset_myself.py --check_device_resize <manifest>`."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_read_ahead_batches",
+        type=int,
+        default=0,
+        help=(
+            "If > 0, every dataloader worker reads the image files of its next N batches in the background"
+            " (`--dataloader_read_ahead_threads` threads per worker) and decodes them from memory, hiding the"
+            " latency of network filesystems."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_read_ahead_threads",
+        type=int,
+        default=16,
+        help="Threads per dataloader worker reading image files for `--dataloader_read_ahead_batches`.",
+    )
+    parser.add_argument(
+        "--dataloader_image_cache_gb",
+        type=float,
+        default=0,
+        help=(
+            "Keep up to this many GB of encoded image files in shared memory, shared by all dataloader workers"
+            " of a process, so later epochs of a small dataset are read from RAM. Requires the `fork` worker"
+            " start method. 0 disables the cache."
+        ),
+    )
+    parser.add_argument(
+        "--latent_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory written by `python ../common/latent_cache.py`. When set, the dataloader serves the cached VAE latent"
+            " moments and images are neither decoded nor passed through the VAE during training."
+        ),
+    )
+    parser.add_argument(
+        "--text_embedding_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory of a persistent fp16 cache of the FLUX prompt embeddings keyed by caption hash. The T5"
+            " hidden states are stored for all `--max_sequence_length` positions, including the padding-token"
+            " outputs, so cache hits match the uncached embeddings. The text encoders are only loaded for cache"
+            " misses."
+        ),
+    )
     # ----Batch Size and Training Steps----
     parser.add_argument(
         "--train_batch_size",
@@ -429,7 +560,11 @@ def parse_args():
         "--max_train_steps",
         type=int,
         default=None,
-        help="Total number of training steps to perform.  If provided, overrides num_train_epochs.",
+        help=(
+            "Total number of training steps to perform.  If provided, overrides num_train_epochs. Steps are counted"
+            " in samples, one step being train_batch_size * num_processes * gradient_accumulation_steps samples,"
+            " so that they keep their meaning with `--max_batch_pixels`."
+        ),
     )
     parser.add_argument(
         "--max_train_samples",
@@ -575,6 +710,16 @@ def parse_args():
         default=512,
         help="",
     )
+    parser.add_argument(
+        "--dynamic_text_length",
+        action="store_true",
+        help=(
+            "Pad the T5 prompt embeddings to the longest caption of each batch, rounded up to a multiple of 64 and"
+            " capped at `--max_sequence_length`, instead of always to `--max_sequence_length`. This shortens the"
+            " joint attention of every transformer pass on short-caption datasets. T5 is run without an attention"
+            " mask, so the embeddings differ slightly from the fully padded ones."
+        ),
+    )
     # ----Latent Consistency Distillation (LCD) Specific Arguments----
     parser.add_argument(
         "--guidance_scale",
@@ -716,6 +861,11 @@ def parse_args():
     parser.add_argument("--s_ratio", default=0.3, type=float)
     parser.add_argument("--adv_weight", default=0.1, type=float)
     parser.add_argument("--adv_lr", default=1e-5, type=float)
+    parser.add_argument(
+        "--discriminator_single_pass",
+        action="store_true",
+        help="Run fake and real samples through the discriminator backbone as one batch in the discriminator loss.",
+    )
     args = parser.parse_args()
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
     if env_local_rank != -1 and env_local_rank != args.local_rank:
@@ -725,18 +875,20 @@ def parse_args():
     return args
 
 
-def tokenize_prompt(tokenizer, prompt, max_sequence_length):
+def tokenize_prompt(tokenizer, prompt, max_sequence_length, pad_to_multiple_of=None):
+    # pad_to_multiple_of 为 None 时补齐到 max_sequence_length，否则补齐到 batch 内最长 caption 的整数倍
     text_inputs = tokenizer(
         prompt,
-        padding="max_length",
+        padding="max_length" if pad_to_multiple_of is None else "longest",
         max_length=max_sequence_length,
         truncation=True,
+        pad_to_multiple_of=pad_to_multiple_of,
         return_length=False,
         return_overflowing_tokens=False,
         return_tensors="pt",
     )
     text_input_ids = text_inputs.input_ids
-    return text_input_ids
+    return text_input_ids[:, :max_sequence_length]
 
 
 def _encode_prompt_with_t5(
@@ -746,21 +898,13 @@ def _encode_prompt_with_t5(
     prompt=None,
     num_images_per_prompt=1,
     device=None,
-    text_input_ids=None
+    text_input_ids=None,
+    pad_to_multiple_of=None,
 ):
     prompt = [prompt] if isinstance(prompt, str) else prompt
     batch_size = len(prompt)
 
-    text_inputs = tokenizer(
-        prompt,
-        padding="max_length",
-        max_length=max_sequence_length,
-        truncation=True,
-        return_length=False,
-        return_overflowing_tokens=False,
-        return_tensors="pt",
-    )
-    text_input_ids = text_inputs.input_ids
+    text_input_ids = tokenize_prompt(tokenizer, prompt, max_sequence_length, pad_to_multiple_of)
     prompt_embeds = text_encoder(text_input_ids.to(device))[0]
 
     dtype = text_encoder.dtype
@@ -817,6 +961,7 @@ def encode_prompt(
     device=None,
     num_images_per_prompt: int = 1,
     text_input_ids_list=None,
+    pad_to_multiple_of=None,
 ):
     prompt = [prompt] if isinstance(prompt, str) else prompt
     batch_size = len(prompt)
@@ -839,6 +984,7 @@ def encode_prompt(
         num_images_per_prompt=num_images_per_prompt,
         device=device if device is not None else text_encoders[1].device,
         text_input_ids=text_input_ids_list[1] if text_input_ids_list else None,
+        pad_to_multiple_of=pad_to_multiple_of,
     )
 
     text_ids = torch.zeros(batch_size, prompt_embeds.shape[1], 3).to(device=device, dtype=dtype)
@@ -847,6 +993,84 @@ def encode_prompt(
     return prompt_embeds, pooled_prompt_embeds, text_ids
 
 
+class CachedPromptEncoder:
+    """
+    `encode_prompt` backed by a persistent fp16 `EmbeddingCache` keyed by caption hash.
+
+    The T5 hidden states are stored for all `max_sequence_length` positions: T5 runs without an attention
+    mask, so its outputs at the padding positions depend on the caption, and a cache hit returns them as
+    `encode_prompt` computed them. The number of real tokens (including `</s>`) is stored next to the CLIP
+    pooled embedding; with `pad_to_multiple_of` the embeddings are cut after the longest caption of the batch
+    rounded up to that multiple. The text encoders are created by `load_text_encoders` on the first cache
+    miss, so a warm cache never puts T5 on the GPU.
+    """
+
+    fields = {
+        "prompt_embeds": ((None, 4096), np.float16),
+        "pooled_prompt_embeds": ((768,), np.float16),
+        "num_tokens": ((1,), np.int32),
+    }
+
+    def __init__(self, embedding_cache, load_text_encoders, tokenizers, max_sequence_length, pad_to_multiple_of=None):
+        self.embedding_cache = embedding_cache
+        self.load_text_encoders = load_text_encoders
+        self.tokenizers = tokenizers
+        self.max_sequence_length = max_sequence_length
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.text_encoders = None
+
+    @torch.no_grad()
+    def encode_misses(self, captions):
+        if self.text_encoders is None:
+            self.text_encoders = self.load_text_encoders()
+        prompt_embeds, pooled_prompt_embeds, _ = encode_prompt(
+            self.text_encoders, self.tokenizers, captions, self.max_sequence_length
+        )
+        # 真实 token 数（含 </s>），之后都是 pad token；动态长度时按它截断
+        lengths = self.tokenizers[1](
+            captions,
+            padding="max_length",
+            max_length=self.max_sequence_length,
+            truncation=True,
+            return_tensors="pt",
+        ).attention_mask.sum(dim=1).tolist()
+        prompt_embeds = prompt_embeds.to(torch.float16).cpu().numpy()
+        pooled_prompt_embeds = pooled_prompt_embeds.to(torch.float16).cpu().numpy()
+        found = {}
+        for caption, length, prompt_embed, pooled_prompt_embed in zip(
+            captions, lengths, prompt_embeds, pooled_prompt_embeds
+        ):
+            found[caption] = {
+                "prompt_embeds": prompt_embed,
+                "pooled_prompt_embeds": pooled_prompt_embed,
+                "num_tokens": np.array([length], dtype=np.int32),
+            }
+            self.embedding_cache.put(caption, **found[caption])
+        return found
+
+    def lookup(self, captions):
+        found = {caption: self.embedding_cache.get(caption) for caption in set(captions)}
+        misses = sorted(caption for caption, embeds in found.items() if embeds is None)
+        if misses:
+            found.update(self.encode_misses(misses))
+        return found
+
+    def __call__(self, prompt, device=None, dtype=None):
+        prompt = [prompt] if isinstance(prompt, str) else prompt
+        found = self.lookup(prompt)
+        seq_len = self.max_sequence_length
+        if self.pad_to_multiple_of is not None:
+            longest = max(int(found[caption]["num_tokens"][0]) for caption in prompt)
+            seq_len = min(-(-longest // self.pad_to_multiple_of) * self.pad_to_multiple_of, seq_len)
+        prompt_embeds = np.stack([found[caption]["prompt_embeds"][:seq_len] for caption in prompt])
+        pooled_prompt_embeds = np.stack([found[caption]["pooled_prompt_embeds"] for caption in prompt])
+
+        prompt_embeds = torch.from_numpy(prompt_embeds).to(device=device, dtype=dtype)
+        pooled_prompt_embeds = torch.from_numpy(pooled_prompt_embeds).to(device=device, dtype=dtype)
+        text_ids = torch.zeros(len(prompt), seq_len, 3).to(device=device, dtype=dtype)
+        return prompt_embeds, pooled_prompt_embeds, text_ids
+
+
 def main(args):
     if torch.backends.mps.is_available() and args.mixed_precision == "bf16":
         # due to pytorch#99272, MPS does not yet support bfloat16.
@@ -908,13 +1132,6 @@ def main(args):
         args.pretrained_teacher_model, args.teacher_revision, subfolder="text_encoder_2"
     )
 
-    text_encoder_one = text_encoder_cls_one.from_pretrained(
-        args.pretrained_teacher_model, subfolder="text_encoder", revision=args.teacher_revision
-    )
-    text_encoder_two = text_encoder_cls_two.from_pretrained(
-        args.pretrained_teacher_model, subfolder="text_encoder_2", revision=args.teacher_revision
-    )
-
     # 3. Create the noise scheduler and the desired noise schedule.
     noise_scheduler = FlowMatchEulerDiscreteScheduler.from_pretrained(
         args.pretrained_teacher_model, subfolder="scheduler"
@@ -922,9 +1139,11 @@ def main(args):
     # noise_scheduler_solver = FlowMatchEulerDiscreteScheduler.from_pretrained(
     #     args.pretrained_teacher_model, subfolder="scheduler"
     # )
-    text_encoder_one, text_encoder_two = load_text_encoders(
-        text_encoder_cls_one, text_encoder_cls_two
-    )
+    # 使用 text embedding 缓存时，text encoder 只在缓存未命中时才加载
+    if args.text_embedding_cache_dir is None:
+        text_encoder_one, text_encoder_two = load_text_encoders(
+            text_encoder_cls_one, text_encoder_cls_two
+        )
     # 4. Load VAE from SD-XL checkpoint (or more stable VAE)
     vae_path = (
         args.pretrained_teacher_model
@@ -952,7 +1171,7 @@ def main(args):
 
 
 
-    discriminator = TransformerFluxDiscriminator(transformer)
+    discriminator = TransformerFluxDiscriminator(transformer, single_pass=args.discriminator_single_pass)
     discriminator.transformer.requires_grad_(False)
     discriminator_params = []
     for param in discriminator.heads.parameters():
@@ -967,8 +1186,9 @@ def main(args):
     # transformer.requires_grad_(False)
     # teacher_transformer.requires_grad_(False)
     vae.requires_grad_(False)
-    text_encoder_one.requires_grad_(False)
-    text_encoder_two.requires_grad_(False)
+    if args.text_embedding_cache_dir is None:
+        text_encoder_one.requires_grad_(False)
+        text_encoder_two.requires_grad_(False)
 
     # 8. Handle mixed precision and device placement
     # For mixed precision training we cast all non-trainable weigths to half-precision
@@ -985,11 +1205,14 @@ def main(args):
             "Mixed precision training with bfloat16 is not supported on MPS. Please use fp16 (recommended) or fp32 instead."
         )
 
-    vae.to(accelerator.device, dtype=torch.float32)
+    # 使用 latent cache 时训练中只用到 vae.config，VAE 不需要占用显存
+    if args.latent_cache_dir is None:
+        vae.to(accelerator.device, dtype=torch.float32)
     transformer.to(accelerator.device, dtype=weight_dtype)
     # teacher_transformer.to(accelerator.device, dtype=weight_dtype)
-    text_encoder_one.to(accelerator.device, dtype=weight_dtype)
-    text_encoder_two.to(accelerator.device, dtype=weight_dtype)
+    if args.text_embedding_cache_dir is None:
+        text_encoder_one.to(accelerator.device, dtype=weight_dtype)
+        text_encoder_two.to(accelerator.device, dtype=weight_dtype)
     #print(noise_scheduler.config.num_train_timesteps)
     solver = EulerSolver(
         noise_scheduler.sigmas.numpy()[::-1],
@@ -1205,12 +1428,50 @@ def main(args):
 
     # 13. Dataset creation and data processing
     tokenizers = [tokenizer_one, tokenizer_two]
-    text_encoders = [text_encoder_one, text_encoder_two]
+    # 动态长度时 T5 embedding 只补齐到 batch 内最长 caption（64 的整数倍）
+    text_pad_to_multiple_of = 64 if args.dynamic_text_length else None
+    if args.text_embedding_cache_dir is None:
+        text_encoders = [text_encoder_one, text_encoder_two]
+        prompt_encoder = None
+    else:
+        text_encoders = None
+
+        def load_cache_miss_text_encoders():
+            logger.info("Loading text encoders for text embedding cache misses")
+            text_encoders = load_text_encoders(text_encoder_cls_one, text_encoder_cls_two)
+            for text_encoder in text_encoders:
+                text_encoder.requires_grad_(False)
+                text_encoder.to(accelerator.device, dtype=weight_dtype)
+            return list(text_encoders)
+
+        embedding_cache = EmbeddingCache(
+            args.text_embedding_cache_dir,
+            CachedPromptEncoder.fields,
+            signature={
+                "model": args.pretrained_teacher_model,
+                "revision": args.revision,
+                "variant": args.variant,
+                "max_sequence_length": args.max_sequence_length,
+            },
+        )
+        prompt_encoder = CachedPromptEncoder(
+            embedding_cache,
+            load_cache_miss_text_encoders,
+            tokenizers,
+            args.max_sequence_length,
+            pad_to_multiple_of=text_pad_to_multiple_of,
+        )
 
     def compute_text_embeddings(prompt, text_encoders, tokenizers):
+        if prompt_encoder is not None:
+            return prompt_encoder(prompt, device=accelerator.device, dtype=weight_dtype)
         with torch.no_grad():
             prompt_embeds, pooled_prompt_embeds, text_ids = encode_prompt(
-                text_encoders, tokenizers, prompt, args.max_sequence_length
+                text_encoders,
+                tokenizers,
+                prompt,
+                args.max_sequence_length,
+                pad_to_multiple_of=text_pad_to_multiple_of,
             )
             prompt_embeds = prompt_embeds.to(accelerator.device)
             pooled_prompt_embeds = pooled_prompt_embeds.to(accelerator.device)
@@ -1238,9 +1499,29 @@ def main(args):
 
 
     print("##load dataset")
-    data_module = ComicDataModule(batch_size=args.train_batch_size, file_txt=args.train_shards_path_or_url,disable_bucket=args.disable_bucket)
+    data_module = ComicDataModule(
+        batch_size=args.train_batch_size,
+        file_txt=args.train_shards_path_or_url,
+        disable_bucket=args.disable_bucket,
+        num_workers=args.dataloader_num_workers,
+        prefetch_factor=args.dataloader_prefetch_factor,
+        persistent_workers=args.dataloader_persistent_workers,
+        seed=args.seed if args.seed is not None else 0,
+        num_replicas=accelerator.num_processes,
+        rank=accelerator.process_index,
+        sync_buckets=args.dataloader_sync_buckets,
+        max_batch_pixels=args.max_batch_pixels,
+        latent_cache_dir=args.latent_cache_dir,
+        reduced_decode=args.dataloader_reduced_decode,
+        device_resize=args.dataloader_device_resize,
+        num_samples=args.max_train_samples,
+        read_ahead_batches=args.dataloader_read_ahead_batches,
+        read_ahead_threads=args.dataloader_read_ahead_threads,
+        image_cache_bytes=int(args.dataloader_image_cache_gb * 2**30),
+    )
     data_module.setup(stage="fit")
     train_dataloader = data_module.train_dataloader()
+    batch_sampler = data_module.batch_sampler
 
 
 
@@ -1249,9 +1530,12 @@ def main(args):
 
     # 14. LR Scheduler creation
     # Scheduler and math around the number of training steps.
+    # 训练进度按样本数计：一个优化步对应 total_batch_size 个样本。动态 batch (`--max_batch_pixels`) 时
+    # 每步实际样本数不同，总步数、epoch 数和学习率调度都按已消费的样本数换算
+    total_batch_size = args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
     overrode_max_train_steps = False
     num_update_steps_per_epoch = math.ceil(
-        len(train_dataloader) / args.gradient_accumulation_steps
+        batch_sampler.epoch_samples() * accelerator.num_processes / total_batch_size
     )
     if args.max_train_steps is None:
         args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
@@ -1272,7 +1556,7 @@ def main(args):
     transformer, discriminator, optimizer, discriminator_optimizer, lr_scheduler = accelerator.prepare(transformer, discriminator, optimizer, discriminator_optimizer, lr_scheduler)
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
-    num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
+    num_update_steps_per_epoch = math.ceil(batch_sampler.epoch_samples() * accelerator.num_processes / total_batch_size)
     if overrode_max_train_steps:
         args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
     # Afterwards we recalculate our number of training epochs
@@ -1284,17 +1568,23 @@ def main(args):
         accelerator.init_trackers(args.tracker_project_name, config=vars(args))
 
     # 16. Train!
-    total_batch_size = args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
-
     logger.info("***** Running training *****")
     logger.info(f"  Num batches each epoch = {len(train_dataloader)}")
     logger.info(f"  Num Epochs = {args.num_train_epochs}")
     logger.info(f"  Instantaneous batch size per device = {args.train_batch_size}")
+    if args.max_batch_pixels is not None:
+        logger.info(f"  Max pixels per batch = {args.max_batch_pixels} (batch size per bucket up to {batch_sampler.max_batch_size})")
     logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
     logger.info(f"  Gradient Accumulation steps = {args.gradient_accumulation_steps}")
     logger.info(f"  Total optimization steps = {args.max_train_steps}")
     global_step = 0
     first_epoch = 0
+    # 动态 batch 时每步样本数不同，按样本数而不是 batch 数统计训练进度
+    samples_seen = 0
+    # 生成器步消费的样本数，学习率每 total_batch_size 个样本调度一步
+    scheduler_samples = 0
+    # 当前梯度累积窗口内所有 rank 的样本数
+    window_samples = 0
     # 假设使用 float32 类型 (每个元素占 4 字节)
     total_memory = 0  # 总内存占用（字节）
 
@@ -1338,16 +1628,30 @@ def main(args):
         else:
             accelerator.print(f"Resuming from checkpoint {path}")
             accelerator.load_state(os.path.join(args.output_dir, path))
+            sampler_state_path = os.path.join(args.output_dir, path, "sampler_state.json")
+            if os.path.exists(sampler_state_path):
+                with open(sampler_state_path) as f:
+                    sampler_state = json.load(f)
+                samples_seen = sampler_state.pop("samples_seen", 0)
+                scheduler_samples = sampler_state.pop("scheduler_samples", 0)
+                batch_sampler.load_state_dict(sampler_state)
             global_step = int(path.split("-")[1])
 
             initial_global_step = global_step
-            first_epoch = global_step // num_update_steps_per_epoch
+            if os.path.exists(sampler_state_path):
+                # 动态 batch 时 epoch 无法由步数推算，用 sampler 保存的 epoch
+                first_epoch = batch_sampler.epoch
+            else:
+                # 没有 sampler 状态的旧 checkpoint 按固定 batch 估算已消费的样本数
+                first_epoch = global_step // num_update_steps_per_epoch
+                samples_seen = global_step * total_batch_size
     else:
         initial_global_step = 0
 
     progress_bar = tqdm(
         range(0, args.max_train_steps),
-        initial=initial_global_step,
+        # 进度条按样本数换算的步数显示，与 max_train_steps 一致
+        initial=samples_seen // total_batch_size,
         desc="Steps",
         # Only show the progress bar once on each machine.
         disable=not accelerator.is_local_main_process,
@@ -1358,6 +1662,8 @@ def main(args):
 
     for epoch in range(first_epoch, args.num_train_epochs):
         transformer.train()
+        # 恢复训练时 sampler 已载入同一 epoch 的 position，set_epoch 不会重置
+        batch_sampler.set_epoch(epoch)
         for step, batch in enumerate(train_dataloader):
             if step >= len(train_dataloader) - 1:
                 break
@@ -1365,8 +1671,7 @@ def main(args):
             with accelerator.accumulate(models_to_accumulate):
                 # pixel_values, prompts, _, _ = batch
                 # pixel_values = pixel_values.to(dtype=vae.dtype, device=vae.device)
-                pixel_values, prompts, orig_size, crop_coords, target_sizes  = batch['pixel_values'], batch['caption'], batch['original_sizes'], batch['crop_top_lefts'], batch['target_sizes']     
-                pixel_values = pixel_values.to(dtype=vae.dtype, device=vae.device)
+                prompts, orig_size, crop_coords, target_sizes  = batch['caption'], batch['original_sizes'], batch['crop_top_lefts'], batch['target_sizes']     
                 # orig_size = [torch.tensor(list(items)) for items in zip(*orig_size)]
                 # crop_coords = [torch.tensor(list(items)) for items in zip(*crop_coords)]
 
@@ -1376,7 +1681,16 @@ def main(args):
                 )
 
                 # Convert images to latent space
-                model_input = vae.encode(pixel_values).latent_dist.sample()
+                if args.latent_cache_dir is not None:
+                    # 从缓存的 latent 分布均值 / 对数方差直接采样，跳过解码和 VAE 编码
+                    model_input = latent_dist_sample(
+                        batch["latent_mean"].to(accelerator.device, non_blocking=True),
+                        batch["latent_logvar"].to(accelerator.device, non_blocking=True),
+                    )
+                else:
+                    pixel_values = prepare_pixel_values(batch, vae.device)
+                    pixel_values = pixel_values.to(dtype=vae.dtype)
+                    model_input = vae.encode(pixel_values).latent_dist.sample()
                 model_input = model_input * vae.config.scaling_factor
                 model_input = model_input.to(dtype=weight_dtype)
 
@@ -1393,6 +1707,12 @@ def main(args):
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(model_input)
                 bsz = model_input.shape[0]
+                # 各桶 batch 大小不同时，loss 按样本数加权累积，参数更新前再把梯度乘以
+                # total_batch_size / window_samples (累积窗口内所有 rank 的实际样本数)，
+                # 使每个样本的贡献相同且权重平均为 1；固定 batch 时两者都是 1
+                sample_weight = bsz / args.train_batch_size
+                global_bsz = int(accelerator.reduce(torch.tensor(bsz, device=accelerator.device), "sum"))
+                window_samples += global_bsz
 
                 index = torch.randint(0, args.num_euler_timesteps, (bsz,), device=model_input.device).long()
 
@@ -1425,19 +1745,24 @@ def main(args):
                     width=model_input.shape[3],
                 )
 
+                # 偶数步只更新判别器，d_loss 会 detach fake 样本，学生前向不需要计算图
+                d_step = global_step % 2 == 0
+                student_forward = no_grad_forward(accelerator.unwrap_model(transformer)) if d_step else nullcontext()
+
                 # 20.4.9. Get online LCM prediction on z_{t_{n + k}}, w, c, t_{n + k}
                 # Predict the noise residual
-                model_pred = transformer(
-                    hidden_states=packed_noisy_model_input,
-                    # YiYi notes: divide it by 1000 for now because we scale it by 1000 in the transforme rmodel (we should not keep it but I want to keep the inputs same for the model for testing)
-                    timestep=timesteps / 1000,
-                    guidance=guidance,
-                    pooled_projections=pooled_prompt_embeds,
-                    encoder_hidden_states=prompt_embeds,
-                    txt_ids=text_ids,
-                    img_ids=latent_image_ids,
-                    return_dict=False,
-                )[0]
+                with student_forward:
+                    model_pred = transformer(
+                        hidden_states=packed_noisy_model_input,
+                        # YiYi notes: divide it by 1000 for now because we scale it by 1000 in the transforme rmodel (we should not keep it but I want to keep the inputs same for the model for testing)
+                        timestep=timesteps / 1000,
+                        guidance=guidance,
+                        pooled_projections=pooled_prompt_embeds,
+                        encoder_hidden_states=prompt_embeds,
+                        txt_ids=text_ids,
+                        img_ids=latent_image_ids,
+                        return_dict=False,
+                    )[0]
                 # model_pred = FluxPipeline._unpack_latents(
                 #     model_pred,
                 #     height=int(model_input.shape[2] * vae_scale_factor / 2),
@@ -1522,7 +1847,7 @@ def main(args):
                     model_pred, torch.randn_like(model_pred), timestep_index_s, gan_timesteps
                 )
 
-                if global_step % 2 == 0:
+                if d_step:
                     discriminator_optimizer.zero_grad(set_to_none=True)
                     sum_of_parameters=sum(p.sum() for p in discriminator_params+transformer_lora_parameters)
                     zero_sum=sum_of_parameters*0.0
@@ -1539,8 +1864,9 @@ def main(args):
                         1,
                     )
                     loss+=zero_sum
-                    accelerator.backward(loss)
+                    accelerator.backward(loss * sample_weight)
                     if accelerator.sync_gradients:
+                        normalize_gradients(discriminator_params, total_batch_size / window_samples)
                         accelerator.clip_grad_norm_(
                             discriminator_params, args.max_grad_norm
                         )
@@ -1574,11 +1900,17 @@ def main(args):
                     zero_sum=sum_of_parameters*0.0
                     loss += g_loss
                     loss+=zero_sum
-                    accelerator.backward(loss)
+                    accelerator.backward(loss * sample_weight)
                     if accelerator.sync_gradients:
+                        normalize_gradients(transformer_lora_parameters, total_batch_size / window_samples)
                         accelerator.clip_grad_norm_(transformer_lora_parameters, args.max_grad_norm)
                     optimizer.step()
-                    lr_scheduler.step()
+                    if accelerator.sync_gradients:
+                        # 学习率按生成器步消费的样本数推进，固定 batch 时仍是每个生成器步调度一次
+                        scheduled_steps = scheduler_samples // total_batch_size
+                        scheduler_samples += window_samples
+                        for _ in range(scheduler_samples // total_batch_size - scheduled_steps):
+                            lr_scheduler.step()
                     optimizer.zero_grad(set_to_none = args.set_grad_to_none)
 
             # for param in transformer_lora_parameters[:5]:
@@ -1587,8 +1919,11 @@ def main(args):
             #     print(f"requires_grad: {param.requires_grad}")
 
             # Checks if the accelerator has performed an optimization step behind the scenes
+            batch_sampler.mark_consumed(step + 1)
+            samples_seen += global_bsz
             if accelerator.sync_gradients:
-                progress_bar.update(1)
+                window_samples = 0
+                progress_bar.update(samples_seen // total_batch_size - progress_bar.n)
                 global_step += 1
         
                 if accelerator.is_main_process:
@@ -1620,6 +1955,8 @@ def main(args):
                             args.output_dir, f"checkpoint-{global_step}"
                         )
                         accelerator.save_state(save_path)
+                        with open(os.path.join(save_path, "sampler_state.json"), "w") as f:
+                            json.dump({**batch_sampler.state_dict(), "samples_seen": samples_seen, "scheduler_samples": scheduler_samples}, f)
                         logger.info(f"Saved state to {save_path}")
 
                 # logs = {"loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
@@ -1634,10 +1971,17 @@ def main(args):
                         "g_loss": g_loss.detach().item(),
                         "lr": lr_scheduler.get_last_lr()[0],
                     }
+                logs["samples_seen"] = samples_seen
+                # 所有 rank / worker 登记过的读取失败次数（含历史运行），约每分钟刷新一次
+                if getattr(data_module.dataset, "bad_sample_registry", None) is not None:
+                    logs["bad_samples"] = data_module.dataset.bad_sample_registry.num_failures()
+                # 图片字节缓存的累计命中率（本进程所有 worker）
+                if getattr(data_module.dataset, "byte_cache", None) is not None:
+                    logs["image_cache_hit_rate"] = data_module.dataset.byte_cache.stats()["hit_rate"]
                 progress_bar.set_postfix(**logs)
                 accelerator.log(logs, step=global_step)
 
-                if global_step >= args.max_train_steps:
+                if samples_seen >= args.max_train_steps * total_batch_size:
                     break
 
             # if accelerator.is_main_process:
@@ -31,7 +31,7 @@ def predict_noise(unet, noisy_latents, text_embeddings, uncond_embedding, timest
 
         noise_pred = unet(model_input, timesteps, embeddings, added_cond_kwargs=condition_input).sample
         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-        noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond) 
+        noise_pred = guided_noise(noise_pred_uncond, noise_pred_text, guidance_scale)
     else:
         
         model_input = noisy_latents 
@@ -42,6 +42,62 @@ def predict_noise(unet, noisy_latents, text_embeddings, uncond_embedding, timest
     return noise_pred 
 
 
+def guided_noise(noise_pred_uncond, noise_pred_text, guidance_scale):
+    return noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+
+class TeacherQuery:
+    """A teacher forward queued on a `TeacherBatch`; `output` is set once the batch has run."""
+
+    def __init__(self, size):
+        self.size = size
+        self.output = None
+
+
+class TeacherBatch:
+    """
+    Collects the frozen teacher's queries of one training step and evaluates them in a single forward.
+
+    Inputs are concatenated along the batch dimension with per-sample timesteps and conditions, and the
+    output is split back to the queries. `max_batch_size` caps the batch of one forward (None: no cap).
+    """
+
+    def __init__(self, unet, max_batch_size=None):
+        self.unet = unet
+        self.max_batch_size = max_batch_size
+        self.inputs = []
+        self.queries = []
+
+    def add(self, sample, timesteps, encoder_hidden_states, added_cond_kwargs):
+        query = TeacherQuery(sample.shape[0])
+        timesteps = torch.as_tensor(timesteps, device=sample.device).expand(sample.shape[0])
+        self.inputs.append((sample, timesteps, encoder_hidden_states, added_cond_kwargs))
+        self.queries.append(query)
+        return query
+
+    def run(self):
+        sample = torch.cat([x[0] for x in self.inputs])
+        timesteps = torch.cat([x[1] for x in self.inputs])
+        encoder_hidden_states = torch.cat([x[2] for x in self.inputs])
+        added_cond_kwargs = {k: torch.cat([x[3][k] for x in self.inputs]) for k in self.inputs[0][3]}
+
+        chunk = self.max_batch_size or sample.shape[0]
+        outputs = [
+            self.unet(
+                sample[i:i + chunk],
+                timesteps[i:i + chunk],
+                encoder_hidden_states=encoder_hidden_states[i:i + chunk],
+                added_cond_kwargs={k: v[i:i + chunk] for k, v in added_cond_kwargs.items()},
+            ).sample
+            for i in range(0, sample.shape[0], chunk)
+        ]
+        outputs = torch.cat(outputs) if len(outputs) > 1 else outputs[0]
+        for query, output in zip(self.queries, outputs.split([query.size for query in self.queries])):
+            query.output = output
+        self.inputs = []
+        self.queries = []
+
+
 def get_x0_from_noise(sample, model_output, alphas_cumprod, timestep):
     alpha_prod_t = alphas_cumprod[timestep].reshape(-1, 1, 1, 1)
     beta_prod_t = 1 - alpha_prod_t
@@ -108,28 +164,62 @@ class SDGuidance(nn.Module):
 
 
 
+    @torch.no_grad()
+    def sample_noisy_latents(self, latents):
+        timesteps = torch.randint(
+            self.min_step, 
+            min(self.max_step+1, self.num_train_timesteps),
+            [latents.shape[0]], 
+            device=latents.device,
+            dtype=torch.long
+        )
+
+        noise = torch.randn_like(latents)
+
+        noisy_latents = self.scheduler.add_noise(latents, noise, timesteps)
+        return noisy_latents, timesteps
+
+    def queue_real_noise(
+        self,
+        teacher_batch,
+        noisy_latents,
+        timesteps,
+        text_embedding,
+        uncond_embedding,
+        unet_added_conditions,
+        uncond_unet_added_conditions
+    ):
+        # 与 predict_noise(self.real_unet, ...) 相同的查询，与本步其它 teacher 查询排入同一个 TeacherBatch；调用方负责精度 (fp32 输入，不开 autocast)
+        queries = []
+        if self.real_guidance_scale > 1:
+            queries.append(teacher_batch.add(noisy_latents, timesteps, uncond_embedding, uncond_unet_added_conditions))
+        queries.append(teacher_batch.add(noisy_latents, timesteps, text_embedding, unet_added_conditions))
+        return queries
+
+    def real_noise(self, queries):
+        if len(queries) == 1:
+            return queries[0].output
+        return guided_noise(queries[0].output, queries[1].output, self.real_guidance_scale)
+
     def compute_distribution_matching_loss(
         self, 
         latents,
         text_embedding,
         uncond_embedding,
         unet_added_conditions,
-        uncond_unet_added_conditions
+        uncond_unet_added_conditions,
+        noisy_latents=None,
+        timesteps=None,
+        pred_real_noise=None,
     ):
+        """
+        `noisy_latents` / `timesteps` from `sample_noisy_latents` and `pred_real_noise` from `real_noise` may be
+        passed when the real branch was evaluated together with other teacher calls.
+        """
         original_latents = latents 
-        batch_size = latents.shape[0]
         with torch.no_grad():
-            timesteps = torch.randint(
-                self.min_step, 
-                min(self.max_step+1, self.num_train_timesteps),
-                [batch_size], 
-                device=latents.device,
-                dtype=torch.long
-            )
-
-            noise = torch.randn_like(latents)
-
-            noisy_latents = self.scheduler.add_noise(latents, noise, timesteps)
+            if noisy_latents is None:
+                noisy_latents, timesteps = self.sample_noisy_latents(latents)
 
             # run at full precision as autocast and no_grad doesn't work well together 
             pred_fake_noise = predict_noise(
@@ -143,7 +233,8 @@ class SDGuidance(nn.Module):
                 noisy_latents.double(), pred_fake_noise.double(), self.alphas_cumprod.double(), timesteps
             )
 
-            if self.use_fp16:
+            # pred_real_noise 已随本步其它 teacher 调用一起算好时不再单独前向
+            if pred_real_noise is None and self.use_fp16:
                 if self.sdxl:
                     bf16_unet_added_conditions = {} 
                     bf16_uncond_unet_added_conditions = {} 
@@ -163,7 +254,7 @@ class SDGuidance(nn.Module):
                     unet_added_conditions=bf16_unet_added_conditions,
                     uncond_unet_added_conditions=bf16_uncond_unet_added_conditions
                 ) 
-            else:
+            elif pred_real_noise is None:
                 pred_real_noise = predict_noise(
                     self.real_unet, noisy_latents, text_embedding, uncond_embedding, 
                     timesteps, guidance_scale=self.real_guidance_scale,
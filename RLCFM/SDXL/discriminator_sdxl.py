@@ -1,3 +1,5 @@
+import argparse
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -346,6 +348,13 @@ def modified_forward(
     return output_features
 
 
+def _repeat_batch(x):
+    # fake / real 拼成一个 batch 时，共用的条件沿 batch 维重复一份 (标量 timestep 保持不变)
+    if torch.is_tensor(x) and x.ndim > 0:
+        return torch.cat([x, x])
+    return x
+
+
 class DiscriminatorHead(nn.Module):
     def __init__(self, input_channel, output_channel=1):
         super().__init__()
@@ -385,9 +394,12 @@ class Discriminator(nn.Module):
             # 320
             # do not use up blocks to save memory
         ],
+        single_pass=False,
     ):
         super().__init__()
         self.unet = unet
+        # d_loss 中 fake 和 real 拼成一个 batch，只过一次 backbone
+        self.single_pass = single_pass
         self.num_h_per_head = num_h_per_head
         self.head_num = len(adapter_channel_dims)
         self.heads = nn.ModuleList(
@@ -435,12 +447,21 @@ class Discriminator(nn.Module):
         weight,
     ):
         loss = 0.0
-        fake_outputs = self._forward(
-            sample_fake.detach(), timestep, encoder_hidden_states, added_cond_kwargs
-        )
-        real_outputs = self._forward(
-            sample_real.detach(), timestep, encoder_hidden_states, added_cond_kwargs
-        )
+        if self.single_pass:
+            outputs = self._forward(
+                torch.cat([sample_fake.detach(), sample_real.detach()]),
+                _repeat_batch(timestep),
+                _repeat_batch(encoder_hidden_states),
+                {k: _repeat_batch(v) for k, v in added_cond_kwargs.items()},
+            )
+            fake_outputs, real_outputs = zip(*(output.split(sample_fake.shape[0]) for output in outputs))
+        else:
+            fake_outputs = self._forward(
+                sample_fake.detach(), timestep, encoder_hidden_states, added_cond_kwargs
+            )
+            real_outputs = self._forward(
+                sample_real.detach(), timestep, encoder_hidden_states, added_cond_kwargs
+            )
         for fake_output, real_output in zip(fake_outputs, real_outputs):
             loss += (
                 torch.mean(weight * torch.relu(fake_output.float() + 1))
@@ -515,7 +536,53 @@ class Discriminator(nn.Module):
         return loss
 
 
+def check_single_pass(seed=0, atol=1e-5):
+    # 在一个很小的 SDXL 结构 UNet 上比较两次前向与单次前向的 d_loss 及判别头梯度
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=16,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4),
+        use_linear_projection=True,
+        addition_embed_type="text_time",
+        addition_time_embed_dim=8,
+        transformer_layers_per_block=(1, 2),
+        projection_class_embeddings_input_dim=80,
+        cross_attention_dim=64,
+    )
+    unet.requires_grad_(False)
+    discriminator = Discriminator(unet, adapter_channel_dims=[32, 64, 64])
+    sample_fake, sample_real = torch.randn(2, 3, 4, 16, 16)
+    timestep = torch.randint(0, 1000, (3,))
+    encoder_hidden_states = torch.randn(3, 7, 64)
+    added_cond_kwargs = {"text_embeds": torch.randn(3, 32), "time_ids": torch.randn(3, 6)}
+
+    results = []
+    for single_pass in (False, True):
+        discriminator.single_pass = single_pass
+        discriminator.zero_grad(set_to_none=True)
+        loss = discriminator("d_loss", sample_fake, sample_real, timestep, encoder_hidden_states, added_cond_kwargs, 1)
+        loss.backward()
+        results.append((loss.detach(), [p.grad.clone() for p in discriminator.heads.parameters()]))
+    (loss_two, grads_two), (loss_one, grads_one) = results
+    grad_error = max((a - b).abs().max().item() for a, b in zip(grads_two, grads_one))
+    print(f"d_loss two passes {loss_two.item():.6f}, single pass {loss_one.item():.6f}, max head grad difference {grad_error:.2e}")
+    assert torch.allclose(loss_two, loss_one, atol=atol) and grad_error <= atol
+    return loss_two, loss_one
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check_single_pass", action="store_true", help="Check that the single-pass d_loss matches two passes on a tiny U-Net.")
+    if parser.parse_args().check_single_pass:
+        check_single_pass()
+        raise SystemExit
+
     teacher_unet = UNet2DConditionModel.from_pretrained(
         "stable-diffusion-xl-base-1.0",
         subfolder="unet",
@@ -0,0 +1,161 @@
+# Exponential moving average of the student weights into the target network.
+#
+# `update_ema` is the reference per-tensor loop: two kernel launches (mul_, add_)
+# per parameter, i.e. a few thousand launches per step for a full SDXL UNet.
+# `MultiTensorEMA` groups the (target, source) pairs by device and dtype once and
+# updates each group with the multi-tensor `torch._foreach_*` kernels, which
+# process many tensors per launch. Only pairs whose source parameter trains are
+# kept; frozen parameters never change, so their EMA stays equal to them.
+#
+# Updating every N steps with the decay compensated to rate ** N keeps the same
+# effective horizon (the target follows the same geometric weighting of steps,
+# sampled every N steps) at 1/N of the cost.
+
+import argparse
+import time
+from collections import defaultdict
+
+import torch
+
+
+@torch.no_grad()
+def update_ema(target_params, source_params, rate=0.99):
+    """
+    Update target parameters to be closer to those of source parameters using
+    an exponential moving average.
+
+    :param target_params: the target parameter sequence.
+    :param source_params: the source parameter sequence.
+    :param rate: the EMA rate (closer to 1 means slower).
+    """
+    for targ, src in zip(target_params, source_params):
+        targ.detach().mul_(rate).add_(src, alpha=1 - rate)
+
+
+class MultiTensorEMA:
+    """
+    EMA of `source_params` into `target_params` with `torch._foreach_*` kernels.
+
+    :param target_params: the target parameter sequence.
+    :param source_params: the source parameter sequence; pairs whose source does not require grad are skipped.
+    :param update_every: update every this many calls to `step`, with the decay raised to this power.
+    """
+
+    def __init__(self, target_params, source_params, update_every=1):
+        groups = defaultdict(lambda: ([], []))
+        for targ, src in zip(target_params, source_params):
+            if not src.requires_grad:
+                continue
+            if targ.shape != src.shape:
+                raise ValueError(f"EMA target of shape {tuple(targ.shape)} does not match source {tuple(src.shape)}")
+            # _foreach_add_ 要求同一组内 target / source 的 device 与 dtype 一致
+            targets, sources = groups[(targ.device, targ.dtype, src.dtype)]
+            targets.append(targ)
+            sources.append(src)
+        self.groups = list(groups.values())
+        self.update_every = update_every
+        self.num_tensors = sum(len(targets) for targets, _ in self.groups)
+
+    @torch.no_grad()
+    def update(self, rate):
+        """Applies one EMA update with decay `rate` to every group."""
+        for targets, sources in self.groups:
+            if targets[0].dtype != sources[0].dtype:
+                sources = [src.to(targets[0].dtype) for src in sources]
+            torch._foreach_mul_(targets, rate)
+            torch._foreach_add_(targets, sources, alpha=1 - rate)
+
+    def step(self, rate, global_step):
+        """
+        Called after every optimizer step; `global_step` counts completed steps. Updates on every
+        `update_every`-th step with the compensated decay `rate ** update_every`. Returns whether it updated.
+        """
+        if global_step % self.update_every != 0:
+            return False
+        self.update(rate ** self.update_every)
+        return True
+
+
+def benchmark_ema(num_tensors=1680, numel=1 << 16, steps=50, rate=0.95, device=None):
+    # 用与 SDXL UNet 参数个数相当的一组张量比较逐张量循环与 _foreach 的耗时，并检查结果一致
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    generator = torch.Generator().manual_seed(0)
+    sources = [torch.randn(numel, generator=generator).to(device).requires_grad_() for _ in range(num_tensors)]
+    targets_loop = [src.detach().clone() for src in sources]
+    targets_foreach = [src.detach().clone() for src in sources]
+    ema = MultiTensorEMA(targets_foreach, sources)
+
+    def timed(fn):
+        fn()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(steps):
+            fn()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / steps
+
+    with torch.no_grad():
+        for src in sources:
+            src.add_(torch.randn(numel, generator=generator).to(device))
+    loop_time = timed(lambda: update_ema(targets_loop, sources, rate))
+    foreach_time = timed(lambda: ema.update(rate))
+    error = max((a - b).abs().max().item() for a, b in zip(targets_loop, targets_foreach))
+    print(
+        f"{num_tensors} tensors x {numel} on {device}: per-tensor loop {loop_time * 1e3:.2f} ms, "
+        f"foreach {foreach_time * 1e3:.2f} ms ({loop_time / foreach_time:.1f}x), max difference {error:.2e}"
+    )
+    return loop_time, foreach_time
+
+
+def check_ema(update_every=4, rate=0.9, seed=0):
+    # 源参数不变时，MultiTensorEMA.step 在第 update_every 步以 rate ** update_every 更新一次，应与逐张量的
+    # update_ema 执行 update_every 次一致。覆盖不训练的参数 (跳过，target 本就等于 source) 与各种 (target, source) dtype 分组
+    generator = torch.Generator().manual_seed(seed)
+    specs = [
+        # (target dtype, source dtype, source requires grad)
+        (torch.float32, torch.float32, True),
+        (torch.float32, torch.bfloat16, True),
+        (torch.float16, torch.float16, True),
+        (torch.bfloat16, torch.bfloat16, True),
+        (torch.float32, torch.float32, False),
+        (torch.float16, torch.float16, False),
+    ] * 2
+    targets, sources = [], []
+    for i, (target_dtype, source_dtype, trainable) in enumerate(specs):
+        shape = (3 + i, 5)
+        source = torch.randn(shape, generator=generator)
+        target = source if not trainable else source + torch.randn(shape, generator=generator)
+        sources.append(source.to(source_dtype).requires_grad_(trainable))
+        targets.append(target.to(target_dtype))
+    reference = [targ.clone() for targ in targets]
+
+    ema = MultiTensorEMA(targets, sources, update_every)
+    assert ema.num_tensors == sum(trainable for _, _, trainable in specs)
+    updated = [ema.step(rate, global_step) for global_step in range(1, update_every + 1)]
+    assert updated == [False] * (update_every - 1) + [True], updated
+    for _ in range(update_every):
+        update_ema(reference, sources, rate)
+
+    for targ, ref, (target_dtype, source_dtype, trainable) in zip(targets, reference, specs):
+        # 两边各自在 target dtype 下舍入 update_every 次
+        atol = 4 * update_every * torch.finfo(target_dtype).eps * ref.abs().max().item()
+        error = (targ.double() - ref.double()).abs().max().item()
+        assert error <= atol, f"{target_dtype} target / {source_dtype} source (trainable={trainable}): {error:.2e} > {atol:.2e}"
+    print(f"MultiTensorEMA.step matches {update_every} x update_ema for {len(specs)} tensors ({ema.num_tensors} trained)")
+
+
+if __name__ == "__main__":
+    # python ema.py --benchmark_ema：比较逐张量 EMA 循环与 _foreach 版本的耗时
+    # python ema.py --check_ema：检查每 N 步一次的补偿更新与逐张量更新 N 次一致
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark_ema", action="store_true", help="Time the per-tensor EMA loop against the multi-tensor update.")
+    parser.add_argument("--check_ema", action="store_true", help="Check that an every-N-steps update matches N per-tensor updates.")
+    parser.add_argument("--num_tensors", type=int, default=1680)
+    parser.add_argument("--numel", type=int, default=1 << 16)
+    args = parser.parse_args()
+    if args.check_ema:
+        check_ema()
+    if args.benchmark_ema:
+        benchmark_ema(args.num_tensors, args.numel)
@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 
 import argparse, traceback
+import contextlib
 import copy, time, pdb
 import functools
 import gc, cv2
@@ -24,6 +25,7 @@ import math
 import os, traceback
 import random
 import shutil
+import sys
 from pathlib import Path
 from typing import List, Union
 from collections import defaultdict
@@ -41,7 +43,8 @@ from accelerate.logging import get_logger
 from accelerate.utils import ProjectConfiguration, set_seed
 from huggingface_hub import create_repo
 from packaging import version
-from peft import LoraConfig, get_peft_model, get_peft_model_state_dict
+from peft import LoraConfig, get_peft_model, get_peft_model_state_dict, set_peft_model_state_dict
+from peft.utils import load_peft_weights
 from torch.utils.data import default_collate
 from torchvision import transforms
 from tqdm.auto import tqdm
@@ -56,6 +59,7 @@ from diffusers import (
 )
 from scheduling_ddpm_modified import DDPMScheduler
 from diffusers.optimization import get_scheduler
+from diffusers.training_utils import cast_training_params
 from diffusers.utils import check_min_version, is_wandb_available
 from diffusers.utils.import_utils import is_xformers_available
 from torch.utils.data import DataLoader, Dataset
@@ -65,7 +69,13 @@ import pytorch_lightning as pl
 from itertools import chain, repeat
 from get_phased_weight import process_and_plot_data
 from itertools import permutations
-from DMD_loss import predict_noise, get_x0_from_noise, SDGuidance
+from DMD_loss import predict_noise, get_x0_from_noise, SDGuidance, TeacherBatch
+# 数据集与各类缓存模块由 SDXL / FLUX 训练脚本共用，放在 RLCFM/common 下
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from dataset_myself import ComicDataModule, prepare_pixel_values
+from latent_cache import latent_dist_sample
+from embedding_cache import EmbeddingCache
+from ema import MultiTensorEMA
 
 MAX_SEQ_LENGTH = 77
 
@@ -129,356 +139,6 @@ def get_rank(lst):
 check_min_version("0.18.0.dev0")
 
 logger = get_logger(__name__)
-def _repeat_to_at_least(iterable, n):
-    repeat_times = math.ceil(n / len(iterable))
-    repeated = chain.from_iterable(repeat(iterable, repeat_times))
-    return list(repeated)
-
-
-class ComicDatasetBucket(Dataset):
-    def __init__(self, file_path, prompt_embeds=None, pooled_prompt_embeds=None, max_size=(1024,1024), divisible=64, stride=16, min_dim=512, base_res=(1024,1024), max_ar_error=4, dim_limit=2048):
-
-        self.base_res = base_res
-        self.prompt_embeds = prompt_embeds
-        self.pooled_prompt_embeds = pooled_prompt_embeds
-        max_tokens = (max_size[0]/stride) * (max_size[1]/stride)
-        self.get_resolution(file_path)  # 从 JSON 文件读取数据
-        self.gen_buckets(min_dim, max_tokens, dim_limit, stride, divisible)
-        self.assign_buckets(max_ar_error)
-        self.gen_index_map()
-
-    def get_resolution(self, file_path):
-        # 如果缓存文件存在，直接加载
-        file_arr_path = file_path.replace('.json', '.npy')
-        file_arr_path_caption = file_path.replace('.json', '_caption.npy')
-        if os.path.exists(file_arr_path) and os.path.exists(file_arr_path_caption):
-            self.res_map = np.load(file_arr_path, allow_pickle=True).item()
-            self.text_map = np.load(file_arr_path_caption, allow_pickle=True).item()
-            return
-
-        # 初始化存储字典
-        self.res_map = {}
-        self.text_map = {}
-
-        # 从 JSON 文件读取数据
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-
-        print(f'总数据量为{len(data)}')
-
-
-    # 判断 JSON 数据的类型
-        if isinstance(data, dict):  # 字典形式
-            for each_file_path, info in tqdm(data.items()):
-                original_size = info["original_image_size"]  # [宽, 高]
-                caption = info["caption"]  # 图片标签
-
-                # 存储图像尺寸和标签
-                self.res_map[each_file_path] = tuple(original_size)  # (宽, 高)
-                self.text_map[each_file_path] = caption
-        elif isinstance(data, list):  # 列表形式
-            for item in tqdm(data):  # 直接遍历列表
-                image_path = item["image_path"]  # 图片路径
-                original_size = item["size"]  # [宽, 高]
-                if 'caption' in item and item['caption'] != None:
-                    caption = item["caption"]  # 图片标签
-                elif 'wd_tag' in item and item['wd_tag'] != None:
-                    caption = item["wd_tag"]
-                else:
-                    caption = ''
-
-                
-                # 存储图像尺寸和标签
-                self.res_map[image_path] = tuple(original_size)  # (宽, 高)
-                self.text_map[image_path] = caption
-        else:
-            raise ValueError("Unsupported JSON format. Expected a dictionary or a list.")
-
-
-
-        # 保存缓存文件
-        np.save(file_path.replace('.json', '.npy'), np.array(self.res_map))
-        np.save(file_path.replace('.json', '_caption.npy'), np.array(self.text_map))
-
-    def gen_buckets(self, min_dim, max_tokens, dim_limit, stride=8, div=64):
-        resolutions = []
-        aspects = []
-        w = min_dim
-        while (w/stride) * (min_dim/stride) <= max_tokens and w <= dim_limit:
-            h = min_dim
-            got_base = False
-            while (w/stride) * ((h+div)/stride) <= max_tokens and (h+div) <= dim_limit:
-                if w == self.base_res[0] and h == self.base_res[1]:
-                    got_base = True
-                h += div
-            if (w != self.base_res[0] or h != self.base_res[1]) and got_base:
-                resolutions.append(self.base_res)
-                aspects.append(1)
-            resolutions.append((w, h))
-            aspects.append(float(w)/float(h))
-            w += div
-        h = min_dim
-        while (h/stride) * (min_dim/stride) <= max_tokens and h <= dim_limit:
-            w = min_dim
-            got_base = False
-            while (h/stride) * ((w+div)/stride) <= max_tokens and (w+div) <= dim_limit:
-                if w == self.base_res[0] and h == self.base_res[1]:
-                    got_base = True
-                w += div
-            resolutions.append((w, h))
-            aspects.append(float(w)/float(h))
-            h += div
-
-        res_map = {}
-        for i, res in enumerate(resolutions):
-            res_map[res] = aspects[i]
-
-        self.resolutions = sorted(res_map.keys(), key=lambda x: x[0] * 4096 - x[1])
-        self.aspects = np.array(list(map(lambda x: res_map[x], self.resolutions)))
-        self.resolutions = np.array(self.resolutions)
-
-    def assign_buckets(self, max_ar_error=4):
-        self.buckets = {}
-        self.aspect_errors = []
-        self.res_map_new = {}
-
-        skipped = 0
-        skip_list = []
-        for post_id in self.res_map.keys():
-            w, h = self.res_map[post_id]
-            aspect = float(w)/float(h)
-            bucket_id = np.abs(self.aspects - aspect).argmin()
-            if bucket_id not in self.buckets:
-                self.buckets[bucket_id] = []
-            error = abs(self.aspects[bucket_id] - aspect)
-            if error < max_ar_error:
-                self.buckets[bucket_id].append(post_id)
-                self.res_map_new[post_id] = tuple(self.resolutions[bucket_id])
-            else:
-                skipped += 1
-                skip_list.append(post_id)
-        for post_id in skip_list:
-            del self.res_map[post_id]
-
-    def gen_index_map(self):
-        self.id2path = {}
-        self.id2shape = {}
-        id = 0
-        for path, shape in self.res_map_new.items():
-            self.id2path[id] = path
-            self.id2shape[id] = shape
-            id += 1
-
-    def __len__(self):
-        return len(self.res_map)
-
-
-    def __getitem__(self, idx):
-        while True:
-            try:
-                target_path = self.id2path[idx]
-                W, H = self.res_map_new[target_path]
-                text = self.text_map[target_path]
-                target_path = target_path.strip()
-
-                # 加载图像
-                target = cv2.imread(target_path)
-                if target is None:
-                    raise ValueError(f"Unable to read image at path: {target_path}")
-                
-                ori_H, ori_W, _ = target.shape
-
-                target = cv2.cvtColor(target, cv2.COLOR_BGR2RGB)
-                target = cv2.resize(target, (W, H))
-                target = target.transpose((2,0,1))
-
-                # 归一化到 [-1, 1]
-                target = (target.astype(np.float32) / 127.5) - 1.0
-
-                return dict(pixel_values=target, original_sizes=(ori_W, ori_H), crop_top_lefts=(0, 0), target_sizes=(W, H), caption=text)
-            
-            except Exception as e:
-                traceback.print_exc()
-                print(f"Skipping sample {idx} due to error: {e}, path: {target_path}")
-                
-                # 从当前桶中重新选择一个样本
-                bucket_id = self.get_bucket_id(idx)
-                if bucket_id is not None:
-                    new_idx = random.choice(self.buckets[bucket_id])
-                    idx = new_idx
-                else:
-                    idx = random.randint(0, len(self.id2path) - 1)  # 如果没有找到桶，随机选择一个样本
-        
-
-
-    def get_bucket_id(self, idx):
-        target_path = self.id2path[idx]
-        W, H = self.res_map_new[target_path]
-        aspect = float(W) / float(H)
-        bucket_id = np.abs(self.aspects - aspect).argmin()
-        return bucket_id if bucket_id in self.buckets else None
-
-    # def __getitem__(self, idx):
-    #     while True:
-    #         try:
-    #             target_path = self.id2path[idx]
-    #             W, H = self.res_map_new[target_path]
-    #             text = self.text_map[target_path]
-    #             target_path = target_path.strip()
-
-    #             # 加载图像
-    #             target = cv2.imread(target_path)
-    #             if target is None:
-    #                 raise ValueError(f"Unable to read image at path: {target_path}")
-                
-    #             ori_H, ori_W, _ = target.shape
-
-    #             target = cv2.cvtColor(target, cv2.COLOR_BGR2RGB)
-    #             target = cv2.resize(target, (W, H))
-    #             target = target.transpose((2,0,1))
-
-    #             # 归一化到 [-1, 1]
-    #             target = (target.astype(np.float32) / 127.5) - 1.0
-
-    #             return dict(pixel_values=target, original_sizes=(ori_W, ori_H), crop_top_lefts=(0, 0), target_sizes=(W, H), caption=text)
-            
-    #         except Exception as e:
-    #             traceback.print_exc()
-    #             print(f"Skipping sample {idx} due to error: {e}, path: {target_path}")
-    #             idx = random.randint(0, len(self.id2path) - 1)  # 随机选择一个样本
-
-
-
-
-    # def __getitem__(self, idx):
-    #     target_path = self.id2path[idx]
-    #     W, H = self.res_map_new[target_path]
-    #     text = self.text_map[target_path]
-    #     target_path = target_path.strip()
-
-    #     # 加载图像
-    #     try:
-    #         target = cv2.imread(target_path)
-    #         ori_H, ori_W, _ = target.shape
-    #     except Exception as e:
-    #         traceback.print_exc()
-    #         print(f"Skipping sample {idx} due to error: {e},path:{target_path}")
-    #         return None  # 返回 None 表示该样本有问题
-
-    #     target = cv2.cvtColor(target, cv2.COLOR_BGR2RGB)
-    #     target = cv2.resize(target, (W, H))
-    #     target = target.transpose((2,0,1))
-
-    #     # 归一化到 [-1, 1]
-    #     target = (target.astype(np.float32) / 127.5) - 1.0
-
-    #     return dict(pixel_values=target, original_sizes=(ori_W, ori_H), crop_top_lefts=(0, 0), target_sizes=(W, H), caption=text)
-
-
-
-class GroupedBatchSampler(BatchSampler):
-    # def __init__(self, sampler, batch_size, drop_last=True):
-    def __init__(self, sampler, dataset, batch_size, drop_last=True):
-        if not isinstance(sampler, Sampler):
-            raise ValueError(f"sampler should be an instance of torch.utils.data.Sampler, but got sampler={sampler}")
-        self.sampler = sampler
-        # self.group_ids = self.sampler.dataset.id2shape
-        self.group_ids = dataset.id2shape
-        self.batch_size = batch_size
-        self.drop_last = drop_last
-
-    def __iter__(self):
-        buffer_per_group = defaultdict(list)
-        samples_per_group = defaultdict(list)
-
-        num_batches = 0
-        for idx in self.sampler:
-            group_id = self.group_ids[idx]
-            buffer_per_group[group_id].append(idx)
-            samples_per_group[group_id].append(idx)
-            if len(buffer_per_group[group_id]) == self.batch_size:
-                yield buffer_per_group[group_id]
-                num_batches += 1
-                del buffer_per_group[group_id]
-            assert len(buffer_per_group[group_id]) < self.batch_size
-
-        expected_num_batches = len(self)
-        num_remaining = expected_num_batches - num_batches
-        if num_remaining > 0:
-            for group_id, _ in sorted(buffer_per_group.items(), key=lambda x: len(x[1]), reverse=True):
-                remaining = self.batch_size - len(buffer_per_group[group_id])
-                samples_from_group_id = _repeat_to_at_least(samples_per_group[group_id], remaining)
-                buffer_per_group[group_id].extend(samples_from_group_id[:remaining])
-                assert len(buffer_per_group[group_id]) == self.batch_size
-                yield buffer_per_group[group_id]
-                num_remaining -= 1
-                if num_remaining == 0:
-                    break
-        assert num_remaining == 0
-
-    def __len__(self):
-        return len(self.sampler) // self.batch_size
-    
-# using LightningDataModule
-class ComicDataModule(pl.LightningDataModule):
-    def __init__(self, batch_size, file_txt, prompt_embeds=None, pooled_prompt_embeds=None):
-        super().__init__()
-        self.save_hyperparameters()
-        self.batch_size = batch_size
-        # self.dataset = dataset
-        self.file_txt = file_txt
-        self.prompt_embeds = prompt_embeds
-        self.pooled_prompt_embeds = pooled_prompt_embeds
-    
-    def setup(self, stage):
-        self.dataset = ComicDatasetBucket(file_path=self.file_txt, prompt_embeds=self.prompt_embeds, pooled_prompt_embeds=self.pooled_prompt_embeds)
-        self.sampler = SequentialSampler(self.dataset)
-
-    def __len__(self):
-        return len(self.dataset.res_map)
-
-
-    def train_dataloader(self):
-        def collate_fn(examples):
-            examples = [sample for sample in examples if sample is not None]
-            pixel_values = torch.stack([torch.tensor(example["pixel_values"]) for example in examples])
-            pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
-            original_sizes = [example["original_sizes"] for example in examples]
-            crop_top_lefts = [example["crop_top_lefts"] for example in examples]
-            target_sizes = [example["target_sizes"] for example in examples]
-            caption = [example["caption"] for example in examples]
-            # prompt_embeds = torch.stack([torch.tensor(example["prompt_embeds"]) for example in examples])
-            # pooled_prompt_embeds = torch.stack([torch.tensor(example["pooled_prompt_embeds"]) for example in examples])
-
-            return {
-                "pixel_values": pixel_values,
-                # "prompt_embeds": prompt_embeds,
-                # "pooled_prompt_embeds": pooled_prompt_embeds,
-                "original_sizes": original_sizes,
-                "crop_top_lefts": crop_top_lefts,
-                "target_sizes": target_sizes,
-                "caption": caption
-            }
-        # return DataLoader(self.dataset, batch_sampler=GroupedBatchSampler(sampler=self.sampler, batch_size=self.batch_size), num_workers=32, collate_fn=collate_fn)
-        return DataLoader(self.dataset, batch_sampler=GroupedBatchSampler(sampler=self.sampler, dataset=self.dataset, batch_size=self.batch_size), num_workers=0, collate_fn=collate_fn, pin_memory=True, persistent_workers=False)
-
-
-
-
-
-@torch.no_grad()
-def update_ema(target_params, source_params, rate=0.99):
-    """
-    Update target parameters to be closer to those of source parameters using
-    an exponential moving average.
-
-    :param target_params: the target parameter sequence.
-    :param source_params: the source parameter sequence.
-    :param rate: the EMA rate (closer to 1 means slower).
-    """
-    for targ, src in zip(target_params, source_params):
-        targ.detach().mul_(rate).add_(src, alpha=1 - rate)
-
 
 
 def get_module_kohya_state_dict(
@@ -504,6 +164,100 @@ def get_module_kohya_state_dict(
     return kohya_ss_state_dict
 
 
+@contextlib.contextmanager
+def no_grad_forward(model):
+    """
+    Forward of a model whose output is not backpropagated, e.g. the student on discriminator steps where the
+    fake sample is detached: no autograd graph is built and gradient checkpointing is switched off, so the
+    checkpointed blocks skip their bookkeeping as well.
+    """
+    model = model.get_base_model() if hasattr(model, "get_base_model") else model
+    checkpointing = model.is_gradient_checkpointing
+    if checkpointing:
+        model.disable_gradient_checkpointing()
+    try:
+        with torch.no_grad():
+            yield
+    finally:
+        if checkpointing:
+            model.enable_gradient_checkpointing()
+
+
+@torch.no_grad()
+def normalize_gradients(parameters, scale):
+    """Multiplies the accumulated gradients by `scale` before clipping and the optimizer step."""
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if grads and scale != 1:
+        torch._foreach_mul_(grads, scale)
+
+
+class AdapterDisabledUNet:
+    """
+    The LoRA student's UNet with its adapters disabled, i.e. the frozen base model. Used as teacher and as
+    discriminator backbone so that only one UNet is resident. Not an `nn.Module`, so modules holding it
+    (Discriminator, SDGuidance) do not register the backbone as their own parameters.
+    """
+
+    def __init__(self, unet):
+        self.unet = unet
+
+    def __getattr__(self, name):
+        return getattr(self.unet, name)
+
+    @contextlib.contextmanager
+    def adapters_disabled(self):
+        # 梯度检查点在反向时重算前向，那时 adapter 已重新打开，所以这段前向不做检查点
+        base_model = self.unet.get_base_model()
+        checkpointing = base_model.is_gradient_checkpointing
+        if checkpointing:
+            base_model.disable_gradient_checkpointing()
+        try:
+            with self.unet.disable_adapter():
+                yield
+        finally:
+            if checkpointing:
+                base_model.enable_gradient_checkpointing()
+
+    def __call__(self, *args, **kwargs):
+        with self.adapters_disabled():
+            return self.unet(*args, **kwargs)
+
+
+class EMAAdapterUNet:
+    """
+    The LoRA student's UNet with an EMA of its adapter weights swapped in; the target network. The EMA
+    tensors trade places with the adapter parameters (`.data` only, no copies) for the duration of a call.
+    """
+
+    def __init__(self, unet):
+        self.unet = unet
+        named_parameters = [(name, param) for name, param in unet.named_parameters() if param.requires_grad]
+        self.names = [name for name, _ in named_parameters]
+        self.adapter_parameters = [param for _, param in named_parameters]
+        self.ema_parameters = [param.detach().clone() for param in self.adapter_parameters]
+
+    def __getattr__(self, name):
+        return getattr(self.unet, name)
+
+    def _swap(self):
+        for param, ema in zip(self.adapter_parameters, self.ema_parameters):
+            param.data, ema.data = ema.data, param.data
+
+    def __call__(self, *args, **kwargs):
+        self._swap()
+        try:
+            return self.unet(*args, **kwargs)
+        finally:
+            self._swap()
+
+    def state_dict(self):
+        return dict(zip(self.names, self.ema_parameters))
+
+    def load_state_dict(self, state_dict):
+        for name, ema in zip(self.names, self.ema_parameters):
+            ema.copy_(state_dict[name])
+
+
 class CustomImageDataset_without_crop(Dataset):
     def __init__(self, img_dir, sample_size):
         """
@@ -994,7 +748,9 @@ def parse_args():
         help=(
             "The name of the Dataset (from the HuggingFace hub) to train on (could be your own, possibly private,"
             " dataset). It can also be a path pointing to a local copy of a dataset in your filesystem,"
-            " or to a folder containing files that 🤗 Datasets can understand."
+            " or to a folder containing files that 🤗 Datasets can understand. Tar shards in webdataset format"
+            " (e.g. `/data/shards/{00000..00999}.tar`, several patterns separated by `::`) are read sequentially"
+            " and bucketed on the fly; this needs `--max_train_samples` as the number of samples per epoch."
         ),
     )
     parser.add_argument(
@@ -1035,6 +791,100 @@ def parse_args():
             "Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process."
         ),
     )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=2,
+        help="Number of batches loaded in advance by each worker. Only used when `--dataloader_num_workers > 0`.",
+    )
+    parser.add_argument(
+        "--dataloader_persistent_workers",
+        action="store_true",
+        help="Keep the dataloader workers alive between epochs instead of re-creating them.",
+    )
+    parser.add_argument(
+        "--dataloader_sync_buckets",
+        action="store_true",
+        help=(
+            "Make all ranks draw their batch from the same resolution bucket at every step, so that step time is"
+            " uniform across GPUs instead of waiting on the rank with the largest resolution."
+        ),
+    )
+    parser.add_argument(
+        "--max_batch_pixels",
+        type=int,
+        default=None,
+        help=(
+            "If set, the batch size of every resolution bucket is max_batch_pixels // (width * height) instead of"
+            " `--train_batch_size`, e.g. train_batch_size * 1024 * 1024 keeps the number of latent tokens per step"
+            " close to the base resolution. Gradients are averaged over the samples of each accumulation window and"
+            " the step count and learning rate schedule follow the number of samples seen (see `--max_train_steps`)."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_reduced_decode",
+        action="store_true",
+        help=(
+            "Decode JPEGs at 1/2, 1/4 or 1/8 resolution (libjpeg DCT scaling) when the original image, as recorded"
+            " in the manifest, is still at least as large as its bucket after the reduction. Saves most of the"
+            " decode time for photos much larger than the buckets. Benchmark with"
+            " `python ../common/dataset_myself.py --benchmark_decode <manifest>`."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_device_resize",
+        action="store_true",
+        help=(
+            "Dataloader workers only decode; each batch is resized to its bucket resolution on the training device"
+            " with antialiased bilinear interpolation (one call per source image size). Best combined with"
+            " `--dataloader_reduced_decode`, which keeps the transferred images small. Check the difference to the"
+            " cv2 path with `python ../common/dataset_myself.py --check_device_resize <manifest>`."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_read_ahead_batches",
+        type=int,
+        default=0,
+        help=(
+            "If > 0, every dataloader worker reads the image files of its next N batches in the background"
+            " (`--dataloader_read_ahead_threads` threads per worker) and decodes them from memory, hiding the"
+            " latency of network filesystems."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_read_ahead_threads",
+        type=int,
+        default=16,
+        help="Threads per dataloader worker reading image files for `--dataloader_read_ahead_batches`.",
+    )
+    parser.add_argument(
+        "--dataloader_image_cache_gb",
+        type=float,
+        default=0,
+        help=(
+            "Keep up to this many GB of encoded image files in shared memory, shared by all dataloader workers"
+            " of a process, so later epochs of a small dataset are read from RAM. Requires the `fork` worker"
+            " start method. 0 disables the cache."
+        ),
+    )
+    parser.add_argument(
+        "--latent_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory written by `python ../common/latent_cache.py`. When set, the dataloader serves the cached VAE latent"
+            " moments and images are neither decoded nor passed through the VAE during training."
+        ),
+    )
+    parser.add_argument(
+        "--text_embedding_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory of a persistent fp16 cache of the SDXL prompt embeddings keyed by caption hash. Captions are"
+            " encoded once and reused in later epochs and runs; the text encoders are only loaded for cache misses."
+        ),
+    )
     # ----Batch Size and Training Steps----
     parser.add_argument(
         "--train_batch_size",
@@ -1047,7 +897,11 @@ def parse_args():
         "--max_train_steps",
         type=int,
         default=None,
-        help="Total number of training steps to perform.  If provided, overrides num_train_epochs.",
+        help=(
+            "Total number of training steps to perform.  If provided, overrides num_train_epochs. Steps are counted"
+            " in samples, one step being train_batch_size * num_processes * gradient_accumulation_steps samples,"
+            " so that they keep their meaning with `--max_batch_pixels`."
+        ),
     )
     parser.add_argument(
         "--max_train_samples",
@@ -1089,6 +943,15 @@ def parse_args():
         required=False,
         help="The exponential moving average (EMA) rate or decay factor.",
     )
+    parser.add_argument(
+        "--ema_update_every",
+        type=int,
+        default=1,
+        help=(
+            "Update the target network every this many optimizer steps, with the decay compensated to"
+            " `ema_decay ** ema_update_every`."
+        ),
+    )
     parser.add_argument(
         "--lr_warmup_steps",
         type=int,
@@ -1186,6 +1049,16 @@ def parse_args():
         default=64,
         help="The rank of the LoRA projection matrix.",
     )
+    parser.add_argument(
+        "--use_lora",
+        action="store_true",
+        help=(
+            "Train LoRA adapters on the student instead of the full U-Net. The teacher and the discriminator"
+            " backbone run the same U-Net with the adapters disabled, and the target network is an EMA of the"
+            " adapter weights only, so a single base U-Net stays resident and only the adapters are optimized,"
+            " all-reduced and checkpointed."
+        ),
+    )
     # ----Mixed Precision----
     parser.add_argument(
         "--mixed_precision",
@@ -1211,6 +1084,16 @@ def parse_args():
         action="store_true",
         help="Whether to cast the teacher U-Net to the precision specified by `--mixed_precision`.",
     )
+    parser.add_argument(
+        "--teacher_max_batch_size",
+        type=int,
+        default=None,
+        help=(
+            "All teacher calls of a step (the CFG cond / uncond calls and, with `--dmd_loss`, the uncond / cond calls"
+            " of the real branch of the DMD loss) run as one batched forward in full precision. Set this to split"
+            " it into forwards of at most this many samples if the combined batch does not fit into memory."
+        ),
+    )
     # ----Training Optimizations----
     parser.add_argument(
         "--enable_xformers_memory_efficient_attention",
@@ -1276,6 +1159,11 @@ def parse_args():
     parser.add_argument("--multiphase", default=4, type=int)
     parser.add_argument("--adv_weight", default=0.1, type=float)
     parser.add_argument("--adv_lr", default=1e-5, type=float)
+    parser.add_argument(
+        "--discriminator_single_pass",
+        action="store_true",
+        help="Run fake and real samples through the discriminator backbone as one batch in the discriminator loss.",
+    )
 
 
 
@@ -1304,11 +1192,7 @@ def parse_args():
 
 
 # Adapted from pipelines.StableDiffusionXLPipeline.encode_prompt
-def encode_prompt(
-    prompt_batch, text_encoders, tokenizers, proportion_empty_prompts, is_train=True
-):
-    prompt_embeds_list = []
-
+def select_captions(prompt_batch, proportion_empty_prompts, is_train=True):
     captions = []
     for caption in prompt_batch:
         if random.random() < proportion_empty_prompts:
@@ -1318,6 +1202,15 @@ def encode_prompt(
         elif isinstance(caption, (list, np.ndarray)):
             # take a random caption if there are multiple
             captions.append(random.choice(caption) if is_train else caption[0])
+    return captions
+
+
+def encode_prompt(
+    prompt_batch, text_encoders, tokenizers, proportion_empty_prompts, is_train=True
+):
+    prompt_embeds_list = []
+
+    captions = select_captions(prompt_batch, proportion_empty_prompts, is_train)
 
     with torch.no_grad():
         for tokenizer, text_encoder in zip(tokenizers, text_encoders):
@@ -1349,6 +1242,57 @@ def encode_prompt(
     return prompt_embeds, pooled_prompt_embeds
 
 
+class CachedPromptEncoder:
+    """
+    `encode_prompt` backed by a persistent fp16 `EmbeddingCache` keyed by caption hash.
+
+    Only captions missing from the cache go through the text encoders, which are created by
+    `load_text_encoders` on the first miss. The empty-prompt embedding used by `proportion_empty_prompts`
+    is computed once and reused for every replaced caption.
+    """
+
+    fields = {
+        "prompt_embeds": ((77, 2048), np.float16),
+        "pooled_prompt_embeds": ((1280,), np.float16),
+    }
+
+    def __init__(self, embedding_cache, load_text_encoders, tokenizers):
+        self.embedding_cache = embedding_cache
+        self.load_text_encoders = load_text_encoders
+        self.tokenizers = tokenizers
+        self.text_encoders = None
+        self.empty_embeds = None
+
+    def lookup(self, captions):
+        found = {}
+        for caption in set(captions):
+            if caption == "" and self.empty_embeds is not None:
+                found[caption] = self.empty_embeds
+            else:
+                found[caption] = self.embedding_cache.get(caption)
+
+        misses = sorted(caption for caption, embeds in found.items() if embeds is None)
+        if misses:
+            if self.text_encoders is None:
+                self.text_encoders = self.load_text_encoders()
+            prompt_embeds, pooled_prompt_embeds = encode_prompt(misses, self.text_encoders, self.tokenizers, 0.0)
+            prompt_embeds = prompt_embeds.to(torch.float16).cpu().numpy()
+            pooled_prompt_embeds = pooled_prompt_embeds.to(torch.float16).cpu().numpy()
+            for caption, prompt_embed, pooled_prompt_embed in zip(misses, prompt_embeds, pooled_prompt_embeds):
+                found[caption] = {"prompt_embeds": prompt_embed, "pooled_prompt_embeds": pooled_prompt_embed}
+                self.embedding_cache.put(caption, **found[caption])
+        if "" in found:
+            self.empty_embeds = found[""]
+        return found
+
+    def __call__(self, prompt_batch, proportion_empty_prompts, is_train=True):
+        captions = select_captions(prompt_batch, proportion_empty_prompts, is_train)
+        found = self.lookup(captions)
+        prompt_embeds = torch.from_numpy(np.stack([found[caption]["prompt_embeds"] for caption in captions]))
+        pooled_prompt_embeds = torch.from_numpy(np.stack([found[caption]["pooled_prompt_embeds"] for caption in captions]))
+        return prompt_embeds, pooled_prompt_embeds
+
+
 def main(args):
     existing_data = []
     # phased_weight_list = [1/4, 1/4, 1/4, 1/4]
@@ -1453,18 +1397,23 @@ def main(args):
         args.pretrained_teacher_model, args.teacher_revision, subfolder="text_encoder_2"
     )
 
-    text_encoder_one = text_encoder_cls_one.from_pretrained(
-        args.pretrained_teacher_model,
-        subfolder="text_encoder",
-        revision=args.teacher_revision,
-    )
-    text_encoder_two = text_encoder_cls_two.from_pretrained(
-        args.pretrained_teacher_model,
-        subfolder="text_encoder_2",
-        revision=args.teacher_revision,
-    )
+    def load_text_encoders():
+        text_encoder_one = text_encoder_cls_one.from_pretrained(
+            args.pretrained_teacher_model,
+            subfolder="text_encoder",
+            revision=args.teacher_revision,
+        )
+        text_encoder_two = text_encoder_cls_two.from_pretrained(
+            args.pretrained_teacher_model,
+            subfolder="text_encoder_2",
+            revision=args.teacher_revision,
+        )
+        return text_encoder_one, text_encoder_two
 
-    print("##text_encoder loaded")
+    # 使用 text embedding 缓存时，text encoder 只在缓存未命中时才加载
+    if args.text_embedding_cache_dir is None:
+        text_encoder_one, text_encoder_two = load_text_encoders()
+        print("##text_encoder loaded")
 
     # 4. Load VAE from SD-XL checkpoint (or more stable VAE)
     vae_path = (
@@ -1485,49 +1434,15 @@ def main(args):
     )
 
     print("##teacher_unet loaded")
-    discriminator = Discriminator(teacher_unet)
-
-    discriminator.unet.requires_grad_(False)
     teacher_unet.requires_grad_(False)
-    discriminator_params = []
-    for param in discriminator.heads.parameters():
-        param.requires_grad = True
-        discriminator_params.append(param)
 
     # 6. Freeze teacher vae, text_encoders, and teacher_unet
     vae.requires_grad_(False)
-    text_encoder_one.requires_grad_(False)
-    text_encoder_two.requires_grad_(False)
-
-    # 8. Create online (`unet`) student U-Nets. This will be updated by the optimizer (e.g. via backpropagation.)
-
-    unet = UNet2DConditionModel(**teacher_unet.config)
-    # load teacher_unet weights into unet
-    unet.load_state_dict(teacher_unet.state_dict(), strict=False)
-    unet.train()
-
-    # 9. Create target (`ema_unet`) student U-Net parameters. This will be updated via EMA updates (polyak averaging).
-    # Initialize from unet
-    target_unet = UNet2DConditionModel(**teacher_unet.config)
-    target_unet.load_state_dict(unet.state_dict())
-    target_unet.train()
-    target_unet.requires_grad_(False)
-
-
-
+    if args.text_embedding_cache_dir is None:
+        text_encoder_one.requires_grad_(False)
+        text_encoder_two.requires_grad_(False)
 
-    # Check that all trainable models are in full precision
-    low_precision_error_string = (
-        " Please make sure to always have all model weights in full float32 precision when starting training - even if"
-        " doing mixed precision training, copy of the weights should still be float32."
-    )
-
-    if accelerator.unwrap_model(unet).dtype != torch.float32:
-        raise ValueError(
-            f"Controlnet loaded as datatype {accelerator.unwrap_model(unet).dtype}. {low_precision_error_string}"
-        )
-
-    # 8. Add LoRA to the student U-Net, only the LoRA projection matrix will be updated by the optimizer.
+    # 7. LoRA config of the student U-Net (`--use_lora`), only the LoRA projection matrix will be updated by the optimizer.
     lora_config = LoraConfig(
         r=args.lora_rank,
         target_modules=[
@@ -1548,6 +1463,46 @@ def main(args):
         ],
     )
 
+    if args.use_lora:
+        # 8. The student is the teacher U-Net plus LoRA adapters; teacher and discriminator backbone run it with
+        # the adapters disabled, the target network (created after device placement) with EMA adapter weights.
+        unet = get_peft_model(teacher_unet, lora_config)
+        unet.train()
+        teacher_unet = AdapterDisabledUNet(unet)
+        target_unet = None
+    else:
+        # 8. Create online (`unet`) student U-Nets. This will be updated by the optimizer (e.g. via backpropagation.)
+        unet = UNet2DConditionModel(**teacher_unet.config)
+        # load teacher_unet weights into unet
+        unet.load_state_dict(teacher_unet.state_dict(), strict=False)
+        unet.train()
+
+        # 9. Create target (`ema_unet`) student U-Net parameters. This will be updated via EMA updates (polyak averaging).
+        # Initialize from unet
+        target_unet = UNet2DConditionModel(**teacher_unet.config)
+        target_unet.load_state_dict(unet.state_dict())
+        target_unet.train()
+        target_unet.requires_grad_(False)
+
+    discriminator = Discriminator(teacher_unet, single_pass=args.discriminator_single_pass)
+    discriminator_params = []
+    for param in discriminator.heads.parameters():
+        param.requires_grad = True
+        discriminator_params.append(param)
+    # LoRA 模式下判别器骨干在关闭 adapter 的上下文中运行
+    discriminator_backbone = teacher_unet.adapters_disabled if args.use_lora else contextlib.nullcontext
+
+    # Check that all trainable models are in full precision
+    low_precision_error_string = (
+        " Please make sure to always have all model weights in full float32 precision when starting training - even if"
+        " doing mixed precision training, copy of the weights should still be float32."
+    )
+
+    if accelerator.unwrap_model(unet).dtype != torch.float32:
+        raise ValueError(
+            f"Controlnet loaded as datatype {accelerator.unwrap_model(unet).dtype}. {low_precision_error_string}"
+        )
+
     # 9. Handle mixed precision and device placement
     # For mixed precision training we cast all non-trainable weigths to half-precision
     # as these weights are only used for inference, keeping weights in full precision is not required.
@@ -1562,9 +1517,18 @@ def main(args):
     vae.to(accelerator.device)
     if args.pretrained_vae_model_name_or_path is not None:
         vae.to(dtype=weight_dtype)
-    text_encoder_one.to(accelerator.device, dtype=weight_dtype)
-    text_encoder_two.to(accelerator.device, dtype=weight_dtype)
-    target_unet.to(accelerator.device)
+    if args.text_embedding_cache_dir is None:
+        text_encoder_one.to(accelerator.device, dtype=weight_dtype)
+        text_encoder_two.to(accelerator.device, dtype=weight_dtype)
+    if args.use_lora:
+        # 冻结的底模按 weight_dtype 存放，只有 LoRA 参数保持 fp32
+        unet.to(accelerator.device, dtype=weight_dtype)
+        cast_training_params(unet, dtype=torch.float32)
+        target_unet = EMAAdapterUNet(unet)
+        target_ema = MultiTensorEMA(target_unet.ema_parameters, target_unet.adapter_parameters, args.ema_update_every)
+    else:
+        target_unet.to(accelerator.device)
+        target_ema = MultiTensorEMA(target_unet.parameters(), unet.parameters(), args.ema_update_every)
 
     # Also move the alpha and sigma noise schedules to accelerator.device.
     alpha_schedule = alpha_schedule.to(accelerator.device)
@@ -1577,7 +1541,10 @@ def main(args):
         # create custom saving & loading hooks so that `accelerator.save_state(...)` serializes in a nice format
         def save_model_hook(models, weights, output_dir):
             if accelerator.is_main_process:
-                target_unet.save_pretrained(os.path.join(output_dir, "unet_target"))
+                if args.use_lora:
+                    torch.save(target_unet.state_dict(), os.path.join(output_dir, "unet_target_lora.pth"))
+                else:
+                    target_unet.save_pretrained(os.path.join(output_dir, "unet_target"))
 
                 for i, model in enumerate(models):
 
@@ -1593,10 +1560,13 @@ def main(args):
 
 
         def load_model_hook(models, input_dir):
-            load_model = UNet2DConditionModel.from_pretrained(os.path.join(input_dir, "unet_target"))
-            target_unet.load_state_dict(load_model.state_dict())
-            target_unet.to(accelerator.device)
-            del load_model
+            if args.use_lora:
+                target_unet.load_state_dict(torch.load(os.path.join(input_dir, "unet_target_lora.pth"), map_location="cpu"))
+            else:
+                load_model = UNet2DConditionModel.from_pretrained(os.path.join(input_dir, "unet_target"))
+                target_unet.load_state_dict(load_model.state_dict())
+                target_unet.to(accelerator.device)
+                del load_model
 
 
             for i in range(len(models)):
@@ -1608,6 +1578,10 @@ def main(args):
                     
                     accelerator.unwrap_model(discriminator).heads.load_state_dict(torch.load(os.path.join(input_dir,"heads.pth")))
                     continue
+                if args.use_lora:
+                    # save_pretrained 只保存了 adapter 权重
+                    set_peft_model_state_dict(accelerator.unwrap_model(model), load_peft_weights(os.path.join(input_dir, "unet")))
+                    continue
                 # load diffusers style into model
                 load_model = UNet2DConditionModel.from_pretrained(input_dir, subfolder="unet")
                 model.register_to_config(**load_model.config)
@@ -1660,7 +1634,7 @@ def main(args):
 
     # 12. Optimizer creation
     optimizer = optimizer_class(
-        unet.parameters(),
+        [param for param in unet.parameters() if param.requires_grad],
         lr=args.learning_rate,
         betas=(args.adam_beta1, args.adam_beta2),
         weight_decay=args.adam_weight_decay,
@@ -1696,9 +1670,16 @@ def main(args):
         original_sizes = torch.tensor(original_sizes, dtype=torch.long)
         crops_coords_top_left = torch.tensor(crops_coords_top_left, dtype=torch.long)
 
-        prompt_embeds, pooled_prompt_embeds = encode_prompt(
-            prompt_batch, text_encoders, tokenizers, proportion_empty_prompts, is_train
-        )
+        if prompt_encoder is not None:
+            prompt_embeds, pooled_prompt_embeds = prompt_encoder(
+                prompt_batch, proportion_empty_prompts, is_train
+            )
+            prompt_embeds = prompt_embeds.to(dtype=weight_dtype)
+            pooled_prompt_embeds = pooled_prompt_embeds.to(dtype=weight_dtype)
+        else:
+            prompt_embeds, pooled_prompt_embeds = encode_prompt(
+                prompt_batch, text_encoders, tokenizers, proportion_empty_prompts, is_train
+            )
         add_text_embeds = pooled_prompt_embeds
 
         # Adapted from pipeline.StableDiffusionXLPipeline._get_add_time_ids
@@ -1720,9 +1701,28 @@ def main(args):
         return {"prompt_embeds": prompt_embeds, **unet_added_cond_kwargs}
 
     print("##load dataset")
-    data_module = ComicDataModule(batch_size=args.train_batch_size, file_txt=args.train_shards_path_or_url)
+    data_module = ComicDataModule(
+        batch_size=args.train_batch_size,
+        file_txt=args.train_shards_path_or_url,
+        num_workers=args.dataloader_num_workers,
+        prefetch_factor=args.dataloader_prefetch_factor,
+        persistent_workers=args.dataloader_persistent_workers,
+        seed=args.seed if args.seed is not None else 0,
+        num_replicas=accelerator.num_processes,
+        rank=accelerator.process_index,
+        sync_buckets=args.dataloader_sync_buckets,
+        max_batch_pixels=args.max_batch_pixels,
+        latent_cache_dir=args.latent_cache_dir,
+        reduced_decode=args.dataloader_reduced_decode,
+        device_resize=args.dataloader_device_resize,
+        num_samples=args.max_train_samples,
+        read_ahead_batches=args.dataloader_read_ahead_batches,
+        read_ahead_threads=args.dataloader_read_ahead_threads,
+        image_cache_bytes=int(args.dataloader_image_cache_gb * 2**30),
+    )
     data_module.setup(stage="fit")
     train_dataloader = data_module.train_dataloader()
+    batch_sampler = data_module.batch_sampler
     # if args.not_use_crop:
     #     train_dataset = CustomImageDataset_without_crop(args.train_shards_path_or_url, args.resolution)
     #     print('not_use_crop\n'*5)
@@ -1739,8 +1739,27 @@ def main(args):
 
     # Let's first compute all the embeddings so that we can free up the text encoders
     # from memory.
-    text_encoders = [text_encoder_one, text_encoder_two]
     tokenizers = [tokenizer_one, tokenizer_two]
+    if args.text_embedding_cache_dir is None:
+        text_encoders = [text_encoder_one, text_encoder_two]
+        prompt_encoder = None
+    else:
+        text_encoders = None
+
+        def load_cache_miss_text_encoders():
+            logger.info("Loading text encoders for text embedding cache misses")
+            text_encoders = load_text_encoders()
+            for text_encoder in text_encoders:
+                text_encoder.requires_grad_(False)
+                text_encoder.to(accelerator.device, dtype=weight_dtype)
+            return list(text_encoders)
+
+        embedding_cache = EmbeddingCache(
+            args.text_embedding_cache_dir,
+            CachedPromptEncoder.fields,
+            signature={"model": args.pretrained_teacher_model, "revision": args.teacher_revision},
+        )
+        prompt_encoder = CachedPromptEncoder(embedding_cache, load_cache_miss_text_encoders, tokenizers)
 
     compute_embeddings_fn = functools.partial(
         compute_embeddings,
@@ -1751,9 +1770,16 @@ def main(args):
 
     # 14. LR Scheduler creation
     # Scheduler and math around the number of training steps.
+    # 训练进度按样本数计：一个优化步对应 total_batch_size 个样本。动态 batch (`--max_batch_pixels`) 时
+    # 每步实际样本数不同，总步数、epoch 数和学习率调度都按已消费的样本数换算
+    total_batch_size = (
+        args.train_batch_size
+        * accelerator.num_processes
+        * args.gradient_accumulation_steps
+    )
     overrode_max_train_steps = False
     num_update_steps_per_epoch = math.ceil(
-        len(train_dataloader) / args.gradient_accumulation_steps
+        batch_sampler.epoch_samples() * accelerator.num_processes / total_batch_size
     )
     if args.max_train_steps is None:
         args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
@@ -1790,15 +1816,14 @@ def main(args):
         optimizer,
         discriminator_optimizer,
         lr_scheduler,
-        train_dataloader,
     ) = accelerator.prepare(
         unet,
         discriminator,
         optimizer,
         discriminator_optimizer,
         lr_scheduler,
-        train_dataloader,
     )
+    # train_dataloader 由 DistributedBucketBatchSampler 按 rank 分片，不再交给 accelerator 切分
     print("##prepared")
 
     sdguidance = SDGuidance(args,real_unet=teacher_unet,fake_unet=unet,num_train_timesteps=noise_scheduler.config.num_train_timesteps)
@@ -1806,7 +1831,7 @@ def main(args):
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(
-        len(train_dataloader) / args.gradient_accumulation_steps
+        batch_sampler.epoch_samples() * accelerator.num_processes / total_batch_size
     )
     if overrode_max_train_steps:
         args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
@@ -1820,24 +1845,20 @@ def main(args):
         accelerator.init_trackers(args.tracker_project_name, config=tracker_config)
 
     # Create uncond embeds for classifier free guidance
-    uncond_prompt_embeds = torch.zeros(args.train_batch_size, 77, 2048).to(
+    uncond_prompt_embeds = torch.zeros(batch_sampler.max_batch_size, 77, 2048).to(
         accelerator.device
     )
-    uncond_pooled_prompt_embeds = torch.zeros(args.train_batch_size, 1280).to(
+    uncond_pooled_prompt_embeds = torch.zeros(batch_sampler.max_batch_size, 1280).to(
         accelerator.device
     )
 
     # 16. Train!
-    total_batch_size = (
-        args.train_batch_size
-        * accelerator.num_processes
-        * args.gradient_accumulation_steps
-    )
-
     logger.info("***** Running training *****")
     logger.info(f"  Num batches each epoch = {len(train_dataloader)}")
     logger.info(f"  Num Epochs = {args.num_train_epochs}")
     logger.info(f"  Instantaneous batch size per device = {args.train_batch_size}")
+    if args.max_batch_pixels is not None:
+        logger.info(f"  Max pixels per batch = {args.max_batch_pixels} (batch size per bucket up to {batch_sampler.max_batch_size})")
     logger.info(
         f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}"
     )
@@ -1845,6 +1866,12 @@ def main(args):
     logger.info(f"  Total optimization steps = {args.max_train_steps}")
     global_step = 0
     first_epoch = 0
+    # 动态 batch 时每步样本数不同，按样本数而不是 batch 数统计训练进度
+    samples_seen = 0
+    # 生成器步消费的样本数，学习率每 total_batch_size 个样本调度一步
+    scheduler_samples = 0
+    # 当前梯度累积窗口内所有 rank 的样本数
+    window_samples = 0
 
     # Potentially load in the weights and states from a previous save
     if args.resume_from_checkpoint:
@@ -1866,23 +1893,39 @@ def main(args):
         else:
             accelerator.print(f"Resuming from checkpoint {path}")
             accelerator.load_state(os.path.join(args.output_dir, path))
+            sampler_state_path = os.path.join(args.output_dir, path, "sampler_state.json")
+            if os.path.exists(sampler_state_path):
+                with open(sampler_state_path) as f:
+                    sampler_state = json.load(f)
+                samples_seen = sampler_state.pop("samples_seen", 0)
+                scheduler_samples = sampler_state.pop("scheduler_samples", 0)
+                batch_sampler.load_state_dict(sampler_state)
             global_step = int(path.split("-")[1])
 
             initial_global_step = global_step
-            first_epoch = global_step // num_update_steps_per_epoch
+            if os.path.exists(sampler_state_path):
+                # 动态 batch 时 epoch 无法由步数推算，用 sampler 保存的 epoch
+                first_epoch = batch_sampler.epoch
+            else:
+                # 没有 sampler 状态的旧 checkpoint 按固定 batch 估算已消费的样本数
+                first_epoch = global_step // num_update_steps_per_epoch
+                samples_seen = global_step * total_batch_size
             RL_start_epoch =  initial_global_step + 10
     else:
         initial_global_step = 0
 
     progress_bar = tqdm(
         range(0, args.max_train_steps),
-        initial=initial_global_step,
+        # 进度条按样本数换算的步数显示，与 max_train_steps 一致
+        initial=samples_seen // total_batch_size,
         desc="Steps",
         # Only show the progress bar once on each machine.
         disable=not accelerator.is_local_main_process,
     )
 
     for epoch in range(first_epoch, args.num_train_epochs):
+        # 恢复训练时 sampler 已载入同一 epoch 的 position，set_epoch 不会重置
+        batch_sampler.set_epoch(epoch)
         for step, batch in enumerate(train_dataloader):
             if step >= len(train_dataloader) - 1:
                 break
@@ -1899,36 +1942,51 @@ def main(args):
                 # image = image.to(accelerator.device, non_blocking=True)
                 # encoded_text = compute_embeddings_fn(text, orig_size, crop_coords)
 
-                image, text, orig_size, crop_coords, target_sizes  = batch['pixel_values'], batch['caption'], batch['original_sizes'], batch['crop_top_lefts'], batch['target_sizes']     
-                image = image.to(accelerator.device, non_blocking=True)
+                text, orig_size, crop_coords, target_sizes  = batch['caption'], batch['original_sizes'], batch['crop_top_lefts'], batch['target_sizes']     
                 orig_size = [torch.tensor(list(items)) for items in zip(*orig_size)]
                 crop_coords = [torch.tensor(list(items)) for items in zip(*crop_coords)]
                 encoded_text = compute_embeddings_fn(text, orig_size, crop_coords,target_sizes)
 
 
-                if args.pretrained_vae_model_name_or_path is not None:
-                    pixel_values = image.to(dtype=weight_dtype)
-                    if vae.dtype != weight_dtype:
-                        vae.to(dtype=weight_dtype)
+                if args.latent_cache_dir is not None:
+                    # 从缓存的 latent 分布均值 / 对数方差直接采样，跳过解码和 VAE 编码
+                    latents = latent_dist_sample(
+                        batch["latent_mean"].to(accelerator.device, non_blocking=True),
+                        batch["latent_logvar"].to(accelerator.device, non_blocking=True),
+                    )
                 else:
-                    pixel_values = image
-
-                # encode pixel values with batch size of at most 8
-                with torch.no_grad():
-                    latents = []
-                    for i in range(0, pixel_values.shape[0], 8):
-                        latents.append(
-                            vae.encode(pixel_values[i : i + 8]).latent_dist.sample()
-                        )
-                    latents = torch.cat(latents, dim=0)
+                    image = prepare_pixel_values(batch, accelerator.device)
+                    if args.pretrained_vae_model_name_or_path is not None:
+                        pixel_values = image.to(dtype=weight_dtype)
+                        if vae.dtype != weight_dtype:
+                            vae.to(dtype=weight_dtype)
+                    else:
+                        pixel_values = image
+
+                    # encode pixel values with batch size of at most 8
+                    with torch.no_grad():
+                        latents = []
+                        for i in range(0, pixel_values.shape[0], 8):
+                            latents.append(
+                                vae.encode(pixel_values[i : i + 8]).latent_dist.sample()
+                            )
+                        latents = torch.cat(latents, dim=0)
 
                 latents = latents * vae.config.scaling_factor
-                if args.pretrained_vae_model_name_or_path is None:
+                if args.pretrained_vae_model_name_or_path is None or args.latent_cache_dir is not None:
                     latents = latents.to(weight_dtype)
 
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(latents)
                 bsz = latents.shape[0]
+                # 各桶 batch 大小不同时，loss 按样本数加权累积，参数更新前再把梯度乘以
+                # total_batch_size / window_samples (累积窗口内所有 rank 的实际样本数)，
+                # 使每个样本的贡献相同且权重平均为 1；固定 batch 时两者都是 1
+                sample_weight = bsz / args.train_batch_size
+                global_bsz = int(accelerator.reduce(torch.tensor(bsz, device=accelerator.device), "sum"))
+                window_samples += global_bsz
+                step_uncond_prompt_embeds = uncond_prompt_embeds[:bsz]
+                step_uncond_pooled_prompt_embeds = uncond_pooled_prompt_embeds[:bsz]
 
                 # Sample a random timestep for each image t_n ~ U[0, N - k - 1] without bias.
                 topk = (
@@ -1999,15 +2057,20 @@ def main(args):
                 # 20.4.8. Prepare prompt embeds and unet_added_conditions
                 prompt_embeds = encoded_text.pop("prompt_embeds")
 
+                # 偶数步只更新判别器，d_loss 会 detach fake 样本，学生前向不需要计算图
+                d_step = global_step % 2 == 0
+                student_forward = no_grad_forward(accelerator.unwrap_model(unet)) if d_step else contextlib.nullcontext()
+
                 # 20.4.9. Get online LCM prediction on z_{t_{n + k}}, w, c, t_{n + k}
                 try:
-                    noise_pred = unet(
-                        noisy_model_input,
-                        start_timesteps,
-                        timestep_cond=None,
-                        encoder_hidden_states=prompt_embeds.float(),
-                        added_cond_kwargs=encoded_text,
-                    ).sample
+                    with student_forward:
+                        noise_pred = unet(
+                            noisy_model_input,
+                            start_timesteps,
+                            timestep_cond=None,
+                            encoder_hidden_states=prompt_embeds.float(),
+                            added_cond_kwargs=encoded_text,
+                        ).sample
                 except:
                     import pdb; pdb.set_trace()
                 pred_x_0 = predicted_origin(
@@ -2031,17 +2094,62 @@ def main(args):
                 # noisy_latents with both the conditioning embedding c and unconditional embedding 0
                 # Get teacher model prediction on noisy_latents and conditional embedding
                 with torch.no_grad():
-                    with torch.autocast("cuda"):
-                        cond_teacher_output = teacher_unet(
-                            noisy_model_input.float(),
-                            start_timesteps,
-                            encoder_hidden_states=prompt_embeds.float(),
-                            added_cond_kwargs={
-                                k: v.float() for k, v in encoded_text.items()
-                            },
-                        ).sample
-                        cond_pred_x0 = predicted_origin(
-                            cond_teacher_output,
+                    # 本步所有 teacher 查询 (CFG 的 cond / uncond，以及生成器步中 DMD loss real 分支的 uncond / cond)
+                    # 合并为一次前向，按 DMD real 分支原来的精度运行：fp32 输入，不开 autocast。
+                    # LoRA 模式下冻结的底模按 weight_dtype 存放，只能在 autocast 下前向
+                    teacher_batch = TeacherBatch(teacher_unet, max_batch_size=args.teacher_max_batch_size)
+                    teacher_input = noisy_model_input.float()
+                    prompt_embeds_fp32 = prompt_embeds.float()
+                    uncond_prompt_embeds_fp32 = step_uncond_prompt_embeds.float()
+                    uncond_added_conditions = copy.deepcopy(encoded_text)
+                    uncond_added_conditions["text_embeds"] = (
+                        step_uncond_pooled_prompt_embeds
+                    )
+                    cond_added_kwargs = {k: v.float() for k, v in encoded_text.items()}
+                    uncond_added_kwargs = {k: v.float() for k, v in uncond_added_conditions.items()}
+
+                    cond_query = teacher_batch.add(
+                        teacher_input, start_timesteps, prompt_embeds_fp32, cond_added_kwargs
+                    )
+                    if not args.not_apply_cfg_solver:
+                        # Get teacher model prediction on noisy_latents and unconditional embedding
+                        uncond_query = teacher_batch.add(
+                            teacher_input, start_timesteps, uncond_prompt_embeds_fp32, uncond_added_kwargs
+                        )
+
+                    dmd_step = args.dmd_loss and not d_step
+                    if dmd_step:
+                        dmd_noisy_latents, dmd_timesteps = sdguidance.sample_noisy_latents(latents)
+                        dmd_queries = sdguidance.queue_real_noise(
+                            teacher_batch,
+                            dmd_noisy_latents.float(),
+                            dmd_timesteps,
+                            prompt_embeds_fp32,
+                            uncond_prompt_embeds_fp32,
+                            cond_added_kwargs,
+                            uncond_added_kwargs,
+                        )
+
+                    with torch.autocast("cuda", dtype=weight_dtype, enabled=args.use_lora and weight_dtype != torch.float32):
+                        teacher_batch.run()
+
+                    cond_teacher_output = cond_query.output
+                    cond_pred_x0 = predicted_origin(
+                        cond_teacher_output,
+                        start_timesteps,
+                        noisy_model_input,
+                        noise_scheduler.config.prediction_type,
+                        alpha_schedule,
+                        sigma_schedule,
+                    )
+
+                    if args.not_apply_cfg_solver:
+                        uncond_teacher_output = cond_teacher_output
+                        uncond_pred_x0 = cond_pred_x0
+                    else:
+                        uncond_teacher_output = uncond_query.output
+                        uncond_pred_x0 = predicted_origin(
+                            uncond_teacher_output,
                             start_timesteps,
                             noisy_model_input,
                             noise_scheduler.config.prediction_type,
@@ -2049,40 +2157,12 @@ def main(args):
                             sigma_schedule,
                         )
 
-                        if args.not_apply_cfg_solver:
-                            uncond_teacher_output = cond_teacher_output
-                            uncond_pred_x0 = cond_pred_x0
-                        else:
-                            # Get teacher model prediction on noisy_latents and unconditional embedding
-                            uncond_added_conditions = copy.deepcopy(encoded_text)
-                            uncond_added_conditions["text_embeds"] = (
-                                uncond_pooled_prompt_embeds
-                            )
-                            uncond_teacher_output = teacher_unet(
-                                noisy_model_input.float(),
-                                start_timesteps,
-                                encoder_hidden_states=uncond_prompt_embeds.float(),
-                                added_cond_kwargs={
-                                    k: v.float()
-                                    for k, v in uncond_added_conditions.items()
-                                },
-                            ).sample
-
-                            uncond_pred_x0 = predicted_origin(
-                                uncond_teacher_output,
-                                start_timesteps,
-                                noisy_model_input,
-                                noise_scheduler.config.prediction_type,
-                                alpha_schedule,
-                                sigma_schedule,
-                            )
-
-                        # 20.4.11. Perform "CFG" to get x_prev estimate (using the LCM paper's CFG formulation)
-                        pred_x0 = cond_pred_x0 + w * (cond_pred_x0 - uncond_pred_x0)
-                        pred_noise = cond_teacher_output + w * (
-                            cond_teacher_output - uncond_teacher_output
-                        )
-                        x_prev = solver.ddim_step(pred_x0, pred_noise, index)
+                    # 20.4.11. Perform "CFG" to get x_prev estimate (using the LCM paper's CFG formulation)
+                    pred_x0 = cond_pred_x0 + w * (cond_pred_x0 - uncond_pred_x0)
+                    pred_noise = cond_teacher_output + w * (
+                        cond_teacher_output - uncond_teacher_output
+                    )
+                    x_prev = solver.ddim_step(pred_x0, pred_noise, index)
 
                 # 20.4.12. Get target LCM prediction on x_prev, w, c, t_n
                 with torch.no_grad():
@@ -2127,19 +2207,21 @@ def main(args):
                     model_pred, torch.randn_like(latents), end_timesteps, gan_timesteps
                 )
 
-                if global_step % 2 == 0:
+                if d_step:
                     discriminator_optimizer.zero_grad(set_to_none=True)
-                    loss = discriminator(
-                        "d_loss",
-                        fake_gan.float(),
-                        real_gan.float(),
-                        gan_timesteps,
-                        prompt_embeds.float(),
-                        encoded_text,
-                        1,
-                    )
-                    accelerator.backward(loss)
+                    with discriminator_backbone():
+                        loss = discriminator(
+                            "d_loss",
+                            fake_gan.float(),
+                            real_gan.float(),
+                            gan_timesteps,
+                            prompt_embeds.float(),
+                            encoded_text,
+                            1,
+                        )
+                    accelerator.backward(loss * sample_weight)
                     if accelerator.sync_gradients:
+                        normalize_gradients(discriminator.parameters(), total_batch_size / window_samples)
                         accelerator.clip_grad_norm_(
                             discriminator.parameters(), args.max_grad_norm
                         )
@@ -2176,14 +2258,15 @@ def main(args):
                     except:
                         import pdb; pdb.set_trace()
 
-                    g_loss = args.adv_weight * discriminator(
-                        "g_loss",
-                        fake_gan.float(),
-                        gan_timesteps,
-                        prompt_embeds.float(),
-                        encoded_text,
-                        1,
-                    )
+                    with discriminator_backbone():
+                        g_loss = args.adv_weight * discriminator(
+                            "g_loss",
+                            fake_gan.float(),
+                            gan_timesteps,
+                            prompt_embeds.float(),
+                            encoded_text,
+                            1,
+                        )
                     
 
                 
@@ -2197,9 +2280,12 @@ def main(args):
                         dmd_loss = args.dmd_weight * sdguidance.compute_distribution_matching_loss(
                                     latents=latents,
                                     text_embedding=prompt_embeds,
-                                    uncond_embedding=uncond_prompt_embeds,
+                                    uncond_embedding=step_uncond_prompt_embeds,
                                     unet_added_conditions=encoded_text,
-                                    uncond_unet_added_conditions=uncond_added_conditions
+                                    uncond_unet_added_conditions=uncond_added_conditions,
+                                    noisy_latents=dmd_noisy_latents,
+                                    timesteps=dmd_timesteps,
+                                    pred_real_noise=sdguidance.real_noise(dmd_queries),
                                 )[0]['loss_dm']
                         loss = loss + g_loss + dmd_loss
                     
@@ -2207,20 +2293,29 @@ def main(args):
                         loss = loss + g_loss
 
                     # 20.4.14. Backpropagate on the online student model (`unet`)
-                    accelerator.backward(loss)
+                    accelerator.backward(loss * sample_weight)
                     if accelerator.sync_gradients:
+                        normalize_gradients(unet.parameters(), total_batch_size / window_samples)
                         accelerator.clip_grad_norm_(
                             unet.parameters(), args.max_grad_norm
                         )
 
                     optimizer.step()
-                    lr_scheduler.step()
+                    if accelerator.sync_gradients:
+                        # 学习率按生成器步消费的样本数推进，固定 batch 时仍是每个生成器步调度一次
+                        scheduled_steps = scheduler_samples // total_batch_size
+                        scheduler_samples += window_samples
+                        for _ in range(scheduler_samples // total_batch_size - scheduled_steps):
+                            lr_scheduler.step()
                     optimizer.zero_grad(set_to_none=True)
 
             # Checks if the accelerator has performed an optimization step behind the scenes
+            batch_sampler.mark_consumed(step + 1)
+            samples_seen += global_bsz
             if accelerator.sync_gradients:
-                update_ema(target_unet.parameters(), unet.parameters(), args.ema_decay)
-                progress_bar.update(1)
+                window_samples = 0
+                target_ema.step(args.ema_decay, global_step + 1)
+                progress_bar.update(samples_seen // total_batch_size - progress_bar.n)
                 global_step += 1
 
                 if accelerator.is_main_process:
@@ -2262,6 +2357,8 @@ def main(args):
                             accelerator.save_state(save_path)
                         except:
                             import pdb; pdb.set_trace()
+                        with open(os.path.join(save_path, "sampler_state.json"), "w") as f:
+                            json.dump({**batch_sampler.state_dict(), "samples_seen": samples_seen, "scheduler_samples": scheduler_samples}, f)
                         logger.info(f"Saved state to {save_path}")
 
                     if global_step % args.validation_steps == 0:
@@ -2294,10 +2391,17 @@ def main(args):
                             "g_loss": g_loss.detach().item(),
                             "lr": lr_scheduler.get_last_lr()[0],
                         }
+                logs["samples_seen"] = samples_seen
+                # 所有 rank / worker 登记过的读取失败次数（含历史运行），约每分钟刷新一次
+                if getattr(data_module.dataset, "bad_sample_registry", None) is not None:
+                    logs["bad_samples"] = data_module.dataset.bad_sample_registry.num_failures()
+                # 图片字节缓存的累计命中率（本进程所有 worker）
+                if getattr(data_module.dataset, "byte_cache", None) is not None:
+                    logs["image_cache_hit_rate"] = data_module.dataset.byte_cache.stats()["hit_rate"]
                 progress_bar.set_postfix(**logs)
                 accelerator.log(logs, step=global_step)
 
-                if global_step >= args.max_train_steps:
+                if samples_seen >= args.max_train_steps * total_batch_size:
                     break
 
     # Create the pipeline using using the trained modules and save it.
@@ -0,0 +1,1245 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+
+import argparse, traceback
+import copy, time
+import functools
+import gc, cv2
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import shutil
+from pathlib import Path
+from typing import List, Union
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+
+from PIL import Image
+import accelerate
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.checkpoint
+import torchvision.transforms.functional as TF
+from accelerate.logging import get_logger
+from packaging import version
+from torch.utils.data import default_collate
+from tqdm.auto import tqdm
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
+from torch.utils.data import Sampler, BatchSampler, SequentialSampler, RandomSampler
+import pytorch_lightning as pl
+from itertools import chain, repeat
+from manifest_index import BadSampleRegistry, ManifestIndex, ManifestIndexWriter, build_manifest_index, manifest_index_dir, read_image_size
+from latent_cache import LatentCache
+from image_byte_cache import SharedByteCache
+
+
+MAX_SEQ_LENGTH = 77
+
+
+logger = get_logger(__name__)
+# cv2 读取 JPEG 时可在 DCT 域直接按 1/2、1/4、1/8 解码
+_REDUCED_IMREAD_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+_JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+
+def reduced_imread_flag(original_size, target_size):
+    # 选最大的降采样倍数，使解码结果的长短边仍不小于目标桶的长短边（不依赖 EXIF 方向），之后再 resize 到桶
+    short_side, long_side = sorted(original_size)
+    target_short, target_long = sorted(target_size)
+    for factor, flag in _REDUCED_IMREAD_FLAGS:
+        if short_side // factor >= target_short and long_side // factor >= target_long:
+            return factor, flag
+    return 1, cv2.IMREAD_COLOR
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _repeat_to_at_least(iterable, n):
+    repeat_times = math.ceil(n / len(iterable))
+    repeated = chain.from_iterable(repeat(iterable, repeat_times))
+    return list(repeated)
+
+
+
+
+
+
+class ComicDatasetBucket(Dataset):
+    def __init__(self, file_path, disable_bucket=False,prompt_embeds=None, pooled_prompt_embeds=None, max_size=(1024,1024), divisible=64, stride=16, min_dim=512, base_res=(1024,1024), max_ar_error=4, dim_limit=2048, index_num_workers=8, latent_cache_dir=None, reduced_decode=False, exclude_bad_samples=True, bad_sample_rows=None, read_ahead_threads=0, image_cache_bytes=0, device_resize=False):
+        self.disable_bucket = disable_bucket
+        self.index_num_workers = index_num_workers
+        # 原图远大于目标桶时按 manifest 中的原图尺寸选择 JPEG 降采样解码倍数
+        self.reduced_decode = reduced_decode
+        # worker 只解码，缩放到桶分辨率放到训练卡上按 batch 做 (prepare_pixel_values)
+        self.device_resize = device_resize
+        # >0 时 __getitems__ 用线程池并发读取当前 batch 和后续 batch 的文件字节，见 ReadAheadBatchSampler
+        self.read_ahead_threads = read_ahead_threads
+        self._reset_read_ahead()
+        if self.disable_bucket:
+            print('禁用分桶，全部resize为1024')
+            max_ar_error=float('inf')
+            min_dim=1024
+            dim_limit=1024
+            divisible=1
+
+
+
+        self.base_res = base_res
+        self.prompt_embeds = prompt_embeds
+        self.pooled_prompt_embeds = pooled_prompt_embeds
+        max_tokens = (max_size[0]/stride) * (max_size[1]/stride)
+        self.get_resolution(file_path)  # 从 JSON 文件读取数据
+        self.gen_buckets(min_dim, max_tokens, dim_limit, stride, divisible)
+        self.assignment_key = self._assignment_key(max_ar_error)
+        if not self.load_assignment(self.assignment_key):
+            self.assign_buckets(max_ar_error)
+            self.gen_index_map()
+            self.save_assignment(self.assignment_key)
+
+        # 读取失败的样本登记在索引目录下，下次启动时从样本中剔除
+        # latent cache 按完整的分桶结果建立，使用时不剔除（不可读样本已在缓存中标记）
+        # bad_sample_rows 为主进程读取的登记快照，多卡训练时各 rank 据此剔除同一组样本
+        self.bad_sample_registry = BadSampleRegistry(os.path.join(self.manifest.index_dir, 'bad_samples'))
+        self.num_excluded_samples = 0
+        if exclude_bad_samples and latent_cache_dir is None:
+            self.exclude_rows(self.bad_sample_registry.rows() if bad_sample_rows is None else bad_sample_rows)
+        self.failed_samples = set()
+
+        # 使用离线编码好的 VAE latent 时不再解码图片
+        self.latent_cache = None
+        if latent_cache_dir is not None:
+            self.latent_cache = LatentCache(latent_cache_dir)
+            self.latent_cache.check(self)
+
+        # 小数据集多 epoch 训练时把图片文件字节缓存在共享内存中，在 fork 出 worker 之前创建
+        self.byte_cache = None
+        if image_cache_bytes > 0 and self.latent_cache is None:
+            self.byte_cache = SharedByteCache(image_cache_bytes, len(self))
+
+    def get_resolution(self, file_path):
+        # 如果索引已存在，直接以 memmap 方式加载
+        index_dir = manifest_index_dir(file_path)
+        if not ManifestIndex.exists(index_dir):
+            self.build_index(file_path, index_dir)
+        self.manifest = ManifestIndex(index_dir)
+        print(f'总数据量为{len(self.manifest)}')
+
+    def build_index(self, file_path, index_dir):
+        # 兼容旧版 pickle 缓存 (.npy)，直接转换，不再重新解析 JSON
+        legacy_res_path = file_path.replace('.json', '.npy')
+        legacy_caption_path = file_path.replace('.json', '_caption.npy')
+        if os.path.exists(legacy_res_path) and os.path.exists(legacy_caption_path):
+            res_map = np.load(legacy_res_path, allow_pickle=True).item()
+            text_map = np.load(legacy_caption_path, allow_pickle=True).item()
+            with ManifestIndexWriter(index_dir) as writer:
+                for image_path, original_size in tqdm(res_map.items()):
+                    writer.add(image_path, original_size, text_map.get(image_path, ''))
+            return
+
+        # 流式解析 JSON / JSONL，内存占用与数据量无关
+        build_manifest_index(file_path, index_dir, num_workers=self.index_num_workers)
+
+    def gen_buckets(self, min_dim, max_tokens, dim_limit, stride=8, div=64):
+        resolutions = []
+        aspects = []
+        w = min_dim
+        while (w/stride) * (min_dim/stride) <= max_tokens and w <= dim_limit:
+            h = min_dim
+            got_base = False
+            while (w/stride) * ((h+div)/stride) <= max_tokens and (h+div) <= dim_limit:
+                if w == self.base_res[0] and h == self.base_res[1]:
+                    got_base = True
+                h += div
+            if (w != self.base_res[0] or h != self.base_res[1]) and got_base:
+                resolutions.append(self.base_res)
+                aspects.append(1)
+            resolutions.append((w, h))
+            aspects.append(float(w)/float(h))
+            w += div
+        h = min_dim
+        while (h/stride) * (min_dim/stride) <= max_tokens and h <= dim_limit:
+            w = min_dim
+            got_base = False
+            while (h/stride) * ((w+div)/stride) <= max_tokens and (w+div) <= dim_limit:
+                if w == self.base_res[0] and h == self.base_res[1]:
+                    got_base = True
+                w += div
+            resolutions.append((w, h))
+            aspects.append(float(w)/float(h))
+            h += div
+
+        res_map = {}
+        for i, res in enumerate(resolutions):
+            res_map[res] = aspects[i]
+
+        self.resolutions = sorted(res_map.keys(), key=lambda x: x[0] * 4096 - x[1])
+        self.aspects = np.array(list(map(lambda x: res_map[x], self.resolutions)))
+        self.resolutions = np.array(self.resolutions)
+
+    def assign_buckets(self, max_ar_error=4, chunk_size=1 << 22):
+        # 向量化分桶：在排序后的宽高比表上 searchsorted，取左右两个候选中误差更小者
+        order = np.argsort(self.aspects, kind='stable')
+        sorted_aspects = self.aspects[order]
+        # 宽高比相同的桶取原始下标最小的一个，与 argmin 的结果保持一致
+        run_start = np.r_[0, np.flatnonzero(np.diff(sorted_aspects)) + 1]
+        first_of_run = np.repeat(run_start, np.diff(np.r_[run_start, len(sorted_aspects)]))
+
+        sizes = self.manifest.sizes
+        sample_rows = []
+        sample_buckets = []
+        for start in range(0, len(sizes), chunk_size):
+            wh = np.asarray(sizes[start:start + chunk_size], dtype=np.float64)
+            aspect = wh[:, 0] / wh[:, 1]
+
+            right = np.searchsorted(sorted_aspects, aspect, side='left')
+            left = order[first_of_run[np.maximum(right - 1, 0)]]
+            right = order[np.minimum(right, len(order) - 1)]
+            left_error = np.abs(self.aspects[left] - aspect)
+            right_error = np.abs(self.aspects[right] - aspect)
+            pick_left = (left_error < right_error) | ((left_error == right_error) & (left < right))
+            bucket_id = np.where(pick_left, left, right)
+            error = np.where(pick_left, left_error, right_error)
+
+            keep = np.flatnonzero(error < max_ar_error)
+            sample_rows.append(keep + start)
+            sample_buckets.append(bucket_id[keep])
+
+        index_dtype = np.int32 if len(sizes) < np.iinfo(np.int32).max else np.int64
+        self.sample_rows = np.concatenate(sample_rows or [np.zeros(0)]).astype(index_dtype)  # 样本 id -> manifest 行号
+        self.sample_buckets = np.concatenate(sample_buckets or [np.zeros(0)]).astype(np.int32)  # 样本 id -> 桶 id
+        self.skipped = len(sizes) - len(self.sample_rows)
+
+    def gen_index_map(self):
+        # 每个桶的样本 id 存放在一段连续数组中，self.buckets 只保存切片视图
+        self.bucket_members = np.argsort(self.sample_buckets, kind='stable').astype(self.sample_rows.dtype)
+        counts = np.bincount(self.sample_buckets, minlength=len(self.resolutions))
+        self.bucket_bounds = np.r_[0, np.cumsum(counts)]
+        self._build_bucket_views()
+
+    def _build_bucket_views(self):
+        bounds = self.bucket_bounds
+        self.buckets = {
+            bucket_id: self.bucket_members[bounds[bucket_id]:bounds[bucket_id + 1]]
+            for bucket_id in np.flatnonzero(np.diff(bounds)).tolist()
+        }
+
+    _ASSIGNMENT_ARRAYS = ('sample_rows', 'sample_buckets', 'bucket_members')
+
+    def exclude_rows(self, rows):
+        # 剔除后的分桶结果按 (分桶 key, 剔除样本) 另存一份并重新以 memmap 打开，完整分桶的缓存保持不变；
+        # 这样样本索引仍由 page cache 共享，spawn 出的 worker 也只收到文件路径
+        keep = ~np.isin(self.sample_rows, rows)
+        excluded = np.asarray(self.sample_rows[~keep], dtype=np.int64)
+        self.num_excluded_samples = len(excluded)
+        if self.num_excluded_samples == 0:
+            return
+        self.assignment_key = f'{self.assignment_key}-{hashlib.sha1(excluded.tobytes()).hexdigest()[:8]}'
+        if not self.load_assignment(self.assignment_key):
+            self.sample_rows = self.sample_rows[keep]
+            self.sample_buckets = self.sample_buckets[keep]
+            self.gen_index_map()
+            self.skipped += self.num_excluded_samples
+            self.save_assignment(self.assignment_key)
+        print(f'剔除 {self.num_excluded_samples} 个已登记的损坏样本')
+
+    def _assignment_key(self, max_ar_error):
+        key = json.dumps([self.resolutions.tolist(), self.aspects.tolist(), max_ar_error])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def _assignment_paths(self, key):
+        prefix = os.path.join(self.manifest.index_dir, f'buckets-{key}')
+        return {name: f'{prefix}-{name}.npy' for name in self._ASSIGNMENT_ARRAYS}
+
+    def load_assignment(self, key):
+        # 分桶结果与 manifest 一样以 memmap 打开，由 page cache 在各 rank / worker 间共享
+        paths = self._assignment_paths(key)
+        if not all(os.path.exists(path) for path in paths.values()):
+            return False
+        for name, path in paths.items():
+            setattr(self, name, np.load(path, mmap_mode='r'))
+        counts = np.bincount(self.sample_buckets, minlength=len(self.resolutions))
+        self.bucket_bounds = np.r_[0, np.cumsum(counts)]
+        self.skipped = len(self.manifest) - len(self.sample_rows)
+        self._build_bucket_views()
+        return True
+
+    def save_assignment(self, key):
+        if len(self.sample_rows) == 0:
+            return
+        paths = self._assignment_paths(key)
+        try:
+            for name, path in paths.items():
+                tmp_path = f'{path}.tmp-{os.getpid()}.npy'
+                np.save(tmp_path, getattr(self, name))
+                os.replace(tmp_path, path)
+        except OSError as e:
+            # 索引目录只读时保留内存中的数组
+            print(f'Unable to cache bucket assignment next to {self.manifest.index_dir}: {e}')
+            return
+        self.load_assignment(key)
+
+    def __getstate__(self):
+        # DataLoader 以 spawn 方式启动 worker 时只传递文件路径，worker 内重新 memmap
+        state = self.__dict__.copy()
+        state.pop('buckets')
+        for name in ('_read_ahead_pool', '_read_ahead_pid', '_read_ahead'):
+            state.pop(name)
+        for name in self._ASSIGNMENT_ARRAYS:
+            array = state[name]
+            if isinstance(array, np.memmap) and array.filename is not None:
+                state[name] = array.filename
+        return state
+
+    def __setstate__(self, state):
+        for name in self._ASSIGNMENT_ARRAYS:
+            if isinstance(state[name], str):
+                state[name] = np.load(state[name], mmap_mode='r')
+        self.__dict__.update(state)
+        self._build_bucket_views()
+        self._reset_read_ahead()
+
+    def _reset_read_ahead(self):
+        self._read_ahead_pool = None
+        self._read_ahead_pid = None
+        self._read_ahead = OrderedDict()  # 样本 id -> 读文件字节的 Future
+
+    def read_ahead(self, indices, hints=()):
+        # 提交当前 batch 和后续 batch 的后台读取。ReadAheadBatchSampler 每次给出本 worker 窗口内的全部后续 batch，
+        # 所以队列中不在 indices / hints 里的条目已经过期 (epoch 或 sampler 变化后预测错的)，只丢弃这些；
+        # 队列大小因此由窗口 (read_ahead_batches + 1) * batch 大小决定，当前 batch 的读取不会被挤掉
+        if self._read_ahead_pid != os.getpid():
+            # fork 出的 worker 不能沿用父进程的线程池
+            self._read_ahead_pool = ThreadPoolExecutor(self.read_ahead_threads, thread_name_prefix='read_ahead')
+            self._read_ahead_pid = os.getpid()
+            self._read_ahead.clear()
+        wanted = [int(idx) for idx in itertools.chain(indices, hints)]
+        live = set(wanted)
+        for idx in [idx for idx in self._read_ahead if idx not in live]:
+            self._read_ahead.pop(idx).cancel()
+        for idx in wanted:
+            if idx in self._read_ahead or (self.byte_cache is not None and idx in self.byte_cache):
+                continue
+            path = self.manifest.path(int(self.sample_rows[idx])).strip()
+            self._read_ahead[idx] = self._read_ahead_pool.submit(_read_file, path)
+
+    def __getitems__(self, indices):
+        # DataLoader 按 batch 取样本时调用；indices 可能带有 ReadAheadBatchSampler 给出的后续样本
+        if self.read_ahead_threads > 0 and self.latent_cache is None:
+            self.read_ahead(indices, getattr(indices, 'read_ahead', ()))
+        return [self[idx] for idx in indices]
+
+    def __len__(self):
+        return len(self.sample_rows)
+
+
+
+    def load_sample(self, idx):
+        row = int(self.sample_rows[idx])
+        W, H = (int(x) for x in self.resolutions[self.sample_buckets[idx]])
+        text = self.manifest.caption(row)
+
+        if self.latent_cache is not None:
+            latent_mean, latent_logvar = self.latent_cache.moments(idx, int(self.sample_buckets[idx]))
+            return dict(latent_mean=latent_mean, latent_logvar=latent_logvar, original_sizes=self.latent_cache.original_size(idx), crop_top_lefts=(0, 0), target_sizes=(W, H), caption=text)
+
+        target_path = self.manifest.path(row).strip()
+
+        # 加载图像
+        factor, flag = 1, cv2.IMREAD_COLOR
+        if self.reduced_decode and target_path.lower().endswith(_JPEG_EXTENSIONS):
+            factor, flag = reduced_imread_flag(self.manifest.size(row), (W, H))
+        # 只用本进程线程池提交的读取 (fork 前父进程的 Future 在子进程里不会完成)
+        prefetched = self._read_ahead.pop(int(idx), None) if self._read_ahead_pid == os.getpid() else None
+        data = self.byte_cache.get(int(idx)) if self.byte_cache is not None else None
+        if data is None:
+            if prefetched is not None:
+                # 文件字节已由后台线程读入内存 (读取失败时 result() 抛出同样的异常)
+                data = prefetched.result()
+            elif self.byte_cache is not None:
+                data = _read_file(target_path)
+            if data is not None and self.byte_cache is not None:
+                self.byte_cache.put(int(idx), data)
+        if data is not None:
+            target = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+        else:
+            target = cv2.imread(target_path, flag)
+        if target is None:
+            raise ValueError(f"Unable to read image at path: {target_path}")
+
+        ori_H, ori_W, _ = target.shape
+        if factor > 1:
+            # 降采样解码的尺寸是 ceil(原尺寸 / factor)，原图尺寸取 manifest 记录，方向与解码结果对齐
+            size_W, size_H = self.manifest.size(row)
+            ori_W, ori_H = (size_W, size_H) if (ori_W >= ori_H) == (size_W >= size_H) else (size_H, size_W)
+
+        target = cv2.cvtColor(target, cv2.COLOR_BGR2RGB)
+        if self.device_resize:
+            return dict(source_pixel_values=target.transpose((2,0,1)), original_sizes=(ori_W, ori_H), crop_top_lefts=(0, 0), target_sizes=(W, H), caption=text)
+        target = cv2.resize(target, (W, H))
+        # 保持 uint8 CHW，归一化到 [-1, 1] 放到训练卡上对整个 batch 做 (normalize_pixel_values)
+        target = target.transpose((2,0,1))
+
+        return dict(pixel_values=target, original_sizes=(ori_W, ori_H), crop_top_lefts=(0, 0), target_sizes=(W, H), caption=text)
+
+    def __getitem__(self, idx):
+        while True:
+            if idx not in self.failed_samples:
+                try:
+                    return self.load_sample(idx)
+
+                except Exception as e:
+                    row = int(self.sample_rows[idx])
+                    print(f"Skipping sample {idx} due to error: {e}, path: {self.manifest.path(row).strip()}")
+                    # 本进程内不再重试，同时登记到磁盘供其它进程和下次启动使用
+                    self.failed_samples.add(idx)
+                    self.bad_sample_registry.add(row)
+
+            # 从当前桶中重新选择一个样本
+            bucket_id = self.get_bucket_id(idx)
+            if bucket_id is not None:
+                new_idx = int(random.choice(self.buckets[bucket_id]))
+                idx = new_idx
+            else:
+                idx = random.randint(0, len(self.sample_rows) - 1)  # 如果没有找到桶，随机选择一个样本
+
+    def get_bucket_id(self, idx):
+        bucket_id = int(self.sample_buckets[idx])
+        return bucket_id if bucket_id in self.buckets else None
+
+
+
+
+    # def __getitem__(self, idx):
+    #     target_path = self.id2path[idx]
+    #     W, H = self.res_map_new[target_path]
+    #     text = self.text_map[target_path]
+    #     target_path = target_path.strip()
+
+    #     # 加载图像
+    #     try:
+    #         target = cv2.imread(target_path)
+    #         ori_H, ori_W, _ = target.shape
+    #     except Exception as e:
+    #         traceback.print_exc()
+    #         print(f"Skipping sample {idx} due to error: {e}")
+    #         return None  # 返回 None 表示该样本有问题
+
+    #     target = cv2.cvtColor(target, cv2.COLOR_BGR2RGB)
+    #     target = cv2.resize(target, (W, H))
+    #     target = target.transpose((2,0,1))
+
+    #     # 归一化到 [-1, 1]
+    #     target = (target.astype(np.float32) / 127.5) - 1.0
+
+    #     return dict(pixel_values=target, original_sizes=(ori_W, ori_H), crop_top_lefts=(0, 0), target_sizes=(W, H), caption=text)
+
+
+
+class GroupedBatchSampler(BatchSampler):
+    # def __init__(self, sampler, batch_size, drop_last=True):
+    def __init__(self, sampler, dataset, batch_size, drop_last=True):
+        if not isinstance(sampler, Sampler):
+            raise ValueError(f"sampler should be an instance of torch.utils.data.Sampler, but got sampler={sampler}")
+        self.sampler = sampler
+        # self.group_ids = self.sampler.dataset.id2shape
+        self.group_ids = dataset.sample_buckets
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        buffer_per_group = defaultdict(list)
+        samples_per_group = defaultdict(list)
+
+        num_batches = 0
+        for idx in self.sampler:
+            group_id = int(self.group_ids[idx])
+            buffer_per_group[group_id].append(idx)
+            samples_per_group[group_id].append(idx)
+            if len(buffer_per_group[group_id]) == self.batch_size:
+                yield buffer_per_group[group_id]
+                num_batches += 1
+                del buffer_per_group[group_id]
+            assert len(buffer_per_group[group_id]) < self.batch_size
+
+        expected_num_batches = len(self)
+        num_remaining = expected_num_batches - num_batches
+        if num_remaining > 0:
+            for group_id, _ in sorted(buffer_per_group.items(), key=lambda x: len(x[1]), reverse=True):
+                remaining = self.batch_size - len(buffer_per_group[group_id])
+                samples_from_group_id = _repeat_to_at_least(samples_per_group[group_id], remaining)
+                buffer_per_group[group_id].extend(samples_from_group_id[:remaining])
+                assert len(buffer_per_group[group_id]) == self.batch_size
+                yield buffer_per_group[group_id]
+                num_remaining -= 1
+                if num_remaining == 0:
+                    break
+        assert num_remaining == 0
+
+    def __len__(self):
+        return len(self.sampler) // self.batch_size
+
+    def epoch_samples(self):
+        return len(self) * self.batch_size
+
+
+def _group_batches(rng, bucket_orders, batch_sizes, num_batches):
+    # 桶内切整 batch；余数占比大的桶优先补齐 (sort 稳定，同余数按传入顺序)，补齐样本取自同桶的开头，
+    # 与 GroupedBatchSampler 一致地凑够 num_batches 个 batch，最后打乱 batch 顺序。
+    # 各桶 batch 大小可以不同，返回 (samples, offsets)，第 i 个 batch 为 samples[offsets[i]:offsets[i + 1]]
+    pieces = []
+    lengths = []
+    for members, batch_size in zip(bucket_orders, batch_sizes):
+        num_full = len(members) // batch_size
+        pieces.append(members[:num_full * batch_size])
+        lengths.append(np.full(num_full, batch_size, dtype=np.int64))
+
+    num_remaining = num_batches - sum(len(l) for l in lengths)
+    leftovers = sorted(zip(bucket_orders, batch_sizes), key=lambda x: len(x[0]) % x[1] / x[1], reverse=True)
+    for members, batch_size in leftovers[:max(num_remaining, 0)]:
+        tail = members[len(members) - len(members) % batch_size:]
+        fill = np.resize(members, batch_size - len(tail))
+        pieces.append(np.concatenate([tail, fill]))
+        lengths.append(np.array([batch_size], dtype=np.int64))
+
+    samples = np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.int64)
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    order = rng.permutation(len(lengths))
+    if len(order) != num_batches:
+        # 动态 batch 下各 rank 的分片凑不出完全相同的 batch 数，循环复用/截断以保证各 rank 步数一致
+        order = np.resize(order, num_batches)
+    lengths = lengths[order]
+    offsets = np.r_[0, np.cumsum(lengths)]
+    gather = np.repeat(starts[order] - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return samples[gather], offsets
+
+
+def _num_batches(bucket_sizes, batch_sizes, num_replicas=1):
+    # sum(n_b / bs_b) // num_replicas，用分数避免浮点误差；batch 大小相同时即 len(dataset) // batch_size
+    return int(sum(Fraction(int(n), int(bs) * num_replicas) for n, bs in zip(bucket_sizes, batch_sizes)))
+
+
+class BucketBatchSampler(BatchSampler):
+    """
+    按 (seed, epoch) 打乱的分桶 batch sampler。
+
+    每个 epoch 先在桶内做随机排列并切成整 batch，余数部分沿用 `GroupedBatchSampler` 的补齐规则
+    (余数最多的桶优先，用同桶样本循环补满，直到凑够 `len(dataset) // batch_size` 个 batch)，
+    最后把所有 batch 的顺序整体打乱，使不同分辨率的桶交错出现。
+
+    整个 epoch 的 batch 表只由 (seed, epoch) 决定，因此状态只有 (seed, epoch, position)，
+    断点恢复时直接从第 position 个 batch 开始，不需要重放迭代器。
+
+    指定 max_batch_pixels 时，每个桶的 batch 大小为 max_batch_pixels // (W * H) (至少为 1)，
+    小分辨率桶一次放更多样本，使每步的像素量 (即 latent token 数) 与基准分辨率大致相同。
+    """
+
+    def __init__(self, dataset, batch_size, drop_last=True, seed=0, max_batch_pixels=None):
+        self.sampler = SequentialSampler(dataset)
+        self.buckets = dataset.buckets
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.max_batch_pixels = max_batch_pixels
+        self.bucket_batch_sizes = {}
+        for bucket_id in self.buckets:
+            if max_batch_pixels is None:
+                self.bucket_batch_sizes[bucket_id] = batch_size
+            else:
+                W, H = dataset.resolutions[bucket_id]
+                self.bucket_batch_sizes[bucket_id] = max(1, int(max_batch_pixels) // (int(W) * int(H)))
+        self.max_batch_size = max(self.bucket_batch_sizes.values(), default=batch_size)
+        self.epoch = 0
+        # 当前 epoch 已被训练循环消费的 batch 数
+        self.position = 0
+        self._start = 0
+        self._plan = None
+        self._plan_epoch = None
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.position = 0
+
+    def mark_consumed(self, num_batches):
+        # DataLoader 的 worker 会预取 batch，sampler 自己产出的数量会超前于训练进度，
+        # 所以由训练循环告知本次迭代实际消费了多少 batch
+        self.position = self._start + num_batches
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch, "position": self.position}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+        self.position = state_dict["position"]
+
+    def bucket_orders(self, rng):
+        """返回本 epoch 每个桶 (按桶 id 顺序) 的 (桶 id, 打乱后的样本下标)。"""
+        return [(bucket_id, rng.permutation(np.asarray(self.buckets[bucket_id], dtype=np.int64))) for bucket_id in sorted(self.buckets)]
+
+    def epoch_plan(self, epoch):
+        """返回 epoch 对应的 (samples, offsets) batch 表。"""
+        if self._plan_epoch == epoch:
+            return self._plan
+        rng = np.random.default_rng([self.seed, epoch])
+        bucket_ids, orders = zip(*self.bucket_orders(rng)) if self.buckets else ((), ())
+        batch_sizes = [self.bucket_batch_sizes[bucket_id] for bucket_id in bucket_ids]
+        self._plan = _group_batches(rng, orders, batch_sizes, len(self))
+        self._plan_epoch = epoch
+        return self._plan
+
+    def __iter__(self):
+        samples, offsets = self.epoch_plan(self.epoch)
+        self._start = self.position
+        for i in range(self.position, len(offsets) - 1):
+            yield samples[offsets[i]:offsets[i + 1]].tolist()
+
+    def __len__(self):
+        return _num_batches([len(self.buckets[b]) for b in self.buckets], list(self.bucket_batch_sizes.values()))
+
+    def epoch_samples(self):
+        """本进程当前 epoch 的 batch 表中的样本数；max_batch_pixels 下各桶 batch 大小不同，不等于 len(self) * batch_size。"""
+        return int(self.epoch_plan(self.epoch)[1][-1])
+
+
+class DistributedBucketBatchSampler(BucketBatchSampler):
+    """
+    多卡版本的 `BucketBatchSampler`：先按 rank 切分样本，再在各自的分片内分桶组 batch。
+
+    所有 rank 用同一个 (seed, epoch) 打乱全量下标，循环补齐到 num_replicas 的整数倍后按 rank 间隔取，
+    各 rank 分片大小相同，每个 epoch 产出的 batch 数也相同，不会有 rank 卡在最后一次集合通信上。
+    dataloader 不需要再交给 accelerator.prepare 做 batch 切分。
+
+    sync_buckets=True 时改为各 rank 同步分桶：所有 rank 按同一 seed 生成同一张全局 batch 表，
+    每行是 num_replicas * batch_size 个同桶样本 (补齐规则同上)，rank 各取其中连续的一段。
+    同一步里所有 rank 的分辨率相同，不会因为某张卡拿到大分辨率而拖慢整步的 all-reduce。
+    """
+
+    def __init__(self, dataset, batch_size, num_replicas, rank, drop_last=True, seed=0, sync_buckets=False, max_batch_pixels=None):
+        super().__init__(dataset, batch_size, drop_last=drop_last, seed=seed, max_batch_pixels=max_batch_pixels)
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rank should be in [0, {num_replicas}), but got rank={rank}")
+        self.sample_buckets = dataset.sample_buckets
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.sync_buckets = sync_buckets
+        self.num_samples = math.ceil(len(self.sampler) / num_replicas)
+
+    def epoch_plan(self, epoch):
+        if not self.sync_buckets:
+            return super().epoch_plan(epoch)
+        if self._plan_epoch == epoch:
+            return self._plan
+        rng = np.random.default_rng([self.seed, epoch])
+        bucket_ids, orders = zip(*BucketBatchSampler.bucket_orders(self, rng)) if self.buckets else ((), ())
+        batch_sizes = [self.bucket_batch_sizes[bucket_id] * self.num_replicas for bucket_id in bucket_ids]
+        samples, offsets = _group_batches(rng, orders, batch_sizes, len(self))
+        # 每个全局 batch 均分给各 rank，取属于本 rank 的连续一段
+        local = np.diff(offsets) // self.num_replicas
+        local_offsets = np.r_[0, np.cumsum(local)]
+        gather = np.repeat(offsets[:-1] + self.rank * local - local_offsets[:-1], local) + np.arange(local_offsets[-1])
+        self._plan = (samples[gather], local_offsets)
+        self._plan_epoch = epoch
+        return self._plan
+
+    def bucket_orders(self, rng):
+        order = rng.permutation(len(self.sampler))
+        shard = np.resize(order, self.num_samples * self.num_replicas)[self.rank::self.num_replicas]
+        groups = np.asarray(self.sample_buckets[shard])
+        shard = shard[np.argsort(groups, kind="stable")]
+        counts = np.bincount(groups)
+        bounds = np.r_[0, np.cumsum(counts)]
+        return [(bucket_id, shard[bounds[bucket_id]:bounds[bucket_id + 1]]) for bucket_id in np.flatnonzero(counts)]
+
+    def __len__(self):
+        bucket_sizes = [len(self.buckets[b]) for b in self.buckets]
+        batch_sizes = list(self.bucket_batch_sizes.values())
+        if self.sync_buckets:
+            return _num_batches(bucket_sizes, batch_sizes, self.num_replicas)
+        if self.max_batch_pixels is None:
+            return self.num_samples // self.batch_size
+        return _num_batches(bucket_sizes, batch_sizes, self.num_replicas)
+
+
+def normalize_pixel_values(pixel_values):
+    # uint8 [0, 255] -> float32 [-1, 1]，与之前在 worker 里逐张做的结果一致
+    return pixel_values.float() / 127.5 - 1.0
+
+
+def resize_pixel_values(images, size, device):
+    """
+    把一组原尺寸的 uint8 CHW 图片缩放到 `size` (W, H) 并归一化到 [-1, 1]，返回 float32 [B, 3, H, W]。
+
+    尺寸相同的图片拼在一起，每种输入尺寸只调用一次带抗锯齿的双线性插值。
+    """
+    W, H = size
+    out = torch.empty((len(images), 3, H, W), dtype=torch.float32, device=device)
+    groups = defaultdict(list)
+    for i, image in enumerate(images):
+        groups[tuple(image.shape)].append(i)
+    for shape, indices in groups.items():
+        batch = torch.stack([images[i] for i in indices]).to(device, non_blocking=True)
+        batch = normalize_pixel_values(batch)
+        if shape[1:] != (H, W):
+            batch = F.interpolate(batch, size=(H, W), mode='bilinear', align_corners=False, antialias=True)
+        out[indices] = batch.clamp_(-1.0, 1.0)
+    return out
+
+
+def prepare_pixel_values(batch, device):
+    # 训练卡上的 [-1, 1] 像素：worker 已缩放好的 uint8 batch 直接归一化，device_resize 模式下在此统一缩放
+    pixel_values = batch['pixel_values']
+    if isinstance(pixel_values, torch.Tensor):
+        return normalize_pixel_values(pixel_values.to(device, non_blocking=True))
+    return resize_pixel_values(pixel_values, batch['target_sizes'][0], device)
+
+
+def collate_fn(examples):
+    examples = [sample for sample in examples if sample is not None]
+    if "latent_mean" in examples[0]:
+        # latent cache: 只传 latent 分布的均值 / 对数方差，采样在训练卡上完成
+        latent_mean = torch.from_numpy(np.stack([example["latent_mean"] for example in examples]))
+        latent_logvar = torch.from_numpy(np.stack([example["latent_logvar"] for example in examples]))
+        return {
+            "latent_mean": latent_mean,
+            "latent_logvar": latent_logvar,
+            "original_sizes": [example["original_sizes"] for example in examples],
+            "crop_top_lefts": [example["crop_top_lefts"] for example in examples],
+            "target_sizes": [example["target_sizes"] for example in examples],
+            "caption": [example["caption"] for example in examples],
+        }
+    if "source_pixel_values" in examples[0]:
+        # device_resize：各图尺寸不同，保持 list，由 prepare_pixel_values 在训练卡上缩放
+        pixel_values = [torch.from_numpy(np.ascontiguousarray(example["source_pixel_values"])) for example in examples]
+    else:
+        # uint8 batch；在 worker 中 default_collate 直接拼进共享内存，不再经过 float32 中间拷贝
+        pixel_values = default_collate([torch.from_numpy(example["pixel_values"]) for example in examples])
+    original_sizes = [example["original_sizes"] for example in examples]
+    crop_top_lefts = [example["crop_top_lefts"] for example in examples]
+    target_sizes = [example["target_sizes"] for example in examples]
+    caption = [example["caption"] for example in examples]
+    # prompt_embeds = torch.stack([torch.tensor(example["prompt_embeds"]) for example in examples])
+    # pooled_prompt_embeds = torch.stack([torch.tensor(example["pooled_prompt_embeds"]) for example in examples])
+
+    return {
+        "pixel_values": pixel_values,
+        # "prompt_embeds": prompt_embeds,
+        # "pooled_prompt_embeds": pooled_prompt_embeds,
+        "original_sizes": original_sizes,
+        "crop_top_lefts": crop_top_lefts,
+        "target_sizes": target_sizes,
+        "caption": caption
+    }
+
+
+class ReadAheadBatch(list):
+    """一个 batch 的样本 id，附带同一 worker 接下来要处理的样本 id (`read_ahead`)。"""
+
+    def __init__(self, indices, read_ahead):
+        super().__init__(indices)
+        self.read_ahead = read_ahead
+
+
+class ReadAheadBatchSampler(Sampler):
+    """
+    包装 batch sampler，让 worker 提前读取后续 batch 的文件字节。
+
+    DataLoader 按轮转把第 i 个 batch 交给 worker i % num_workers，所以向前多取 num_batches * num_workers 个
+    batch，把 i + num_workers, i + 2 * num_workers, ... 的样本 id 作为提示随第 i 个 batch 一起发给 worker，
+    由 `ComicDatasetBucket.__getitems__` 用线程池读入内存。提示只影响读取时机，batch 内容和顺序不变。
+    """
+
+    def __init__(self, batch_sampler, num_batches, num_workers):
+        self.batch_sampler = batch_sampler
+        self.num_batches = num_batches
+        self.stride = max(1, num_workers)
+
+    def __iter__(self):
+        window = deque()
+        lookahead = self.num_batches * self.stride
+        for batch in itertools.chain(self.batch_sampler, [None]):
+            if batch is not None:
+                window.append(batch)
+                if len(window) <= lookahead:
+                    continue
+            while window and (batch is None or len(window) > lookahead):
+                current = window.popleft()
+                read_ahead = [idx for i in range(self.stride - 1, len(window), self.stride) for idx in window[i]]
+                yield ReadAheadBatch(current, read_ahead)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+_TAR_IMAGE_KEYS = ('jpg', 'jpeg', 'png', 'webp')
+
+
+def is_tar_shards(file_path):
+    # 指向 tar 分片 (可含 {00000..00099} 展开、pipe: / http 地址) 时走流式读取，否则是 JSON manifest
+    return '.tar' in file_path
+
+
+class TarShardBucketDataset(IterableDataset):
+    """
+    顺序读取 webdataset 格式的 tar 分片，边读边按 `GroupedBatchSampler` 的规则分桶，直接产出单一分辨率的 batch。
+
+    每个样本是同名的图片 (jpg / jpeg / png / webp)、可选的 `.txt` caption 和可选的 `.json` 元信息
+    (size 或 original_image_size；caption / wd_tag，优先级同 JSON manifest，`.txt` 最优先)。分桶只用
+    json 中的原图尺寸或图片文件头，桶内凑满一个 batch 后才解码，所以每个桶最多缓存 batch_size - 1 个未解码样本。
+
+    所有 rank 按 (seed, epoch) 打乱分片列表后按 (rank, worker) 间隔分配，分片读完后换一个顺序循环读取，
+    每个 rank 每个 epoch 固定产出 num_samples // (batch_size * num_replicas) 个 batch。batch 流只由
+    (seed, epoch) 和 worker 数决定，所以它同时充当训练脚本里的 batch sampler：断点恢复时各 worker 跳过
+    已消费的 batch (只读 tar，不解码)。
+    """
+
+    # 桶网格与 ComicDatasetBucket 完全相同
+    gen_buckets = ComicDatasetBucket.gen_buckets
+
+    def __init__(self, urls, batch_size, num_samples, num_replicas=1, rank=0, seed=0, max_batch_pixels=None, disable_bucket=False, max_size=(1024,1024), divisible=64, stride=16, min_dim=512, base_res=(1024,1024), max_ar_error=4, dim_limit=2048, reduced_decode=False, device_resize=False):
+        if num_samples is None:
+            raise ValueError('Reading tar shards needs the number of samples per epoch (`--max_train_samples`).')
+        from braceexpand import braceexpand
+
+        self.urls = [url for pattern in urls.split('::') for url in braceexpand(pattern)]
+        if disable_bucket:
+            max_ar_error = float('inf')
+            min_dim = 1024
+            dim_limit = 1024
+            divisible = 1
+        self.base_res = base_res
+        self.gen_buckets(min_dim, (max_size[0]/stride) * (max_size[1]/stride), dim_limit, stride, divisible)
+        self.max_ar_error = max_ar_error
+        self.reduced_decode = reduced_decode
+        self.device_resize = device_resize
+
+        self.batch_size = batch_size
+        self.num_samples = num_samples
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.bucket_batch_sizes = {}
+        for bucket_id, (W, H) in enumerate(self.resolutions):
+            if max_batch_pixels is None:
+                self.bucket_batch_sizes[bucket_id] = batch_size
+            else:
+                self.bucket_batch_sizes[bucket_id] = max(1, int(max_batch_pixels) // (int(W) * int(H)))
+        self.max_batch_size = max(self.bucket_batch_sizes.values())
+        self.epoch = 0
+        self.position = 0
+        self._start = 0
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.position = 0
+        # worker 里的副本无法回传进度，本次迭代的起点在主进程记录
+        self._start = self.position
+
+    def mark_consumed(self, num_batches):
+        self.position = self._start + num_batches
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch, "position": self.position}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+        self.position = state_dict["position"]
+
+    def __len__(self):
+        return self.num_samples // (self.batch_size * self.num_replicas)
+
+    def epoch_samples(self):
+        # 各桶样本比例要读完分片才知道；max_batch_pixels 取 batch_size * 1024 * 1024 时各桶 batch 都不小于 batch_size，这里是下界
+        return len(self) * self.batch_size
+
+    def iter_shard(self, url):
+        from webdataset.handlers import warn_and_continue
+        from webdataset.tariterators import group_by_keys, tar_file_expander, url_opener
+
+        files = tar_file_expander(url_opener([dict(url=url)], handler=warn_and_continue), handler=warn_and_continue)
+        return group_by_keys(files, handler=warn_and_continue)
+
+    def read_record(self, sample):
+        # 返回 (图片字节, 原图尺寸, caption)，不解码图片
+        image_key = next((key for key in _TAR_IMAGE_KEYS if key in sample), None)
+        if image_key is None:
+            return None
+        meta = json.loads(sample['json']) if 'json' in sample else {}
+        size = meta.get('size', meta.get('original_image_size'))
+        if size is None:
+            size = read_image_size(io.BytesIO(sample[image_key]))
+        if 'txt' in sample:
+            caption = sample['txt'].decode('utf-8').strip()
+        elif meta.get('caption') is not None:
+            caption = meta['caption']
+        elif meta.get('wd_tag') is not None:
+            caption = meta['wd_tag']
+        else:
+            caption = ''
+        return sample[image_key], (int(size[0]), int(size[1])), caption
+
+    def assign_bucket(self, size):
+        aspect = size[0] / size[1]
+        errors = np.abs(self.aspects - aspect)
+        bucket_id = int(np.argmin(errors))
+        return bucket_id if errors[bucket_id] < self.max_ar_error else None
+
+    def worker_batches(self, worker_id, num_workers):
+        """本 worker 的无限 batch 流，每项为 (桶 id, 未解码的样本列表)。"""
+        slot = self.rank * num_workers + worker_id
+        num_slots = self.num_replicas * num_workers
+        if len(self.urls) < num_slots:
+            raise ValueError(f'{len(self.urls)} tar shards cannot feed {self.num_replicas} ranks x {num_workers} workers.')
+        buffers = defaultdict(list)
+        cycle = 0
+        while True:
+            num_read = 0
+            order = np.random.default_rng([self.seed, self.epoch, cycle]).permutation(len(self.urls))
+            for shard in order[slot::num_slots]:
+                for sample in self.iter_shard(self.urls[shard]):
+                    try:
+                        record = self.read_record(sample)
+                    except Exception as e:
+                        print(f"Skipping {sample.get('__key__')} in {self.urls[shard]} due to error: {e}")
+                        continue
+                    if record is None:
+                        continue
+                    num_read += 1
+                    bucket_id = self.assign_bucket(record[1])
+                    if bucket_id is None:
+                        continue
+                    buffers[bucket_id].append(record)
+                    if len(buffers[bucket_id]) == self.bucket_batch_sizes[bucket_id]:
+                        yield bucket_id, buffers.pop(bucket_id)
+            if num_read == 0:
+                raise ValueError(f'No samples found in the tar shards of rank {self.rank}, worker {worker_id}.')
+            cycle += 1
+
+    def decode(self, record, bucket_id):
+        data, (ori_W, ori_H), caption = record
+        W, H = (int(x) for x in self.resolutions[bucket_id])
+        flag = cv2.IMREAD_COLOR
+        if self.reduced_decode:
+            _, flag = reduced_imread_flag((ori_W, ori_H), (W, H))
+        target = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+        if target is None:
+            raise ValueError('Unable to decode image')
+        target = cv2.cvtColor(target, cv2.COLOR_BGR2RGB)
+        if self.device_resize:
+            return dict(source_pixel_values=target.transpose((2,0,1)), original_sizes=(ori_W, ori_H), crop_top_lefts=(0, 0), target_sizes=(W, H), caption=caption)
+        target = cv2.resize(target, (W, H))
+        target = target.transpose((2,0,1))
+        return dict(pixel_values=target, original_sizes=(ori_W, ori_H), crop_top_lefts=(0, 0), target_sizes=(W, H), caption=caption)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        # 第 i 个 batch 由 worker i % num_workers 产出 (DataLoader 轮流从各 worker 取)
+        num_skip = len(range(worker_id, min(self.position, len(self)), num_workers))
+        num_yield = len(range(worker_id, len(self), num_workers)) - num_skip
+        batches = self.worker_batches(worker_id, num_workers)
+        for _ in range(num_skip):
+            next(batches)
+        while num_yield > 0:
+            bucket_id, records = next(batches)
+            examples = []
+            for record in records:
+                try:
+                    examples.append(self.decode(record, bucket_id))
+                except Exception as e:
+                    print(f"Skipping sample due to error: {e}")
+            if not examples:
+                continue
+            # 解码失败的样本用同一 batch 内的样本补齐
+            examples = _repeat_to_at_least(examples, len(records))[:len(records)]
+            yield collate_fn(examples)
+            num_yield -= 1
+
+
+def benchmark_decode(dataset, num_samples=200, seed=0, tolerance=3.0):
+    # 对同一批样本分别用全分辨率解码和降采样解码，统计每张图的耗时，并断言每个样本与全分辨率结果的平均像素差不超过 tolerance
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(len(dataset), size=min(num_samples, len(dataset)), replace=False)
+    reduced_decode = dataset.reduced_decode
+    timings = {}
+    outputs = {}
+    try:
+        for mode in (False, True):
+            dataset.reduced_decode = mode
+            elapsed = []
+            outputs[mode] = []
+            for idx in indices:
+                start = time.perf_counter()
+                try:
+                    sample = dataset.load_sample(int(idx))
+                except Exception:
+                    outputs[mode].append(None)
+                    continue
+                elapsed.append(time.perf_counter() - start)
+                outputs[mode].append(sample['pixel_values'])
+            timings[mode] = np.asarray(elapsed)
+    finally:
+        dataset.reduced_decode = reduced_decode
+
+    diffs = [
+        np.abs(full.astype(np.float32) - reduced.astype(np.float32)).mean()
+        for full, reduced in zip(outputs[False], outputs[True])
+        if full is not None and reduced is not None
+    ]
+    full_ms, reduced_ms = timings[False].mean() * 1000, timings[True].mean() * 1000
+    print(f'decoded {len(timings[False])} samples')
+    print(f'full decode:    {full_ms:.1f} ms/sample (p50 {np.median(timings[False]) * 1000:.1f} ms)')
+    print(f'reduced decode: {reduced_ms:.1f} ms/sample (p50 {np.median(timings[True]) * 1000:.1f} ms)')
+    print(f'speedup: {full_ms / reduced_ms:.2f}x, mean abs pixel difference: {np.mean(diffs):.2f} / 255 (max over samples {np.max(diffs):.2f}, tolerance {tolerance})')
+    assert np.max(diffs) <= tolerance, f'reduced decode differs from the full decode by {np.max(diffs):.2f} / 255 on average in a sample (tolerance {tolerance})'
+    return timings
+
+
+def check_device_resize(dataset, num_samples=64, device='cpu', tolerance=3.0, seed=0):
+    # 同一批样本分别在 worker 内 cv2.resize 和在 device 上批量抗锯齿缩放，比较两者的像素差 (按 0-255 计)
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(len(dataset), size=min(num_samples, len(dataset)), replace=False)
+    device_resize = dataset.device_resize
+    samples = {}
+    try:
+        for mode in (False, True):
+            dataset.device_resize = mode
+            samples[mode] = []
+            for idx in indices:
+                try:
+                    samples[mode].append(dataset.load_sample(int(idx)))
+                except Exception:
+                    samples[mode].append(None)
+    finally:
+        dataset.device_resize = device_resize
+
+    diffs = []
+    for reference, source in zip(samples[False], samples[True]):
+        if reference is None or source is None:
+            continue
+        resized = prepare_pixel_values(collate_fn([source]), device)[0]
+        reference = normalize_pixel_values(torch.from_numpy(reference['pixel_values'])).to(device)
+        diffs.append(((resized - reference).abs() * 127.5).mean().item())
+    diffs = np.asarray(diffs)
+    print(f'compared {len(diffs)} samples on {device}')
+    print(f'mean abs pixel difference: {diffs.mean():.2f} / 255 (max over samples {diffs.max():.2f}, tolerance {tolerance})')
+    # cv2.resize 缩小时不做抗锯齿，真实图片的高频细节会使单个像素差到十几，所以这里按每个样本的平均差判定
+    assert diffs.max() <= tolerance, f'device resize differs from the cv2 path by {diffs.max():.2f} / 255 on average in a sample (tolerance {tolerance})'
+    return diffs
+
+
+def check_resize_parity(device='cpu', tolerance=2.0, seed=0):
+    # 在不含高于目标分辨率频率的合成图片上，cv2.resize 与 device 上的抗锯齿缩放应逐像素一致 (只差 uint8 舍入)；
+    # 覆盖大幅缩小、等比缩小、放大和换宽高比几种情况，断言最大像素差 (按 0-255 计) 不超过 tolerance
+    rng = np.random.default_rng(seed)
+    cases = [((3000, 4000), (1152, 896)), ((2048, 2048), (1024, 1024)), ((600, 800), (1152, 896)), ((1333, 1000), (832, 1216))]
+    max_diffs = []
+    for (h, w), size in cases:
+        y, x = np.mgrid[0:h, 0:w] / max(h, w)
+        image = np.zeros((h, w, 3))
+        for c in range(3):
+            for _ in range(6):
+                fy, fx = rng.uniform(0.5, 6, 2)
+                image[..., c] += np.sin(2 * np.pi * (fy * y + fx * x) + rng.uniform(0, 2 * np.pi))
+        image = np.round((image - image.min()) / (image.max() - image.min()) * 255).astype(np.uint8)
+        reference = normalize_pixel_values(torch.from_numpy(cv2.resize(image, size).transpose((2, 0, 1)))).to(device)
+        resized = resize_pixel_values([torch.from_numpy(np.ascontiguousarray(image.transpose((2, 0, 1))))], size, device)[0]
+        max_diff = ((resized - reference).abs().max() * 127.5).item()
+        assert max_diff <= tolerance, f'{w}x{h} -> {size[0]}x{size[1]}: max abs pixel difference {max_diff:.2f} / 255 (tolerance {tolerance})'
+        max_diffs.append(max_diff)
+    print(f'device resize matches cv2.resize on {len(cases)} synthetic images on {device}: max abs pixel difference {max(max_diffs):.2f} / 255')
+    return max_diffs
+
+
+def seed_worker(worker_id):
+    # torch 已为每个 worker 派生出不同的种子 (主进程 set_seed 后可复现)，同步给 random / numpy
+    worker_seed = torch.initial_seed() % 2**32
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+    # 多 worker 时每个 worker 内 cv2 单线程，避免线程数超卖
+    cv2.setNumThreads(1)
+
+
+# using LightningDataModule
+class ComicDataModule(pl.LightningDataModule):
+    def __init__(self, batch_size, file_txt, disable_bucket=False,prompt_embeds=None, pooled_prompt_embeds=None, num_workers=0, prefetch_factor=2, persistent_workers=False, shuffle=True, seed=0, num_replicas=1, rank=0, sync_buckets=False, max_batch_pixels=None, latent_cache_dir=None, reduced_decode=False, num_samples=None, read_ahead_batches=0, read_ahead_threads=16, image_cache_bytes=0, device_resize=False):
+        super().__init__()
+        self.save_hyperparameters()
+        self.batch_size = batch_size
+        # self.dataset = dataset
+        self.file_txt = file_txt
+        self.prompt_embeds = prompt_embeds
+        self.pooled_prompt_embeds = pooled_prompt_embeds
+        self.disable_bucket = disable_bucket
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.sync_buckets = sync_buckets
+        self.max_batch_pixels = max_batch_pixels
+        self.latent_cache_dir = latent_cache_dir
+        self.reduced_decode = reduced_decode
+        self.num_samples = num_samples
+        self.read_ahead_batches = read_ahead_batches
+        self.read_ahead_threads = read_ahead_threads
+        self.image_cache_bytes = image_cache_bytes
+        self.device_resize = device_resize
+
+    def setup(self, stage):
+        if is_tar_shards(self.file_txt):
+            if self.latent_cache_dir is not None:
+                raise ValueError('The latent cache is built from a JSON manifest and cannot be used with tar shards.')
+            # tar 分片流式读取：数据集自己分桶组 batch，同时充当 batch sampler
+            self.dataset = TarShardBucketDataset(self.file_txt, batch_size=self.batch_size, num_samples=self.num_samples, num_replicas=self.num_replicas, rank=self.rank, seed=self.seed, max_batch_pixels=self.max_batch_pixels, disable_bucket=self.disable_bucket, reduced_decode=self.reduced_decode, device_resize=self.device_resize)
+            self.batch_sampler = self.dataset
+            return
+        if not self.shuffle and self.num_replicas > 1:
+            # GroupedBatchSampler 不按 rank 切分样本，dataloader 也不再经过 accelerator.prepare，各 rank 会训练相同的 batch
+            raise ValueError('shuffle=False uses an unsharded sampler and is only supported with a single process.')
+        distributed = self.num_replicas > 1 and torch.distributed.is_available() and torch.distributed.is_initialized()
+        bad_sample_rows = None
+        if distributed:
+            # 损坏样本登记可能在启动期间被同一 manifest 上的其它任务追加，多机时索引目录还可能在各节点本地；
+            # 由 rank 0 读取一次后广播，保证各 rank 剔除同一组样本
+            snapshot = [BadSampleRegistry(os.path.join(manifest_index_dir(self.file_txt), 'bad_samples')).rows() if self.rank == 0 else None]
+            torch.distributed.broadcast_object_list(snapshot, src=0)
+            bad_sample_rows = snapshot[0]
+        self.dataset = ComicDatasetBucket(file_path=self.file_txt, prompt_embeds=self.prompt_embeds, pooled_prompt_embeds=self.pooled_prompt_embeds,disable_bucket=self.disable_bucket, latent_cache_dir=self.latent_cache_dir, reduced_decode=self.reduced_decode, bad_sample_rows=bad_sample_rows, read_ahead_threads=self.read_ahead_threads if self.read_ahead_batches > 0 else 0, image_cache_bytes=self.image_cache_bytes, device_resize=self.device_resize)
+        if distributed:
+            # 样本数不一致时 DistributedBucketBatchSampler 给各 rank 的 batch 数不同，DDP 会卡住
+            lengths = [None] * self.num_replicas
+            torch.distributed.all_gather_object(lengths, len(self.dataset))
+            if len(set(lengths)) != 1:
+                raise RuntimeError(f'Dataset length differs between ranks: {lengths}')
+        self.sampler = SequentialSampler(self.dataset)
+        if self.shuffle and self.num_replicas > 1:
+            self.batch_sampler = DistributedBucketBatchSampler(self.dataset, batch_size=self.batch_size, num_replicas=self.num_replicas, rank=self.rank, seed=self.seed, sync_buckets=self.sync_buckets, max_batch_pixels=self.max_batch_pixels)
+        elif self.shuffle:
+            self.batch_sampler = BucketBatchSampler(self.dataset, batch_size=self.batch_size, seed=self.seed, max_batch_pixels=self.max_batch_pixels)
+        else:
+            self.batch_sampler = GroupedBatchSampler(sampler=self.sampler, dataset=self.dataset, batch_size=self.batch_size)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+    def train_dataloader(self):
+        worker_kwargs = {}
+        if self.num_workers > 0:
+            worker_kwargs = dict(
+                prefetch_factor=self.prefetch_factor,
+                persistent_workers=self.persistent_workers,
+                worker_init_fn=seed_worker,
+            )
+        if isinstance(self.dataset, IterableDataset):
+            # epoch / position 随每个 epoch 重新 pickle 给 worker，不能用常驻 worker
+            worker_kwargs.pop('persistent_workers', None)
+            return DataLoader(self.dataset, batch_size=None, num_workers=self.num_workers, pin_memory=True, **worker_kwargs)
+        # return DataLoader(self.dataset, batch_sampler=GroupedBatchSampler(sampler=self.sampler, batch_size=self.batch_size), num_workers=32, collate_fn=collate_fn)
+        batch_sampler = self.batch_sampler
+        if self.read_ahead_batches > 0 and self.dataset.latent_cache is None:
+            # self.batch_sampler 保持不变，训练脚本仍通过它 set_epoch / 保存进度
+            batch_sampler = ReadAheadBatchSampler(batch_sampler, self.read_ahead_batches, self.num_workers)
+        return DataLoader(self.dataset, batch_sampler=batch_sampler, num_workers=self.num_workers, collate_fn=collate_fn, pin_memory=True, **worker_kwargs)
+
+def analyze_buckets(dataset):
+    # 查看桶的总数
+    num_buckets = len(dataset.buckets)
+    print(f"Total number of buckets: {num_buckets}")
+
+    # 查看每个桶的分辨率和图像数量
+    for bucket_id, image_ids in dataset.buckets.items():
+        resolution = dataset.resolutions[bucket_id]
+        num_images = len(image_ids)
+        print(f"Bucket {bucket_id} (Resolution: {resolution}) contains {num_images} images")
+
+if __name__ == "__main__":
+    # python dataset_myself.py --benchmark_decode <manifest.json>：比较全分辨率解码与降采样解码的耗时
+    # python dataset_myself.py --check_device_resize <manifest.json>：检查 device 上批量缩放与 cv2.resize 的差异
+    cli_parser = argparse.ArgumentParser()
+    cli_parser.add_argument("--benchmark_decode", type=str, default=None, help="Manifest to benchmark full vs. reduced JPEG decode on.")
+    cli_parser.add_argument("--check_device_resize", type=str, default=None, help="Manifest to compare on-device batched resize against cv2.resize on.")
+    cli_parser.add_argument("--num_samples", type=int, default=200)
+    cli_args = cli_parser.parse_args()
+    if cli_args.benchmark_decode is not None:
+        benchmark_decode(ComicDatasetBucket(file_path=cli_args.benchmark_decode), cli_args.num_samples)
+        raise SystemExit
+    if cli_args.check_device_resize is not None:
+        check_device_resize(ComicDatasetBucket(file_path=cli_args.check_device_resize), cli_args.num_samples, device='cuda' if torch.cuda.is_available() else 'cpu')
+        raise SystemExit
+
+    # file_path = '/maindata/data/shared/public/nuo.pang/data/images/1000w_text_info_new.json'
+    # file_path = '/maindata/data/shared/public/songtao.tian/test_code/my/image_info_20250118.json'
+    # file_path = '/maindata/data/shared/public/songtao.tian/data/filter_aesV25_5.5_maxSize_1000_317w_0603_wangwei_after_format_filter_20250115_delete.json'
+    file_path = '/maindata/data/shared/public/songtao.tian/data/meta_aesV25_7.0_maxSize_1000_0603_wangwei.meta_two_term.json'
+
+    # 示例用法
+    dataset = ComicDatasetBucket(file_path=file_path)
+    analyze_buckets(dataset)
+
+
+
+
+    data_module = ComicDataModule(batch_size=2, file_txt=file_path)
+    data_module.setup(stage="fit")
+    train_dataloader = data_module.train_dataloader()
+
+    for step, batch in enumerate(tqdm(train_dataloader)):
+        image, text, orig_size, crop_coords, target_sizes  = batch['pixel_values'], batch['caption'], batch['original_sizes'], batch['crop_top_lefts'], batch['target_sizes']     
+        print(f'image.shape={image.shape}')
+
+
+
+
+
+
+
+    # import json
+    # from collections import Counter
+
+    # # 打开 JSON 文件
+    # with open(file_path, 'r', encoding='utf-8') as f:
+    #     data = json.load(f)  # 读取 JSON 数据
+
+    # # 统计字典关键字的出现次数
+    # dict_counter = Counter()
+
+    # # 遍历列表中的每个字典
+    # for item in data:
+    #     # 获取字典的键（关键字）
+    #     keys = frozenset(item.keys())  # 使用 frozenset 作为不可变键
+    #     dict_counter[keys] += 1
+
+    # # 输出结果
+    # print(f"Total unique dictionaries: {len(dict_counter)}")
+    # print("Dictionary counts:")
+    # for keys, count in dict_counter.items():
+    #     print(f"{keys}: {count}")
\ No newline at end of file
@@ -0,0 +1,344 @@
+# Content-addressed, memory-mapped cache of per-caption text embeddings.
+#
+# A cache directory holds one sub-directory per writer process:
+#
+#   meta.json                 field layout and encoder signature
+#   shard-<host>-<pid>-<uuid>/
+#     keys.bin                uint64 [n, 2]   sha1(caption)[:16], written last
+#     <field>.bin             dtype  [rows, *row_shape]
+#     <field>_ends.bin        int64  [n]      cumulative row count (ragged fields only)
+#   index.json                merged key index in use: its directory and the records it covers per shard
+#   index-<uuid>/
+#     hi.npy, lo.npy          uint64 [m]      keys sorted by the first word
+#     shard.npy               int32  [m]      position of the shard in index.json
+#     record.npy              int64  [m]      record within the shard
+#
+# Fixed fields store exactly one row of `shape` per record; ragged fields
+# (shape[0] is None) store a variable number of rows of `shape[1:]`. A record
+# only becomes visible once its key has been appended, so shards left behind by
+# an interrupted process are still consistent. Every process appends to its own
+# shard, so ranks and restarts never write to the same file.
+#
+# Lookups binary-search the memory-mapped merged index, so its size does not
+# count against the RAM of each rank. Records appended after the index was
+# written (the tail) are indexed in memory; once the tail grows past
+# `merge_threshold` it is merged into a new index directory in a streaming pass.
+
+import hashlib
+import json
+import os
+import socket
+import time
+import uuid
+
+import numpy as np
+
+
+CACHE_VERSION = 1
+
+_META = "meta.json"
+_KEYS = "keys.bin"
+_INDEX_META = "index.json"
+_INDEX_LOCK = "index.lock"
+_INDEX_COLUMNS = (("hi", np.uint64), ("lo", np.uint64), ("shard", np.int32), ("record", np.int64))
+
+
+def caption_key(text):
+    """128-bit key of a caption as two uint64 words."""
+    digest = hashlib.sha1(text.encode("utf-8")).digest()[:16]
+    return tuple(int(x) for x in np.frombuffer(digest, dtype=np.uint64))
+
+
+def _memmap(path, dtype, shape):
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+class _Shard:
+    def __init__(self, shard_dir, fields):
+        self.shard_dir = shard_dir
+        self.fields = fields
+        self.refresh()
+
+    def refresh(self):
+        keys_path = os.path.join(self.shard_dir, _KEYS)
+        n = os.path.getsize(keys_path) // 16 if os.path.exists(keys_path) else 0
+        self.num_records = n
+        self.keys = _memmap(keys_path, np.uint64, (n, 2))
+        self.ends = {}
+        self.data = {}
+        for name, (shape, dtype) in self.fields.items():
+            path = os.path.join(self.shard_dir, f"{name}.bin")
+            if shape[0] is None:
+                self.ends[name] = _memmap(os.path.join(self.shard_dir, f"{name}_ends.bin"), np.int64, (n,))
+                rows = int(self.ends[name][-1]) if n else 0
+                self.data[name] = _memmap(path, dtype, (rows, *shape[1:]))
+            else:
+                self.data[name] = _memmap(path, dtype, (n, *shape))
+
+    def read(self, record):
+        if record >= self.num_records:
+            self.refresh()
+        out = {}
+        for name, (shape, _) in self.fields.items():
+            if shape[0] is None:
+                ends = self.ends[name]
+                start = int(ends[record - 1]) if record else 0
+                out[name] = np.array(self.data[name][start:int(ends[record])])
+            else:
+                out[name] = np.array(self.data[name][record])
+        return out
+
+
+class _KeyIndex:
+    """Keys sorted by their first word, with the shard and record of each; arrays may be memmaps."""
+
+    def __init__(self, hi, lo, shard, record, shard_map=None):
+        self.hi, self.lo, self.shard, self.record = hi, lo, shard, record
+        # 磁盘索引中的 shard 编号是 index.json 中的位置，映射到当前打开的 shards 列表
+        self.shard_map = shard_map
+
+    @classmethod
+    def from_records(cls, keys, shard_ids, records):
+        order = np.argsort(keys[:, 0], kind="stable")
+        return cls(np.ascontiguousarray(keys[order, 0]), np.ascontiguousarray(keys[order, 1]), shard_ids[order], records[order])
+
+    @classmethod
+    def empty(cls):
+        return cls.from_records(np.zeros((0, 2), np.uint64), np.zeros(0, np.int32), np.zeros(0, np.int64))
+
+    def __len__(self):
+        return len(self.hi)
+
+    def shards(self, start, stop):
+        shard = np.asarray(self.shard[start:stop])
+        return shard if self.shard_map is None else self.shard_map[shard]
+
+    def locate(self, hi, lo):
+        i = int(np.searchsorted(self.hi, np.uint64(hi)))
+        while i < len(self.hi) and int(self.hi[i]) == hi:
+            if int(self.lo[i]) == lo:
+                return int(self.shards(i, i + 1)[0]), int(self.record[i])
+            i += 1
+        return None
+
+
+def _merge_index(index, tail, index_dir, chunk_size=1 << 22):
+    """Writes the sorted union of two `_KeyIndex` to `index_dir` chunk by chunk; returns the written length."""
+    os.makedirs(index_dir)
+    total = len(index) + len(tail)
+    out = {name: np.lib.format.open_memmap(os.path.join(index_dir, f"{name}.npy"), mode="w+", dtype=dtype, shape=(total,))
+           for name, dtype in _INDEX_COLUMNS}
+    # tail 的每条记录在合并结果中的位置；其余位置按顺序由 index 填充
+    positions = np.searchsorted(index.hi, tail.hi, side="right") + np.arange(len(tail))
+    tail_shards = tail.shards(0, len(tail))
+    for start in range(0, total, chunk_size):
+        stop = min(start + chunk_size, total)
+        t0, t1 = np.searchsorted(positions, [start, stop])
+        from_tail = np.zeros(stop - start, dtype=bool)
+        from_tail[positions[t0:t1] - start] = True
+        i0, i1 = start - t0, stop - t1
+        for name, source, tail_source in (
+            ("hi", index.hi[i0:i1], tail.hi[t0:t1]),
+            ("lo", index.lo[i0:i1], tail.lo[t0:t1]),
+            ("shard", index.shards(i0, i1), tail_shards[t0:t1]),
+            ("record", index.record[i0:i1], tail.record[t0:t1]),
+        ):
+            out[name][start:stop][from_tail] = tail_source
+            out[name][start:stop][~from_tail] = source
+    for array in out.values():
+        array.flush()
+    return total
+
+
+class EmbeddingCache:
+    """Append-only store of embeddings keyed by caption hash.
+
+    `fields` maps a name to `(shape, dtype)`; a `None` leading dimension marks a
+    ragged field whose length may differ per caption. `signature` identifies the
+    encoders (model path, revision, ...) and must match an existing cache.
+    Records outside the merged on-disk index are kept in memory until there are
+    more than `merge_threshold` of them.
+    """
+
+    def __init__(self, cache_dir, fields, signature=None, merge_threshold=1 << 20):
+        self.cache_dir = cache_dir
+        self.merge_threshold = merge_threshold
+        self.fields = {name: (tuple(shape), np.dtype(dtype)) for name, (shape, dtype) in fields.items()}
+        os.makedirs(cache_dir, exist_ok=True)
+
+        meta = {
+            "version": CACHE_VERSION,
+            "signature": signature,
+            "fields": {name: [list(shape), dtype.name] for name, (shape, dtype) in self.fields.items()},
+        }
+        meta_path = os.path.join(cache_dir, _META)
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                existing = json.load(f)
+            if existing != meta:
+                raise ValueError(
+                    f"{cache_dir} holds embeddings of a different layout or encoder ({existing.get('signature')}); "
+                    "use a new cache directory."
+                )
+        else:
+            tmp_path = f"{meta_path}.tmp-{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+
+        self.shards = []
+        for name in sorted(os.listdir(cache_dir)):
+            shard_dir = os.path.join(cache_dir, name)
+            if name.startswith("shard-") and os.path.isdir(shard_dir):
+                self.shards.append(_Shard(shard_dir, self.fields))
+
+        self._writer = None
+        self._open_index()
+        self._fold()
+
+    def _open_index(self):
+        # 打开 index.json 指向的合并索引；缺失或引用了已不存在的 shard 时视为没有索引
+        self._index, self._covered = _KeyIndex.empty(), {}
+        meta_path = os.path.join(self.cache_dir, _INDEX_META)
+        if not os.path.exists(meta_path):
+            return
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        positions = {os.path.basename(shard.shard_dir): i for i, shard in enumerate(self.shards)}
+        if any(name not in positions for name, _ in meta["shards"]):
+            return
+        index_dir = os.path.join(self.cache_dir, meta["dir"])
+        columns = {name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r") for name, _ in _INDEX_COLUMNS}
+        shard_map = np.array([positions[name] for name, _ in meta["shards"]], dtype=np.int32)
+        self._index = _KeyIndex(columns["hi"], columns["lo"], columns["shard"], columns["record"], shard_map)
+        self._covered = {positions[name]: count for name, count in meta["shards"]}
+
+    def _fold(self):
+        # 把索引未覆盖的记录 (其它进程此前追加的、本进程新写入的) 重新整理成内存中的有序 tail
+        keys, shard_ids, records = [], [], []
+        self._counts = {}
+        for i, shard in enumerate(self.shards):
+            if i == self._writer:
+                shard.refresh()
+            start, stop = self._covered.get(i, 0), shard.num_records
+            self._counts[i] = stop
+            if stop > start:
+                keys.append(np.asarray(shard.keys[start:stop]))
+                shard_ids.append(np.full(stop - start, i, dtype=np.int32))
+                records.append(np.arange(start, stop, dtype=np.int64))
+        if keys:
+            self._tail = _KeyIndex.from_records(np.concatenate(keys), np.concatenate(shard_ids), np.concatenate(records))
+        else:
+            self._tail = _KeyIndex.empty()
+        self._new = {}
+        if len(self._tail) > max(self.merge_threshold, len(self._index) // 8):
+            self._merge()
+
+    def _merge(self):
+        # 同一时间只由一个进程写新索引；拿不到锁的进程本次继续使用内存中的 tail
+        lock_path = os.path.join(self.cache_dir, _INDEX_LOCK)
+        if os.path.exists(lock_path) and time.time() - os.path.getmtime(lock_path) > 3600:
+            # 写索引的进程异常退出后留下的锁
+            os.remove(lock_path)
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return
+        try:
+            name = f"index-{uuid.uuid4().hex[:8]}"
+            _merge_index(self._index, self._tail, os.path.join(self.cache_dir, name))
+            meta = {
+                "dir": name,
+                "shards": [[os.path.basename(shard.shard_dir), self._counts[i]] for i, shard in enumerate(self.shards)],
+            }
+            meta_path = os.path.join(self.cache_dir, _INDEX_META)
+            tmp_path = f"{meta_path}.tmp-{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+            for old in os.listdir(self.cache_dir):
+                old_dir = os.path.join(self.cache_dir, old)
+                # 旧索引可能仍被其它进程 memmap 着，留一段时间再删
+                if old.startswith("index-") and old != name and time.time() - os.path.getmtime(old_dir) > 3600:
+                    for file_name in os.listdir(old_dir):
+                        os.remove(os.path.join(old_dir, file_name))
+                    os.rmdir(old_dir)
+        finally:
+            os.close(fd)
+            os.remove(lock_path)
+        self._open_index()
+        self._tail = _KeyIndex.empty()
+
+    def __len__(self):
+        return len(self._index) + len(self._tail) + len(self._new)
+
+    def _locate(self, key):
+        if key in self._new:
+            return self._new[key]
+        hi, lo = key
+        for index in (self._index, self._tail):
+            location = index.locate(hi, lo)
+            if location is not None:
+                return location
+        return None
+
+    def get(self, text):
+        """Returns the cached arrays of `text` or None on a miss."""
+        location = self._locate(caption_key(text))
+        if location is None:
+            return None
+        shard_id, record = location
+        return self.shards[shard_id].read(record)
+
+    def _open_writer(self):
+        shard_dir = os.path.join(self.cache_dir, f"shard-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(shard_dir, exist_ok=True)
+        self._keys_file = open(os.path.join(shard_dir, _KEYS), "ab")
+        self._data_files = {}
+        self._ends_files = {}
+        self._rows = {}
+        for name, (shape, _) in self.fields.items():
+            self._data_files[name] = open(os.path.join(shard_dir, f"{name}.bin"), "ab")
+            if shape[0] is None:
+                self._ends_files[name] = open(os.path.join(shard_dir, f"{name}_ends.bin"), "ab")
+                self._rows[name] = 0
+        self.shards.append(_Shard(shard_dir, self.fields))
+        self._writer = len(self.shards) - 1
+        self._written = 0
+
+    def put(self, text, **arrays):
+        """Appends the embeddings of `text`; a no-op if it is already cached."""
+        key = caption_key(text)
+        if self._locate(key) is not None:
+            return
+        if self._writer is None:
+            self._open_writer()
+        checked = {}
+        for name, (shape, dtype) in self.fields.items():
+            array = np.ascontiguousarray(arrays[name], dtype=dtype)
+            if array.shape[1:] != shape[1:] or (shape[0] is not None and array.shape[0] != shape[0]):
+                raise ValueError(f"{name} has shape {array.shape}, expected {shape}")
+            checked[name] = array
+        for name, (shape, _) in self.fields.items():
+            array = checked[name]
+            self._data_files[name].write(array.tobytes())
+            self._data_files[name].flush()
+            if shape[0] is None:
+                self._rows[name] += array.shape[0]
+                self._ends_files[name].write(np.int64(self._rows[name]).tobytes())
+                self._ends_files[name].flush()
+        # key 最后写入，作为该条记录完整写完的标记
+        self._keys_file.write(np.asarray(key, dtype=np.uint64).tobytes())
+        self._keys_file.flush()
+        self._new[key] = (self._writer, self._written)
+        self._written += 1
+        if len(self._new) >= self.merge_threshold:
+            self._fold()
+
+    def close(self):
+        if self._writer is not None:
+            for f in (self._keys_file, *self._data_files.values(), *self._ends_files.values()):
+                f.close()
+            self._writer = None
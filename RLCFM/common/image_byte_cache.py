@@ -0,0 +1,100 @@
+# Byte-budgeted in-RAM cache of encoded image files shared by DataLoader workers.
+#
+# A single anonymous shared mapping, created before the workers are forked, holds
+#
+#   header   int64 [4]          reserved bytes (logical write position), hits, misses, inserts
+#   starts   int64 [num_keys]   logical offset of the entry of each key, -1 if never cached
+#   ring     uint8 [capacity]   entries: int64 key, int64 length, encoded bytes
+#
+# Entries are appended at the write position and the ring wraps around, so the
+# oldest entries are overwritten first. An entry is valid while fewer than
+# `capacity` bytes have been reserved after its start; readers check this before
+# and after copying, so lookups take no lock. A hit on an entry in the oldest
+# quarter of the ring appends it again, which keeps the re-read working set
+# resident like an LRU.
+
+import mmap
+import multiprocessing
+
+import numpy as np
+
+
+_RESERVED, _HITS, _MISSES, _INSERTS = range(4)
+_HEADER_SIZE = 4
+_ENTRY_HEADER = 16
+
+
+class SharedByteCache:
+    """Fixed-budget cache of byte strings keyed by integers in [0, num_keys)."""
+
+    def __init__(self, capacity, num_keys):
+        self.capacity = int(capacity)
+        self.num_keys = int(num_keys)
+        # mmap(-1, ...) 是 MAP_SHARED 的匿名映射，fork 出的 worker 与主进程共享同一块内存
+        self._mmap = mmap.mmap(-1, 8 * (_HEADER_SIZE + self.num_keys) + self.capacity)
+        self._header = np.frombuffer(self._mmap, dtype=np.int64, count=_HEADER_SIZE)
+        self._starts = np.frombuffer(self._mmap, dtype=np.int64, count=self.num_keys, offset=8 * _HEADER_SIZE)
+        self._ring = np.frombuffer(self._mmap, dtype=np.uint8, count=self.capacity, offset=8 * (_HEADER_SIZE + self.num_keys))
+        self._starts[:] = -1
+        self._lock = multiprocessing.Lock()
+
+    def __getstate__(self):
+        raise TypeError("SharedByteCache is shared with DataLoader workers through fork and cannot be pickled.")
+
+    def _valid(self, start, reserved):
+        return start >= 0 and reserved <= start + self.capacity
+
+    def __contains__(self, key):
+        return self._valid(int(self._starts[key]), int(self._header[_RESERVED]))
+
+    def get(self, key):
+        """Returns the cached bytes of `key`, or None on a miss."""
+        start = int(self._starts[key])
+        if self._valid(start, int(self._header[_RESERVED])):
+            offset = start % self.capacity
+            entry_key, length = (int(x) for x in self._ring[offset:offset + _ENTRY_HEADER].view(np.int64))
+            if entry_key == key and 0 <= length <= self.capacity - offset - _ENTRY_HEADER:
+                data = self._ring[offset + _ENTRY_HEADER:offset + _ENTRY_HEADER + length].tobytes()
+                reserved = int(self._header[_RESERVED])
+                # 复制期间没有新的写入覆盖这段内存
+                if self._valid(start, reserved):
+                    with self._lock:
+                        self._header[_HITS] += 1
+                    if reserved - start > self.capacity * 3 // 4:
+                        self.put(key, data)
+                    return data
+        with self._lock:
+            self._header[_MISSES] += 1
+        return None
+
+    def put(self, key, data):
+        """Appends `data` for `key`, evicting the oldest entries; entries over 1/4 of the budget are skipped."""
+        need = _ENTRY_HEADER + len(data)
+        if need > self.capacity // 4:
+            return False
+        with self._lock:
+            start = int(self._header[_RESERVED])
+            if start % self.capacity + need > self.capacity:
+                # 条目不跨越环尾
+                start += self.capacity - start % self.capacity
+            self._header[_RESERVED] = start + need
+        offset = start % self.capacity
+        self._ring[offset:offset + _ENTRY_HEADER] = np.array([key, len(data)], dtype=np.int64).view(np.uint8)
+        self._ring[offset + _ENTRY_HEADER:offset + need] = np.frombuffer(data, dtype=np.uint8)
+        with self._lock:
+            # 写入期间可能已被其它进程的新条目覆盖
+            if not self._valid(start, int(self._header[_RESERVED])):
+                return False
+            self._starts[key] = start
+            self._header[_INSERTS] += 1
+        return True
+
+    def stats(self):
+        hits, misses = int(self._header[_HITS]), int(self._header[_MISSES])
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / max(hits + misses, 1),
+            "inserts": int(self._header[_INSERTS]),
+            "used_bytes": min(int(self._header[_RESERVED]), self.capacity),
+        }
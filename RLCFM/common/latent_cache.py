@@ -0,0 +1,323 @@
+# Offline VAE latent cache used by `ComicDatasetBucket`.
+#
+# Every image of a manifest is encoded once at its assigned bucket resolution
+# and the moments of `vae.encode(x).latent_dist` are stored per bucket:
+#
+#   bucket-XXXX-mean.bin    float16  [n_b, C, H / f, W / f]
+#   bucket-XXXX-logvar.bin  float16  [n_b, C, H / f, W / f]
+#   positions.bin           int64    [N]     sample id -> row inside its bucket
+#   status.bin              uint8    [N]     0 pending, 1 encoded, 2 unreadable
+#   original_sizes.bin      int32    [N, 2]  decoded (width, height)
+#   meta.json                                layout, bucket assignment key, VAE
+#
+# Rows of a bucket follow `dataset.bucket_members`, so shard files are filled
+# sequentially. Training maps the files read-only and draws
+# `latent_dist.sample()` from the cached moments on the device.
+#
+# Usage:
+#   python latent_cache.py --train_shards_path_or_url image_info.json \
+#       --pretrained_model_name_or_path <model> --latent_cache_dir image_info_latents
+#
+# Several processes can fill one cache with `--num_shards/--shard_id`; an
+# interrupted run resumes from the batches that are still pending.
+
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from tqdm.auto import tqdm
+
+
+CACHE_VERSION = 1
+
+_POSITIONS = "positions.bin"
+_STATUS = "status.bin"
+_ORIGINAL_SIZES = "original_sizes.bin"
+_META = "meta.json"
+
+PENDING, ENCODED, UNREADABLE = 0, 1, 2
+
+
+def _bucket_file(cache_dir, bucket_id, name):
+    return os.path.join(cache_dir, f"bucket-{bucket_id:04d}-{name}.bin")
+
+
+def _open_or_create(path, dtype, shape):
+    # 预分配定长文件；多个 shard 进程同时创建时 truncate 到同一长度是幂等的
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if not os.path.exists(path) or os.path.getsize(path) != nbytes:
+        with open(path, "ab"):
+            pass
+        os.truncate(path, nbytes)
+    if nbytes == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+
+def latent_dist_sample(mean, logvar, generator=None):
+    """Same draw as `DiagonalGaussianDistribution.sample()` for cached moments."""
+    mean = mean.float()
+    logvar = torch.clamp(logvar.float(), -30.0, 20.0)
+    std = torch.exp(0.5 * logvar)
+    noise = torch.randn(mean.shape, generator=generator, device=mean.device, dtype=mean.dtype)
+    return mean + std * noise
+
+
+def cache_meta(dataset, latent_channels, downsample, dtype, vae_path):
+    return {
+        "version": CACHE_VERSION,
+        "assignment_key": dataset.assignment_key,
+        "num_samples": len(dataset),
+        "latent_channels": int(latent_channels),
+        "downsample": int(downsample),
+        "dtype": np.dtype(dtype).name,
+        "vae": vae_path,
+        "buckets": {
+            str(bucket_id): [len(members), *(int(x) for x in dataset.resolutions[bucket_id])]
+            for bucket_id, members in dataset.buckets.items()
+        },
+    }
+
+
+class LatentCache:
+    """Read-only, memory-mapped view of a latent cache directory."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, _META), "r") as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != CACHE_VERSION:
+            raise ValueError(
+                f"Unsupported latent cache version {self.meta.get('version')} in {cache_dir}, expected {CACHE_VERSION}."
+            )
+        n = int(self.meta["num_samples"])
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.positions = np.memmap(os.path.join(cache_dir, _POSITIONS), dtype=np.int64, mode="r", shape=(n,))
+        self.status = np.memmap(os.path.join(cache_dir, _STATUS), dtype=np.uint8, mode="r", shape=(n,))
+        self.original_sizes = np.memmap(os.path.join(cache_dir, _ORIGINAL_SIZES), dtype=np.int32, mode="r", shape=(n, 2))
+        self._moments = {}
+
+    def __reduce__(self):
+        # pickle by path; the receiving process maps the files again
+        return LatentCache, (self.cache_dir,)
+
+    @staticmethod
+    def exists(cache_dir):
+        return os.path.isfile(os.path.join(cache_dir, _META))
+
+    def check(self, dataset):
+        """Raises if the cache was built for a different manifest or bucket assignment."""
+        if self.meta["assignment_key"] != dataset.assignment_key or self.meta["num_samples"] != len(dataset):
+            raise ValueError(
+                f"Latent cache {self.cache_dir} was built for a different bucket assignment "
+                f"({self.meta['num_samples']} samples, key {self.meta['assignment_key']}); rebuild it with latent_cache.py."
+            )
+        pending = int(np.count_nonzero(self.status == PENDING))
+        if pending:
+            raise ValueError(f"Latent cache {self.cache_dir} is incomplete: {pending} samples are not encoded yet.")
+
+    def _bucket_moments(self, bucket_id):
+        if bucket_id not in self._moments:
+            count, W, H = self.meta["buckets"][str(bucket_id)]
+            f = self.meta["downsample"]
+            shape = (count, self.meta["latent_channels"], H // f, W // f)
+            self._moments[bucket_id] = tuple(
+                np.memmap(_bucket_file(self.cache_dir, bucket_id, name), dtype=self.dtype, mode="r", shape=shape)
+                for name in ("mean", "logvar")
+            )
+        return self._moments[bucket_id]
+
+    def moments(self, idx, bucket_id):
+        if self.status[idx] != ENCODED:
+            raise ValueError(f"Sample {idx} could not be read when the latent cache was built.")
+        mean, logvar = self._bucket_moments(bucket_id)
+        position = int(self.positions[idx])
+        return np.array(mean[position]), np.array(logvar[position])
+
+    def original_size(self, idx):
+        w, h = self.original_sizes[idx]
+        return int(w), int(h)
+
+
+class _EncodeDataset(Dataset):
+    # 按 bucket_members 的顺序读图，读取失败时返回占位图并标记，不做随机替换
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, k):
+        idx = int(self.dataset.bucket_members[k])
+        W, H = (int(x) for x in self.dataset.resolutions[self.dataset.sample_buckets[idx]])
+        try:
+            sample = self.dataset.load_sample(idx)
+            return k, sample["pixel_values"], sample["original_sizes"], True
+        except Exception as e:
+            print(f"Unable to encode sample {idx}: {e}")
+            return k, np.zeros((3, H, W), dtype=np.uint8), (0, 0), False
+
+
+def _collate(examples):
+    positions, pixel_values, original_sizes, ok = zip(*examples)
+    return (
+        np.asarray(positions),
+        torch.from_numpy(np.stack(pixel_values)),
+        np.asarray(original_sizes, dtype=np.int32),
+        np.asarray(ok),
+    )
+
+
+def build_latent_cache(dataset, vae, cache_dir, batch_size=8, num_workers=4, num_shards=1, shard_id=0, dtype=np.float16, vae_path=None):
+    """Encodes every sample of `dataset` with `vae` into `cache_dir`."""
+    if getattr(dataset, "num_excluded_samples", 0):
+        raise ValueError("Build the latent cache from a dataset created with exclude_bad_samples=False.")
+    os.makedirs(cache_dir, exist_ok=True)
+    downsample = 2 ** (len(vae.config.block_out_channels) - 1)
+    latent_channels = vae.config.latent_channels
+    meta = cache_meta(dataset, latent_channels, downsample, dtype, vae_path)
+    if LatentCache.exists(cache_dir):
+        with open(os.path.join(cache_dir, _META), "r") as f:
+            previous = json.load(f)
+        if previous != meta:
+            raise ValueError(f"{cache_dir} holds a latent cache with a different layout; use a new directory.")
+
+    n = len(dataset)
+    positions = _open_or_create(os.path.join(cache_dir, _POSITIONS), np.int64, (n,))
+    status = _open_or_create(os.path.join(cache_dir, _STATUS), np.uint8, (n,))
+    original_sizes = _open_or_create(os.path.join(cache_dir, _ORIGINAL_SIZES), np.int32, (n, 2))
+    moments = {}
+    for bucket_id, (count, W, H) in meta["buckets"].items():
+        shape = (count, latent_channels, H // downsample, W // downsample)
+        moments[int(bucket_id)] = tuple(
+            _open_or_create(_bucket_file(cache_dir, int(bucket_id), name), dtype, shape) for name in ("mean", "logvar")
+        )
+
+    members = np.asarray(dataset.bucket_members)
+    bounds = dataset.bucket_bounds
+    # 桶内按 batch_size 切块，块按序号轮流分给各 shard；已完成的块直接跳过
+    batches = []
+    for bucket_id in sorted(dataset.buckets):
+        start, end = int(bounds[bucket_id]), int(bounds[bucket_id + 1])
+        positions[members[start:end]] = np.arange(end - start)
+        for i in range(start, end, batch_size):
+            batches.append(list(range(i, min(i + batch_size, end))))
+    batches = [b for i, b in enumerate(batches) if i % num_shards == shard_id]
+    batches = [b for b in batches if np.any(status[members[b]] == PENDING)]
+    tmp_path = os.path.join(cache_dir, f"{_META}.tmp-{os.getpid()}")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(cache_dir, _META))
+
+    loader = DataLoader(_EncodeDataset(dataset), batch_sampler=batches, num_workers=num_workers, collate_fn=_collate)
+    for step, (ks, pixel_values, sizes, ok) in enumerate(tqdm(loader, desc=f"encode shard {shard_id}/{num_shards}")):
+        idx = members[ks]
+        bucket_id = int(dataset.sample_buckets[idx[0]])
+        rows = ks - int(bounds[bucket_id])
+        with torch.no_grad():
+            # 样本是 uint8，归一化到 [-1, 1] 在设备上完成
+            pixel_values = pixel_values.to(device=vae.device).float() / 127.5 - 1.0
+            latent_dist = vae.encode(pixel_values.to(dtype=vae.dtype)).latent_dist
+        mean, logvar = moments[bucket_id]
+        mean[rows] = latent_dist.mean.float().cpu().numpy().astype(dtype)
+        logvar[rows] = latent_dist.logvar.float().cpu().numpy().astype(dtype)
+        original_sizes[idx] = sizes
+        status[idx] = np.where(ok, ENCODED, UNREADABLE)
+        if step % 100 == 0:
+            for array in (status, original_sizes, mean, logvar):
+                if isinstance(array, np.memmap):
+                    array.flush()
+
+    for array in (positions, status, original_sizes, *(a for pair in moments.values() for a in pair)):
+        if isinstance(array, np.memmap):
+            array.flush()
+    return cache_dir
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Encode a manifest into a per-bucket VAE latent cache.")
+    parser.add_argument(
+        "--train_shards_path_or_url",
+        type=str,
+        required=True,
+        help="JSON / JSONL manifest, the same file that is passed to the training script.",
+    )
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default=None,
+        help="Model whose `vae` subfolder is used when --pretrained_vae_model_name_or_path is not given.",
+    )
+    parser.add_argument(
+        "--pretrained_vae_model_name_or_path",
+        type=str,
+        default=None,
+        help="Path to a standalone VAE, e.g. the fp16-fix SDXL VAE.",
+    )
+    parser.add_argument("--revision", type=str, default=None, help="Revision of the pretrained model.")
+    parser.add_argument(
+        "--latent_cache_dir",
+        type=str,
+        required=True,
+        help="Output directory; pass the same directory to the training script with --latent_cache_dir.",
+    )
+    parser.add_argument("--disable_bucket", action="store_true", help="Must match the training run.")
+    parser.add_argument("--batch_size", type=int, default=8, help="Images per VAE forward.")
+    parser.add_argument("--num_workers", type=int, default=8, help="DataLoader workers decoding images.")
+    parser.add_argument(
+        "--vae_dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "float16", "bfloat16"],
+        help="Precision of the VAE forward. The SDXL VAE is only stable in fp16 with the fp16-fix weights.",
+    )
+    parser.add_argument(
+        "--cache_dtype",
+        type=str,
+        default="float16",
+        choices=["float16", "float32"],
+        help="Storage precision of the cached mean / logvar.",
+    )
+    parser.add_argument("--num_shards", type=int, default=1, help="Number of processes filling the cache.")
+    parser.add_argument("--shard_id", type=int, default=0, help="Index of this process in [0, num_shards).")
+    return parser.parse_args()
+
+
+def main():
+    from diffusers import AutoencoderKL
+    from dataset_myself import ComicDatasetBucket
+
+    args = parse_args()
+    if args.pretrained_vae_model_name_or_path is None and args.pretrained_model_name_or_path is None:
+        raise ValueError("Either --pretrained_model_name_or_path or --pretrained_vae_model_name_or_path is required.")
+    vae_path = args.pretrained_vae_model_name_or_path or args.pretrained_model_name_or_path
+    vae = AutoencoderKL.from_pretrained(
+        vae_path,
+        subfolder="vae" if args.pretrained_vae_model_name_or_path is None else None,
+        revision=args.revision,
+    )
+    device = torch.device(f"cuda:{args.shard_id % torch.cuda.device_count()}" if torch.cuda.is_available() else "cpu")
+    vae.to(device, dtype=getattr(torch, args.vae_dtype))
+    vae.requires_grad_(False)
+    vae.eval()
+
+    # 缓存按完整的分桶结果建立，不剔除登记过的损坏样本（它们会被标记为 UNREADABLE）
+    dataset = ComicDatasetBucket(file_path=args.train_shards_path_or_url, disable_bucket=args.disable_bucket, exclude_bad_samples=False)
+    build_latent_cache(
+        dataset,
+        vae,
+        args.latent_cache_dir,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        num_shards=args.num_shards,
+        shard_id=args.shard_id,
+        dtype=np.dtype(args.cache_dtype),
+        vae_path=vae_path,
+    )
+
+
+if __name__ == "__main__":
+    main()
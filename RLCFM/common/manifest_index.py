@@ -0,0 +1,599 @@
+# Columnar binary manifest used by `ComicDatasetBucket`.
+#
+# An index is a directory next to the source manifest (`image_info.json` ->
+# `image_info_index/`) holding flat little-endian arrays:
+#
+#   sizes.bin            int32  [N, 2]  original (width, height)
+#   path_offsets.bin     int64  [N + 1] byte offsets into path_bytes.bin
+#   path_bytes.bin       uint8          utf-8 image paths, concatenated
+#   caption_offsets.bin  int64  [N + 1] byte offsets into caption_bytes.bin
+#   caption_bytes.bin    uint8          utf-8 captions, concatenated
+#   meta.json                           format version and record count
+#   bad_samples/bad-<host>-<pid>.bin    int64 rows that failed to load, see BadSampleRegistry
+#
+# Everything is opened with `np.memmap`, so loading is O(1) and the pages are
+# shared through the OS page cache by every local rank and DataLoader worker.
+#
+# Indexes can also be built straight from image directories, reading sizes from
+# the image headers only:
+#
+#   python manifest_index.py --image_dirs /data/a /data/b --manifest /data/ab.json
+#
+# writes `/data/ab_index/`, which `ComicDatasetBucket('/data/ab.json')` loads
+# without the JSON file existing.
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm.auto import tqdm
+
+
+INDEX_VERSION = 1
+
+_SIZES = "sizes.bin"
+_PATH_OFFSETS = "path_offsets.bin"
+_PATH_BYTES = "path_bytes.bin"
+_CAPTION_OFFSETS = "caption_offsets.bin"
+_CAPTION_BYTES = "caption_bytes.bin"
+_META = "meta.json"
+
+_READ_CHUNK = 1 << 20
+_COPY_CHUNK = 1 << 22
+
+
+def manifest_index_dir(file_path):
+    """Default index location for a manifest file."""
+    return os.path.splitext(file_path)[0] + "_index"
+
+
+def _open_array(path, dtype, shape=None):
+    # np.memmap refuses zero-length files
+    if os.path.getsize(path) == 0:
+        return np.zeros(shape if shape is not None else (0,), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+class ManifestIndex:
+    """Read-only, memory-mapped view of a manifest index directory."""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, _META), "r") as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_VERSION:
+            raise ValueError(
+                f"Unsupported manifest index version {meta.get('version')} in {index_dir}, expected {INDEX_VERSION}."
+            )
+        self.num_records = int(meta["num_records"])
+        n = self.num_records
+
+        self.sizes = _open_array(os.path.join(index_dir, _SIZES), np.int32, (n, 2))
+        self.path_offsets = _open_array(os.path.join(index_dir, _PATH_OFFSETS), np.int64, (n + 1,))
+        self.path_bytes = _open_array(os.path.join(index_dir, _PATH_BYTES), np.uint8)
+        self.caption_offsets = _open_array(os.path.join(index_dir, _CAPTION_OFFSETS), np.int64, (n + 1,))
+        self.caption_bytes = _open_array(os.path.join(index_dir, _CAPTION_BYTES), np.uint8)
+
+    def __reduce__(self):
+        # pickle by path; the receiving process maps the files again
+        return ManifestIndex, (self.index_dir,)
+
+    @staticmethod
+    def exists(index_dir):
+        return os.path.isfile(os.path.join(index_dir, _META))
+
+    def __len__(self):
+        return self.num_records
+
+    def path(self, row):
+        start, end = self.path_offsets[row], self.path_offsets[row + 1]
+        return self.path_bytes[start:end].tobytes().decode("utf-8")
+
+    def caption(self, row):
+        start, end = self.caption_offsets[row], self.caption_offsets[row + 1]
+        return self.caption_bytes[start:end].tobytes().decode("utf-8")
+
+    def size(self, row):
+        w, h = self.sizes[row]
+        return int(w), int(h)
+
+
+class BadSampleRegistry:
+    """Append-only record of manifest rows that could not be loaded.
+
+    Every process (rank or DataLoader worker) appends int64 rows to its own
+    `bad-<host>-<pid>.bin`, so writers never share a file; readers merge all of
+    them.
+    """
+
+    def __init__(self, registry_dir):
+        self.registry_dir = registry_dir
+        self._file = None
+        self._pid = None
+        self._num_failures = None
+        self._scanned_at = 0.0
+
+    def __reduce__(self):
+        return BadSampleRegistry, (self.registry_dir,)
+
+    def _files(self):
+        if not os.path.isdir(self.registry_dir):
+            return []
+        names = sorted(os.listdir(self.registry_dir))
+        return [os.path.join(self.registry_dir, name) for name in names if name.startswith("bad-") and name.endswith(".bin")]
+
+    def rows(self):
+        """Unique manifest rows recorded by any process."""
+        # 写到一半的末尾记录不足 8 字节，fromfile 会忽略
+        rows = [np.fromfile(path, dtype=np.int64) for path in self._files()]
+        return np.unique(np.concatenate(rows)) if rows else np.zeros(0, dtype=np.int64)
+
+    def num_failures(self, max_age=60.0):
+        """Number of recorded failures, rescanned at most every `max_age` seconds."""
+        now = time.monotonic()
+        if self._num_failures is None or now - self._scanned_at > max_age:
+            self._num_failures = sum(os.path.getsize(path) // 8 for path in self._files())
+            self._scanned_at = now
+        return self._num_failures
+
+    def add(self, row):
+        """Records `row`; returns False if the registry is not writable."""
+        if self._pid != os.getpid():
+            # fork 出的 worker 不复用父进程的文件句柄
+            self._pid = os.getpid()
+            self._file = None
+            try:
+                os.makedirs(self.registry_dir, exist_ok=True)
+                path = os.path.join(self.registry_dir, f"bad-{socket.gethostname()}-{self._pid}.bin")
+                self._file = open(path, "ab")
+            except OSError as e:
+                print(f"Unable to record bad samples in {self.registry_dir}: {e}")
+        if self._file is None:
+            return False
+        self._file.write(np.int64(row).tobytes())
+        self._file.flush()
+        return True
+
+
+class ManifestIndexWriter:
+    """Streams records into a new index directory with bounded memory.
+
+    Records are appended to a private temporary directory which is renamed
+    into place by `close()`, so concurrent ranks building the same index never
+    observe a partially written one.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.tmp_dir = f"{index_dir}.tmp-{os.getpid()}"
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+
+        self._sizes = open(os.path.join(self.tmp_dir, _SIZES), "wb")
+        self._path_offsets = open(os.path.join(self.tmp_dir, _PATH_OFFSETS), "wb")
+        self._path_bytes = open(os.path.join(self.tmp_dir, _PATH_BYTES), "wb")
+        self._caption_offsets = open(os.path.join(self.tmp_dir, _CAPTION_OFFSETS), "wb")
+        self._caption_bytes = open(os.path.join(self.tmp_dir, _CAPTION_BYTES), "wb")
+
+        self.num_records = 0
+        self._path_end = 0
+        self._caption_end = 0
+        self._path_offsets.write(np.int64(0).tobytes())
+        self._caption_offsets.write(np.int64(0).tobytes())
+
+    def add(self, image_path, size, caption):
+        path = image_path.encode("utf-8")
+        text = (caption or "").encode("utf-8")
+        self._sizes.write(np.asarray(size[:2], dtype=np.int32).tobytes())
+        self._path_bytes.write(path)
+        self._caption_bytes.write(text)
+        self._path_end += len(path)
+        self._caption_end += len(text)
+        self._path_offsets.write(np.int64(self._path_end).tobytes())
+        self._caption_offsets.write(np.int64(self._caption_end).tobytes())
+        self.num_records += 1
+
+    def _close_files(self):
+        for f in (self._sizes, self._path_offsets, self._path_bytes, self._caption_offsets, self._caption_bytes):
+            f.close()
+
+    def close(self):
+        self._close_files()
+        with open(os.path.join(self.tmp_dir, _META), "w") as f:
+            json.dump({"version": INDEX_VERSION, "num_records": self.num_records}, f)
+
+        try:
+            os.rename(self.tmp_dir, self.index_dir)
+        except OSError:
+            # another rank finished first; keep its copy
+            if not ManifestIndex.exists(self.index_dir):
+                raise
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        return self.index_dir
+
+    def abort(self):
+        self._close_files()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def _record_from_item(item):
+    # 列表形式 / jsonl 的单条记录
+    image_path = item["image_path"]  # 图片路径
+    original_size = item["size"]  # [宽, 高]
+    if ('caption' in item) and (item['caption'] != None):
+        caption = item["caption"]  # 图片标签
+    elif ('wd_tag' in item) and (item['wd_tag'] != None):
+        caption = item["wd_tag"]
+    else:
+        caption = ''
+    return image_path, original_size, caption
+
+
+def _record_from_entry(each_file_path, info):
+    # 字典形式的单条记录
+    return each_file_path, info["original_image_size"], info["caption"]
+
+
+class _JSONStream:
+    """Pulls one JSON value at a time out of a text file without loading it whole."""
+
+    def __init__(self, f, progress=None):
+        self.f = f
+        self.progress = progress
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.f.read(_READ_CHUNK)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.progress is not None:
+            self.progress.update(len(chunk.encode("utf-8")))
+        if self.pos > 0:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += chunk
+        return True
+
+    def peek(self):
+        """Next non-whitespace character, or '' at end of file."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Malformed JSON manifest: expected {char!r} at offset {self.pos}.")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # the value straddles the buffer end; objects and strings are
+                # self-delimiting so a failed decode always means "read more"
+                if not self._fill():
+                    raise
+                continue
+            self.pos = end
+            return obj
+
+    def separator(self, close):
+        """Consumes ',' and returns True, or consumes `close` and returns False."""
+        char = self.peek()
+        self.pos += 1
+        if char == ",":
+            return True
+        if char == close:
+            return False
+        raise ValueError(f"Malformed JSON manifest: unexpected {char!r} at offset {self.pos - 1}.")
+
+
+def iter_json_manifest(file_path, progress=None):
+    """Yields (image_path, size, caption) from a list- or dict-form JSON manifest."""
+    with open(file_path, "r", encoding="utf-8") as f:
+        stream = _JSONStream(f, progress)
+        head = stream.peek()
+        # 判断 JSON 数据的类型
+        if head == "[":  # 列表形式
+            stream.expect("[")
+            if stream.peek() == "]":
+                return
+            while True:
+                yield _record_from_item(stream.value())
+                if not stream.separator("]"):
+                    break
+        elif head == "{":  # 字典形式
+            stream.expect("{")
+            if stream.peek() == "}":
+                return
+            while True:
+                key = stream.value()
+                stream.expect(":")
+                yield _record_from_entry(key, stream.value())
+                if not stream.separator("}"):
+                    break
+        else:
+            raise ValueError("Unsupported JSON format. Expected a dictionary or a list.")
+
+
+def iter_jsonl_manifest(file_path, start=0, end=None, progress=None):
+    """Yields records from the lines of a JSONL manifest whose first byte lies in [start, end)."""
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        pos = start
+        while end is None or pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            if progress is not None:
+                progress.update(len(line))
+            line = line.strip()
+            if line:
+                yield _record_from_item(json.loads(line))
+
+
+def _jsonl_split_points(file_path, num_parts):
+    # 按字节切分，并对齐到行首
+    file_size = os.path.getsize(file_path)
+    points = [0]
+    with open(file_path, "rb") as f:
+        for i in range(1, num_parts):
+            f.seek(max(file_size * i // num_parts, points[-1]))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()
+            points.append(max(f.tell(), points[-1]))
+    points.append(file_size)
+    return points
+
+
+def _build_jsonl_part(job):
+    file_path, start, end, part_dir = job
+    writer = ManifestIndexWriter(part_dir)
+    try:
+        for record in iter_jsonl_manifest(file_path, start, end):
+            writer.add(*record)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return end - start
+
+
+def _append_offsets(dst, src_path, num_records, base):
+    # 跳过每个分片开头的 0，并整体平移
+    offsets = _open_array(src_path, np.int64, (num_records + 1,))
+    for i in range(1, num_records + 1, _COPY_CHUNK):
+        chunk = np.asarray(offsets[i:i + _COPY_CHUNK]) + base
+        dst.write(chunk.astype(np.int64).tobytes())
+    return base + (int(offsets[-1]) if num_records else 0)
+
+
+def _append_file(dst, src_path):
+    with open(src_path, "rb") as src:
+        shutil.copyfileobj(src, dst, _COPY_CHUNK)
+
+
+def merge_manifest_indexes(part_dirs, index_dir):
+    """Concatenates index directories, in order, into a new index."""
+    writer = ManifestIndexWriter(index_dir)
+    try:
+        for part_dir in part_dirs:
+            part = ManifestIndex(part_dir)
+            n = len(part)
+            _append_file(writer._sizes, os.path.join(part_dir, _SIZES))
+            _append_file(writer._path_bytes, os.path.join(part_dir, _PATH_BYTES))
+            _append_file(writer._caption_bytes, os.path.join(part_dir, _CAPTION_BYTES))
+            writer._path_end = _append_offsets(
+                writer._path_offsets, os.path.join(part_dir, _PATH_OFFSETS), n, writer._path_end
+            )
+            writer._caption_end = _append_offsets(
+                writer._caption_offsets, os.path.join(part_dir, _CAPTION_OFFSETS), n, writer._caption_end
+            )
+            writer.num_records += n
+            del part
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def _build_jsonl_parallel(file_path, index_dir, num_workers):
+    points = _jsonl_split_points(file_path, num_workers)
+    parts_root = f"{index_dir}.parts-{os.getpid()}"
+    os.makedirs(parts_root, exist_ok=True)
+    jobs = [
+        (file_path, start, end, os.path.join(parts_root, f"{i:05d}"))
+        for i, (start, end) in enumerate(zip(points[:-1], points[1:]))
+    ]
+    try:
+        with Pool(num_workers) as pool, tqdm(total=points[-1], unit="B", unit_scale=True) as progress:
+            for nbytes in pool.imap(_build_jsonl_part, jobs):
+                progress.update(nbytes)
+        merge_manifest_indexes([job[3] for job in jobs], index_dir)
+    finally:
+        shutil.rmtree(parts_root, ignore_errors=True)
+    return index_dir
+
+
+def build_manifest_index(file_path, index_dir=None, num_workers=1):
+    """Streams a JSON / JSONL manifest into a binary index in bounded memory.
+
+    JSONL manifests are split at line boundaries and parsed by `num_workers`
+    processes when `num_workers > 1`; JSON manifests are always read by a single
+    incremental parser since they cannot be split without scanning.
+    """
+    index_dir = index_dir or manifest_index_dir(file_path)
+    if file_path.endswith(".jsonl") and num_workers > 1:
+        return _build_jsonl_parallel(file_path, index_dir, num_workers)
+
+    records = iter_jsonl_manifest if file_path.endswith(".jsonl") else iter_json_manifest
+    with tqdm(total=os.path.getsize(file_path), unit="B", unit_scale=True) as progress:
+        with ManifestIndexWriter(index_dir) as writer:
+            for record in records(file_path, progress=progress):
+                writer.add(*record)
+    return index_dir
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+_EXIF_ORIENTATION = 0x0112
+
+
+def read_image_size(path):
+    """(width, height) as seen by `cv2.imread`, read from the header without decoding pixels."""
+    from PIL import Image
+
+    with Image.open(path) as image:
+        width, height = image.size
+        # cv2.imread 按 EXIF 方向旋转图像，方向 5-8 时宽高互换
+        if image.getexif().get(_EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+
+def _sidecar_caption(image_dir, stem, names):
+    # 优先同名 .txt，其次同名 .json 中的 caption / wd_tag 字段（与 _record_from_item 的优先级一致）
+    if f"{stem}.txt" in names:
+        with open(os.path.join(image_dir, f"{stem}.txt"), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    if f"{stem}.json" in names:
+        with open(os.path.join(image_dir, f"{stem}.json"), "r", encoding="utf-8") as f:
+            item = json.load(f)
+        for key in ("caption", "wd_tag"):
+            if item.get(key) is not None:
+                return item[key]
+    return ""
+
+
+def _build_image_dir_part(job):
+    image_dir, part_dir = job
+    names = sorted(os.listdir(image_dir))
+    name_set = set(names)
+    num_skipped = 0
+    writer = ManifestIndexWriter(part_dir)
+    try:
+        for name in names:
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in IMAGE_EXTENSIONS:
+                continue
+            path = os.path.join(image_dir, name)
+            try:
+                size = read_image_size(path)
+            except Exception as e:
+                print(f"Skipping {path}: {e}")
+                num_skipped += 1
+                continue
+            writer.add(path, size, _sidecar_caption(image_dir, stem, name_set))
+    except BaseException:
+        writer.abort()
+        raise
+    num_records = writer.num_records
+    writer.close()
+    return num_records, num_skipped
+
+
+def list_image_dirs(image_dirs):
+    """Every directory below `image_dirs` that directly contains images, in a stable order."""
+    shards = []
+    for root in image_dirs:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            if any(os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS for name in filenames):
+                shards.append(dirpath)
+    return shards
+
+
+def build_manifest_index_from_images(image_dirs, index_dir, num_workers=8):
+    """Indexes the images below `image_dirs`, one directory per pool task.
+
+    Each directory becomes a part index under `<index_dir>.parts/`, renamed into
+    place when complete, so an interrupted build resumes with the directories
+    that are still missing. The parts are merged in directory order at the end.
+    """
+    if ManifestIndex.exists(index_dir):
+        print(f"{index_dir} already exists")
+        return index_dir
+    image_dirs = [os.path.abspath(image_dir) for image_dir in image_dirs]
+    parts_root = f"{index_dir}.parts"
+    os.makedirs(parts_root, exist_ok=True)
+
+    # 目录列表只在第一次运行时遍历并保存，恢复时分片编号保持不变
+    shards_path = os.path.join(parts_root, "shards.json")
+    if os.path.exists(shards_path):
+        with open(shards_path, "r") as f:
+            saved = json.load(f)
+        if saved["image_dirs"] != image_dirs:
+            raise ValueError(f"{parts_root} belongs to a build of {saved['image_dirs']}; remove it to start over.")
+        shards = saved["shards"]
+    else:
+        shards = list_image_dirs(image_dirs)
+        tmp_path = f"{shards_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump({"image_dirs": image_dirs, "shards": shards}, f)
+        os.replace(tmp_path, shards_path)
+
+    # 被中断的 worker 留下的未完成分片
+    for name in os.listdir(parts_root):
+        if ".tmp-" in name and os.path.isdir(os.path.join(parts_root, name)):
+            shutil.rmtree(os.path.join(parts_root, name), ignore_errors=True)
+
+    jobs = [(shard, os.path.join(parts_root, f"{i:06d}")) for i, shard in enumerate(shards)]
+    pending = [job for job in jobs if not ManifestIndex.exists(job[1])]
+    num_records = num_skipped = 0
+    with Pool(num_workers) as pool, tqdm(total=len(jobs), initial=len(jobs) - len(pending), unit="dir") as progress:
+        for records, skipped in pool.imap_unordered(_build_image_dir_part, pending):
+            num_records += records
+            num_skipped += skipped
+            progress.update(1)
+            progress.set_postfix(images=num_records, skipped=num_skipped)
+
+    merge_manifest_indexes([job[1] for job in jobs], index_dir)
+    shutil.rmtree(parts_root, ignore_errors=True)
+    return index_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds a manifest index from image directories.")
+    parser.add_argument("--image_dirs", type=str, nargs="+", required=True, help="Directories searched recursively for images.")
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        required=True,
+        help="Manifest path later passed to training; the index is written to `<manifest without extension>_index/`.",
+    )
+    parser.add_argument("--num_workers", type=int, default=8, help="Processes reading image headers.")
+    args = parser.parse_args()
+
+    index_dir = build_manifest_index_from_images(args.image_dirs, manifest_index_dir(args.manifest), args.num_workers)
+    print(f"{len(ManifestIndex(index_dir))} images indexed in {index_dir}")
+
+
+if __name__ == "__main__":
+    main()
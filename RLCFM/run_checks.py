@@ -0,0 +1,41 @@
+# 训练组件的确定性检查，任一项不满足容差时 AssertionError 退出：
+#   python run_checks.py                          EMA 与缩放两项检查
+#   python run_checks.py --manifest <x.json>      另外用 manifest 中的真实样本比较 device 缩放与 cv2 路径、降采样解码与全分辨率解码
+#
+# - ema: MultiTensorEMA.step 每 N 步一次的补偿更新与逐张量 update_ema 执行 N 次一致，
+#   包括被跳过的不训练参数和 (target, source) dtype 不同的分组
+# - resize: device 上的批量抗锯齿缩放 (`--dataloader_device_resize`) 与 worker 中 cv2.resize 的最大像素差在容差内
+# - decode (需要 manifest): 降采样解码 (`--dataloader_reduced_decode`) 与全分辨率解码的平均像素差在容差内，并给出耗时
+
+import argparse
+import os
+import sys
+
+import torch
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_ROOT, "SDXL"))
+sys.path.insert(0, os.path.join(_ROOT, "common"))
+
+from dataset_myself import ComicDatasetBucket, benchmark_decode, check_device_resize, check_resize_parity
+from ema import check_ema
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="Also compare the on-device resize and the reduced JPEG decode against the default path on samples of this manifest.",
+    )
+    parser.add_argument("--num_samples", type=int, default=64)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    check_ema()
+    check_resize_parity(device=device)
+    if args.manifest is not None:
+        dataset = ComicDatasetBucket(file_path=args.manifest)
+        check_device_resize(dataset, args.num_samples, device=device)
+        benchmark_decode(dataset, args.num_samples)